@@ -7,6 +7,12 @@ import os
 
 if __name__ == '__main__':
     config_name = os.environ.get('FLASK_ENV', 'development')
+    if config_name == 'production':
+        # Pre-forked workers instead of the development server
+        from server import serve
+        serve(config_name, port=int(os.environ.get('PORT', 5000)))
+        raise SystemExit
+    
     app = create_app(config_name)
     
     # Run the application
@@ -0,0 +1,599 @@
+"""
+ASGI entry point serving the same routes as main.create_app.
+
+Upload bodies (single, batch and chunk) are received on the event loop
+and written to disk from a thread pool, and response bodies are read from
+the pool one chunk at a time, so a slow client holds no thread while it
+waits on the network. Change feed subscribers wait on the event loop too,
+so any number of idle ones hold no thread. Every other route runs
+unchanged inside the pool, from a body spooled up to ASGI_MAX_BODY bytes.
+
+    uvicorn --factory asgi:create_asgi_app
+"""
+
+import asyncio
+import functools
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, NEED_DATA
+from werkzeug.wsgi import FileWrapper
+
+from batch_upload import BatchWriter, batch_size_limit
+from changes import (HEARTBEAT_INTERVAL, ChangeFeedError, ChangeHub, format_sse, format_sse_notice, long_poll_body,
+                     sse_preamble)
+from chunked_upload import ChunkWriter
+from main import create_app
+from routes import (EVENT_STREAM_HEADERS, batch_upload_response, change_feed_request, error_response, get_compression,
+                    get_content_store, get_file_index, get_files_dir, prepare_files_dir, upload_recorder)
+from streaming_upload import (MULTIPART_OVERHEAD, TempUpload, UploadError, check_content_length, multipart_decoder,
+                              place_file, validate_upload_name)
+from utils import format_file_size
+
+# Bodies of proxied requests above this size are spooled to disk
+SPOOL_THRESHOLD = 1024 * 1024
+
+ZERO_COPY_EXTENSIONS = ('http.response.zerocopy', 'http.response.pathsend')
+
+
+class ZeroCopyFile(FileWrapper):
+    """A wrapped file the ASGI server is asked to send itself."""
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the request body was complete."""
+
+
+class BodyTooLarge(Exception):
+    """A request body is over the limit for its route."""
+
+
+def _content_length(environ):
+    try:
+        return int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+async def receive_body(receive):
+    """Yield the request body as it arrives."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        if message.get('body'):
+            yield message['body']
+        if not message.get('more_body'):
+            return
+
+
+def counting_receive(receive, tracked):
+    """Wrap receive so the request's metrics count body bytes as they arrive."""
+    async def counted():
+        message = await receive()
+        if message.get('body'):
+            tracked.received(len(message['body']))
+        return message
+    return counted
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away; the request body must have been read."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class AsyncPart:
+    """One part of a multipart body; its data must be read in order."""
+
+    def __init__(self, reader, name, filename):
+        self._reader = reader
+        self.name = name
+        self.filename = filename
+        self.done = False
+
+    async def chunks(self):
+        """Yield the part's data as it arrives."""
+        while not self.done:
+            data, more = await self._reader._next_data()
+            self.done = not more
+            if data:
+                yield data
+
+    async def drain(self):
+        """Skip whatever is left of this part."""
+        async for _ in self.chunks():
+            pass
+
+
+class AsyncMultipartReader:
+    """MultipartReader over an async body iterator."""
+
+    def __init__(self, body, content_type):
+        self._body = body
+        self._decoder = multipart_decoder(content_type)
+        self._finished = False
+        self._part = None
+
+    async def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if event is not NEED_DATA:
+                return event
+            if self._finished:
+                return None
+            try:
+                chunk = await self._body.__anext__()
+            except StopAsyncIteration:
+                self._finished = True
+                self._decoder.receive_data(None)
+            else:
+                self._decoder.receive_data(chunk)
+
+    async def _next_data(self):
+        event = await self._next_event()
+        if not isinstance(event, Data):
+            raise UploadError('UPLOAD_ERROR', 'Malformed multipart body')
+        return event.data, event.more_data
+
+    async def next_part(self):
+        """Return the next AsyncPart, or None after the last one."""
+        if self._part is not None and not self._part.done:
+            await self._part.drain()
+        while True:
+            try:
+                event = await self._next_event()
+            except ValueError:
+                raise UploadError('UPLOAD_ERROR', 'Malformed multipart body')
+            if event is None or isinstance(event, Epilogue):
+                return None
+            if isinstance(event, (File, Field)):
+                self._part = AsyncPart(self, event.name, event.filename if isinstance(event, File) else None)
+                return self._part
+
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ reading from body."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    extensions = scope.get('extensions') or {}
+    if any(name in extensions for name in ZERO_COPY_EXTENSIONS):
+        # The sendfile download backend then hands its file to _send
+        environ['wsgi.file_wrapper'] = ZeroCopyFile
+        environ['asgi.extensions'] = extensions
+    return environ
+
+
+class AsgiApp:
+    """ASGI application wrapping a Flask app built by create_app."""
+
+    def __init__(self, flask_app, threads=None):
+        self.flask_app = flask_app
+        self.pool = ThreadPoolExecutor(max_workers=threads or flask_app.config['ASGI_THREADS'],
+                                       thread_name_prefix='asgi-io')
+        # Routes whose bodies are streamed from the event loop
+        self._streaming = {
+            'api.upload_file': self._upload_file,
+            'api.upload_batch': self._upload_batch,
+            'api.put_upload_chunk': self._put_upload_chunk,
+        }
+        # One per change feed database, fanning its events out to subscribers
+        self._hubs = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    def _route(self, environ):
+        try:
+            return self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None, {}
+
+    async def _http(self, scope, receive, send):
+        environ = build_environ(scope, None)
+        endpoint, view_args = self._route(environ)
+        if endpoint == 'api.change_feed' and environ['REQUEST_METHOD'] == 'GET':
+            await self._change_feed(environ, receive, send)
+            return
+        if endpoint is None:
+            # The app answers 404 or 405 without looking at the body
+            environ['wsgi.input'] = io.BytesIO()
+            await self._send(self.flask_app, environ, send)
+            return
+
+        # Timed from the start, since the body is read here rather than inside the app
+        metrics = self.flask_app.extensions.get('metrics')
+        tracked = metrics.track(environ) if metrics else None
+        if tracked:
+            receive = counting_receive(receive, tracked)
+        handler = self._streaming.get(endpoint)
+        if environ['REQUEST_METHOD'] == 'OPTIONS' or (
+                endpoint == 'api.upload_file' and not self.flask_app.config['STREAMING_UPLOADS']):
+            handler = None
+        if handler is not None:
+            environ['wsgi.input'] = io.BytesIO()
+            try:
+                response = await handler(environ, receive, view_args)
+            except ClientDisconnected:
+                if tracked:
+                    tracked.finish('499', 0)
+                return
+            if metrics:
+                response = functools.partial(metrics.run, response, tracked=tracked)
+            await self._send(response, environ, send)
+            return
+
+        limit = self._body_limit(endpoint)
+        body = tempfile.SpooledTemporaryFile(SPOOL_THRESHOLD)
+        received = 0
+        try:
+            if _content_length(environ) > limit:
+                raise BodyTooLarge()
+            async for data in receive_body(receive):
+                received += len(data)
+                if received > limit:
+                    raise BodyTooLarge()
+                await self._run(body.write, data)
+        except ClientDisconnected:
+            body.close()
+            if tracked:
+                tracked.finish('499', 0)
+            return
+        except BodyTooLarge:
+            body.close()
+            await self._reject_body(environ, limit, send, metrics, tracked)
+            return
+        body.seek(0)
+        environ['wsgi.input'] = body
+        app = self.flask_app
+        if metrics:
+            app = functools.partial(metrics.run, metrics.wsgi_app, tracked=tracked)
+        try:
+            await self._send(app, environ, send)
+        finally:
+            body.close()
+
+    def _body_limit(self, endpoint):
+        """Largest body spooled for a route that doesn't stream it."""
+        config = self.flask_app.config
+        if endpoint == 'api.upload_file':
+            # STREAMING_UPLOADS is off, so the whole form is spooled for Werkzeug
+            return config['MAX_FILE_SIZE'] + MULTIPART_OVERHEAD
+        return config['ASGI_MAX_BODY']
+
+    async def _reject_body(self, environ, limit, send, metrics, tracked):
+        """Answer 413 without reading the rest of the body."""
+        environ['wsgi.input'] = io.BytesIO()
+        message = f'Request body exceeds maximum allowed size of {format_file_size(limit)}'
+        response = await self._in_request(environ, lambda: (error_response('REQUEST_TOO_LARGE', message), 413))
+        if metrics:
+            response = functools.partial(metrics.run, response, tracked=tracked)
+        await self._send(response, environ, send)
+
+    async def _send(self, wsgi_app, environ, send):
+        """Run a WSGI callable in the pool and stream its body to the client."""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+
+        iterable = await self._run(wsgi_app, environ, start_response)
+        try:
+            if isinstance(iterable, ZeroCopyFile) and await self._send_file(iterable, environ, started, send):
+                return
+            iterator = iter(iterable)
+            chunk = await self._run(next, iterator, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self._run(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                await self._run(iterable.close)
+
+    async def _send_file(self, wrapper, environ, started, send):
+        """Have the server send a wrapped file from its position; False if it can't."""
+        extensions = environ['asgi.extensions']
+        f = wrapper.file
+        try:
+            offset = f.tell()
+            f.fileno()
+        except (AttributeError, OSError):
+            return False
+        if 'http.response.zerocopy' in extensions:
+            message = {'type': 'http.response.zerocopy', 'file': f, 'offset': offset, 'more_body': False}
+        elif offset == 0 and isinstance(getattr(f, 'name', None), (str, os.PathLike)):
+            # pathsend always starts at the beginning of the file
+            message = {'type': 'http.response.pathsend', 'path': os.path.abspath(f.name)}
+        else:
+            return False
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        await send(message)
+        return True
+
+    def _hub(self, feed):
+        hub = self._hubs.get(feed.db_path)
+        if hub is None or hub.feed is not feed:
+            hub = self._hubs[feed.db_path] = ChangeHub(feed, self._run,
+                                                       self.flask_app.config['CHANGE_FEED_POLL_INTERVAL'])
+        return hub
+
+    async def _change_feed(self, environ, receive, send):
+        """GET /api/changes, waiting on the event loop instead of in a thread."""
+        environ['wsgi.input'] = io.BytesIO()
+        metrics = self.flask_app.extensions.get('metrics')
+        tracked = metrics.track(environ) if metrics else None
+        disconnected = None
+        try:
+            async for _ in receive_body(receive):
+                pass
+            disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+            try:
+                feed, seq, stream, wait = await self._with_app(environ, change_feed_request)
+                hub = self._hub(feed)
+                if stream:
+                    sent = await self._stream_changes(environ, hub, seq, send, disconnected)
+                    if tracked:
+                        tracked.finish('200', sent)
+                    return
+                if seq is None:
+                    # Nothing to wait for yet: just tell the client where to start
+                    body = long_poll_body(await self._run(feed.latest), [], None)
+                else:
+                    events, reset = await self._until_disconnect(hub.wait(seq, wait), disconnected)
+                    body = long_poll_body(seq, events, reset)
+                response = await self._in_request(environ, lambda: (jsonify(body), 200))
+            except ChangeFeedError as e:
+                response = await self._in_request(environ, lambda: (error_response(e.code, e.message), e.status))
+            except ClientDisconnected:
+                raise
+            except Exception:
+                response = await self._in_request(
+                    environ, lambda: (error_response('INTERNAL_ERROR', 'Failed to read changes'), 500))
+        except ClientDisconnected:
+            if tracked:
+                tracked.finish('499', 0)
+            return
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+        if metrics:
+            response = functools.partial(metrics.run, response, tracked=tracked)
+        await self._send(response, environ, send)
+
+    async def _until_disconnect(self, awaitable, disconnected):
+        """Await awaitable, or raise ClientDisconnected if the client goes away first."""
+        task = asyncio.ensure_future(awaitable)
+        try:
+            await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not task.done():
+                task.cancel()
+        if not task.done() or task.cancelled():
+            raise ClientDisconnected()
+        return task.result()
+
+    async def _stream_changes(self, environ, hub, seq, send, disconnected):
+        """Send an event stream until the client goes away; returns the bytes sent."""
+        # Headers from the app, so CORS applies as it does to every other route
+        response = await self._in_request(environ, lambda: Response(mimetype='text/event-stream',
+                                                                    headers=EVENT_STREAM_HEADERS))
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers
+                   if key.lower() != 'content-length']
+        if seq is None:
+            seq = await self._run(hub.feed.latest)
+        chunk = sse_preamble(seq)
+        sent = 0
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            while True:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                sent += len(chunk)
+                events, reset = await self._until_disconnect(hub.wait(seq, HEARTBEAT_INTERVAL), disconnected)
+                if reset is not None:
+                    seq = reset
+                    chunk = format_sse_notice('reset', seq)
+                elif events:
+                    seq = events[-1]['seq']
+                    chunk = b''.join(format_sse(event) for event in events)
+                else:
+                    chunk = b': keepalive\n\n'
+        except (ClientDisconnected, OSError):
+            return sent
+
+    def _in_request(self, environ, func, *args):
+        """Call func in the pool inside a request context and return its Response."""
+        def call():
+            app = self.flask_app
+            with app.request_context(environ):
+                return app.process_response(app.make_response(func(*args)))
+        return self._run(call)
+
+    def _with_app(self, environ, func, *args):
+        """Call func in the pool inside a request context and return its result."""
+        def call():
+            with self.flask_app.request_context(environ):
+                return func(*args)
+        return self._run(call)
+
+    async def _upload_file(self, environ, receive, view_args):
+        """POST /api/files, streaming the file part to disk as it arrives."""
+        temp = None
+        try:
+            files_dir, record, store, max_size, compression = await self._with_app(environ, _prepare_upload)
+            reader = AsyncMultipartReader(receive_body(receive), environ.get('CONTENT_TYPE'))
+            while True:
+                part = await reader.next_part()
+                if part is None:
+                    raise UploadError('NO_FILE_PART', 'No file part in the request')
+                if part.name == 'file' and part.filename is not None:
+                    break
+            file_path = await self._run(validate_upload_name, part.filename, files_dir)
+            digest = hashlib.sha256()
+            temp = await self._run(TempUpload, files_dir, max_size, digest)
+            async for data in part.chunks():
+                await self._run(temp.write, data)
+            temp_path, _ = await self._run(temp.close)
+            temp = None
+            return await self._in_request(environ, _finish_upload, temp_path, file_path, record, store,
+                                          digest.hexdigest(), compression)
+        except UploadError as e:
+            return await self._in_request(environ, lambda: (error_response(e.code, e.message), e.status))
+        except ClientDisconnected:
+            raise
+        except Exception:
+            return await self._in_request(environ, lambda: (error_response('UPLOAD_ERROR', 'Failed to upload file'), 500))
+        finally:
+            if temp is not None:
+                await self._run(temp.abort)
+
+    async def _upload_batch(self, environ, receive, view_args):
+        """POST /api/files/batch, parsing parts on the event loop while earlier ones are written.
+
+        Parts go to the same bounded writer pool as in WSGI mode; a full
+        queue only holds up the pool thread putting into it.
+        """
+        try:
+            files_dir, record, store, max_size, max_files, compression = await self._with_app(
+                environ, _prepare_batch_upload)
+            reader = AsyncMultipartReader(receive_body(receive), environ.get('CONTENT_TYPE'))
+            writer = BatchWriter(files_dir, max_size, max_files, store, record, compression)
+            try:
+                while True:
+                    part = await reader.next_part()
+                    if part is None:
+                        break
+                    if part.name != 'files' or part.filename is None:
+                        continue
+                    chunks = await self._run(writer.add_part, part.filename)
+                    if chunks is None:
+                        continue
+                    try:
+                        async for data in part.chunks():
+                            await self._run(chunks.put, data)
+                    except BaseException as e:
+                        # Not awaited, so the writer is released even if we're cancelled
+                        self.pool.submit(chunks.put, e)
+                        raise
+                    await self._run(chunks.put, None)
+            except UploadError:
+                # The body broke off: report the files completed before that
+                if not writer.pending:
+                    raise
+            finally:
+                results = await self._run(writer.finish)
+            if not results:
+                raise UploadError('NO_FILE_PART', 'No file part in the request')
+            return await self._in_request(environ, batch_upload_response, results)
+        except UploadError as e:
+            return await self._in_request(environ, lambda: (error_response(e.code, e.message), e.status))
+        except ClientDisconnected:
+            raise
+        except Exception:
+            return await self._in_request(environ, lambda: (error_response('UPLOAD_ERROR', 'Failed to upload files'), 500))
+
+    async def _put_upload_chunk(self, environ, receive, view_args):
+        """PUT /api/uploads/<id>/chunks/<n>, streaming the chunk to disk."""
+        writer = None
+        try:
+            writer = await self._with_app(environ, lambda: ChunkWriter(get_files_dir(), view_args['upload_id'],
+                                                                       view_args['index'],
+                                                                       current_app.config['UPLOAD_SESSION_TTL'],
+                                                                       environ.get('HTTP_X_CHUNK_CHECKSUM')))
+            async for data in receive_body(receive):
+                await self._run(writer.write, data)
+            chunk = await self._run(writer.commit)
+            writer = None
+            return await self._in_request(environ, lambda: (jsonify(chunk), 200))
+        except UploadError as e:
+            return await self._in_request(environ, lambda: (error_response(e.code, e.message), e.status))
+        except ClientDisconnected:
+            raise
+        except Exception:
+            return await self._in_request(environ, lambda: (error_response('UPLOAD_ERROR', 'Failed to store chunk'), 500))
+        finally:
+            if writer is not None:
+                await self._run(writer.abort)
+
+
+def _prepare_upload():
+    files_dir = prepare_files_dir()
+    max_size = current_app.config['MAX_FILE_SIZE']
+    check_content_length(request.content_length, max_size)
+    # Fetched before writing so our own file doesn't trigger a rescan
+    return files_dir, upload_recorder(get_file_index()), get_content_store(), max_size, get_compression()
+
+
+def _prepare_batch_upload():
+    files_dir = prepare_files_dir()
+    max_size = current_app.config['MAX_FILE_SIZE']
+    max_files = current_app.config['BATCH_UPLOAD_MAX_FILES']
+    check_content_length(request.content_length, batch_size_limit(max_size, max_files))
+    return (files_dir, upload_recorder(get_file_index()), get_content_store(), max_size, max_files,
+            get_compression())
+
+
+def _finish_upload(temp_path, file_path, record, store, content_hash, compression):
+    place_file(temp_path, file_path, store, content_hash, compression)
+    return jsonify({
+        'message': 'File uploaded successfully',
+        'file': record(file_path, content_hash)
+    }), 201
+
+
+def create_asgi_app(config_name=None):
+    """Create the Flask app and wrap it for an ASGI server."""
+    return AsgiApp(create_app(config_name or os.environ.get('FLASK_ENV', 'production')))
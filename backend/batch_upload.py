@@ -0,0 +1,164 @@
+"""
+Batch uploads: many files in one multipart request.
+
+Parts are parsed in order from the request stream. Each file part is
+written by a pool thread fed through a small bounded queue, so parsing
+the next part overlaps with writing and linking the previous ones while
+memory stays constant. Every file succeeds or fails on its own.
+"""
+
+import hashlib
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from streaming_upload import (MULTIPART_OVERHEAD, MultipartReader, TempUpload, UploadError, check_content_length,
+                              place_file, validate_upload_name)
+
+WRITE_QUEUE_DEPTH = 8
+WRITER_THREADS = 4
+
+
+def _write_part(chunks, files_dir, file_path, max_size, store, on_saved, compression):
+    """Drain one part's queue into a temp file and move it into place.
+
+    The queue ends with None, or with an exception if the body broke off.
+    """
+    digest = hashlib.sha256()
+    upload, error = None, None
+    try:
+        upload = TempUpload(files_dir, max_size, digest)
+    except BaseException as e:
+        error = e
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, BaseException):
+            error = error or chunk
+            break
+        if error is None:
+            try:
+                upload.write(chunk)
+            except BaseException as e:
+                # Keep draining so the parser never blocks on a full queue
+                error = e
+    if error is not None:
+        if upload is not None:
+            upload.abort()
+        raise error
+    temp_path, _ = upload.close()
+    place_file(temp_path, file_path, store, digest.hexdigest(), compression)
+    return on_saved(file_path, digest.hexdigest()) if on_saved else None
+
+
+def error_result(filename, code, message):
+    return {'filename': filename, 'status': 'error', 'error': {'code': code, 'message': message}}
+
+
+def batch_size_limit(max_size, max_files):
+    """Largest file size a batch body may declare, as passed to check_content_length."""
+    return (max_size + MULTIPART_OVERHEAD) * max_files
+
+
+def claim_part(filename, files_dir, claimed, count, max_files):
+    """Validate the name of a batch's next file part and reserve it.
+
+    count is the number of parts already in the results. Raises UploadError
+    if the batch is full or the name is taken, by a file or an earlier part.
+    """
+    if count >= max_files:
+        raise UploadError('TOO_MANY_FILES', f'A batch may contain at most {max_files} files')
+    file_path = validate_upload_name(filename, files_dir)
+    if file_path.name in claimed:
+        # Already being written by an earlier part of this batch
+        raise UploadError('FILE_EXISTS', 'File already exists', 409)
+    claimed.add(file_path.name)
+    return file_path
+
+
+class BatchWriter:
+    """Writes a batch's file parts concurrently and collects their results.
+
+    Each accepted part gets a bounded queue drained by one of
+    WRITER_THREADS threads, so the caller can parse the next part while
+    earlier ones are still being written. Feed a part's chunks into its
+    queue, then None, or the exception that ended the body.
+    """
+
+    def __init__(self, files_dir, max_size, max_files, store=None, on_saved=None, compression=None):
+        self.files_dir = files_dir
+        self.max_size = max_size
+        self.max_files = max_files
+        self.store = store
+        self.on_saved = on_saved
+        self.compression = compression
+        self.pending = []
+        self._results = []
+        self._claimed = set()
+        self._pool = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix='batch-upload')
+
+    def add_part(self, filename):
+        """Start writing a part; returns its chunk queue, or None if the part was refused."""
+        try:
+            file_path = claim_part(filename, self.files_dir, self._claimed, len(self._results), self.max_files)
+        except UploadError as e:
+            self._results.append(error_result(filename, e.code, e.message))
+            return None
+        chunks = queue.Queue(WRITE_QUEUE_DEPTH)
+        future = self._pool.submit(_write_part, chunks, self.files_dir, file_path, self.max_size, self.store,
+                                   self.on_saved, self.compression)
+        self.pending.append((len(self._results), filename, future))
+        self._results.append(None)
+        return chunks
+
+    def finish(self):
+        """Wait for every write; returns one result per part, in request order."""
+        try:
+            for position, filename, future in self.pending:
+                try:
+                    self._results[position] = {'filename': filename, 'status': 'uploaded', 'file': future.result()}
+                except UploadError as e:
+                    self._results[position] = error_result(filename, e.code, e.message)
+                except Exception:
+                    self._results[position] = error_result(filename, 'UPLOAD_ERROR', 'Failed to upload file')
+        finally:
+            self._pool.shutdown()
+        return self._results
+
+
+def stream_batch_upload(stream, content_type, content_length, files_dir, max_size, max_files,
+                        store=None, on_saved=None, field='files', compression=None):
+    """Save every file part named `field` and return one result per part.
+
+    Results are in request order: {'filename', 'status': 'uploaded', 'file'}
+    or {'filename', 'status': 'error', 'error': {'code', 'message'}}.
+    on_saved(path, sha256hex) is called from a writer thread for each saved
+    file and its return value becomes the result's 'file'. If the body
+    breaks off, files completed before that point are kept and reported.
+    """
+    check_content_length(content_length, batch_size_limit(max_size, max_files))
+    reader = MultipartReader(stream, content_type)
+    writer = BatchWriter(files_dir, max_size, max_files, store, on_saved, compression)
+    try:
+        for part in reader.parts():
+            if part.name != field or part.filename is None:
+                continue
+            chunks = writer.add_part(part.filename)
+            if chunks is None:
+                continue
+            try:
+                for chunk in part.chunks():
+                    chunks.put(chunk)
+            except BaseException as e:
+                chunks.put(e)
+                raise
+            chunks.put(None)
+    except UploadError:
+        if not writer.pending:
+            raise
+    finally:
+        results = writer.finish()
+
+    if not results:
+        raise UploadError('NO_FILE_PART', 'No file part in the request')
+    return results
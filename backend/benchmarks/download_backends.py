@@ -0,0 +1,214 @@
+"""
+Compare download backends: throughput and how long workers stay busy.
+
+Serves one large file through /download with each DOWNLOAD_BACKEND and
+hits it with concurrent clients. "Occupancy" is the fraction of worker
+thread time spent inside a request (from the app call until the server
+closes the response), which is what a slow client costs.
+
+The stream and sendfile backends differ only on servers that implement
+wsgi.file_wrapper with os.sendfile, so use --server worker (server.py's
+worker) or --server gunicorn (needs gunicorn installed) to see the
+zero-copy path. The offload backends
+return right after validation; without nginx/Apache in front the bytes
+aren't sent at all, so their throughput column is the proxy's job and
+only occupancy and latency are meaningful.
+
+Usage:
+    python benchmarks/download_backends.py --size-mb 100 --clients 8 --requests 32
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+from downloads import DOWNLOAD_BACKENDS
+from main import create_app
+
+
+class Occupancy:
+    """WSGI middleware summing the time each request holds a worker."""
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = multiprocessing.Value('d', 0.0)
+
+    def record(self, seconds):
+        with self.busy.get_lock():
+            self.busy.value += seconds
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        body = self.app(environ, start_response)
+        original_close = getattr(body, 'close', None)
+
+        def close():
+            try:
+                if original_close:
+                    original_close()
+            finally:
+                self.record(time.perf_counter() - started)
+
+        try:
+            # Patch in place so servers still recognise their file_wrapper
+            body.close = close
+            return body
+        except AttributeError:
+            return ClosingIterator(body, [lambda: self.record(time.perf_counter() - started)])
+
+
+def build_app(files_dir, backend):
+    app = create_app('testing')
+    app.config['FILES_DIRECTORY'] = files_dir
+    app.config['DOWNLOAD_BACKEND'] = backend
+    return Occupancy(app)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_werkzeug(app, port, threads):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def serve_worker(app, port, threads):
+    from server import WorkerServer
+
+    server = WorkerServer('127.0.0.1', port, app, threads)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def serve_gunicorn(app, port, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'127.0.0.1:{port}')
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', threads)
+            self.cfg.set('loglevel', 'warning')
+
+        def load(self):
+            return app
+
+    process = multiprocessing.Process(target=Server().run, daemon=True)
+    process.start()
+    return process.terminate
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def fetch(port, path):
+    """Download one URL, returning (bytes read, seconds)."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        received = 0
+        while True:
+            data = response.read(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+        return received, time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def run_backend(backend, files_dir, server, clients, requests):
+    app = build_app(files_dir, backend)
+    port = free_port()
+    serve = {'werkzeug': serve_werkzeug, 'worker': serve_worker, 'gunicorn': serve_gunicorn}[server]
+    stop = serve(app, port, clients)
+    try:
+        wait_for_port(port)
+        fetch(port, '/download/payload.bin')  # warm up
+        app.busy.value = 0.0
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            results = list(pool.map(lambda _: fetch(port, '/download/payload.bin'), range(requests)))
+        wall = time.perf_counter() - started
+    finally:
+        stop()
+
+    total_bytes = sum(received for received, _ in results)
+    latencies = sorted(seconds for _, seconds in results)
+    return {
+        'backend': backend,
+        'server': server,
+        'requests': requests,
+        'clients': clients,
+        'wall_seconds': round(wall, 3),
+        'throughput_mb_s': round(total_bytes / wall / 1e6, 1),
+        'p50_latency_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'worker_busy_seconds': round(app.busy.value, 3),
+        'worker_occupancy': round(app.busy.value / (wall * clients), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--server', choices=['werkzeug', 'worker', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--backends', default=','.join(DOWNLOAD_BACKENDS))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as files_dir:
+        with open(os.path.join(files_dir, 'payload.bin'), 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        results = [run_backend(backend, files_dir, args.server, args.clients, args.requests)
+                   for backend in args.backends.split(',')]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'backend':<18}{'MB/s':>10}{'p50 ms':>10}{'busy s':>10}{'occupancy':>11}")
+    for r in results:
+        print(f"{r['backend']:<18}{r['throughput_mb_s']:>10}{r['p50_latency_ms']:>10}"
+              f"{r['worker_busy_seconds']:>10}{r['worker_occupancy']:>11}")
+
+
+if __name__ == '__main__':
+    main()
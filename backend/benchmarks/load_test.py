@@ -0,0 +1,172 @@
+"""
+Load test: the Flask development server against the pre-forked launcher.
+
+Starts each server in turn on a directory of generated files, drives it
+from several client processes (so the client's own GIL isn't the limit)
+with keep-alive connections, and reports throughput and latency.
+
+Usage:
+    python benchmarks/load_test.py --files 2000 --clients 4 --connections 8 --duration 10
+    python benchmarks/load_test.py --path '/api/files?per_page=50&sort_by=size' --json
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+
+DEV_SERVER = (
+    "import sys; from main import create_app; "
+    "create_app('production').run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server on port {port} did not come up')
+
+
+def client_process(port, paths, connections, duration, results):
+    """Run `connections` keep-alive loops for `duration` seconds."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def loop(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local, i = [], offset
+        while time.monotonic() < stop_at:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - started)
+            else:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=loop, args=(n,)) for n in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((latencies, errors[0]))
+
+
+def run_load(port, paths, clients, connections, duration):
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=client_process, args=(port, paths, connections, duration, results))
+             for _ in range(clients)]
+    for p in procs:
+        p.start()
+    latencies, errors = [], 0
+    for _ in procs:
+        lat, err = results.get()
+        latencies.extend(lat)
+        errors += err
+    for p in procs:
+        p.join()
+    latencies.sort()
+
+    def pct(q):
+        return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 2) if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'req_per_s': round(len(latencies) / duration, 1),
+        'p50_ms': pct(0.50),
+        'p99_ms': pct(0.99),
+    }
+
+
+def start_server(mode, port, env, workers, threads):
+    if mode == 'dev':
+        cmd = [sys.executable, '-c', DEV_SERVER, str(port)]
+    else:
+        cmd = [sys.executable, 'server.py', '--bind', f'127.0.0.1:{port}', '--config', 'production']
+        if workers:
+            cmd += ['--workers', str(workers)]
+        if threads:
+            cmd += ['--threads', str(threads)]
+    return subprocess.Popen(cmd, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000, help='files to generate')
+    parser.add_argument('--clients', type=int, default=4, help='client processes')
+    parser.add_argument('--connections', type=int, default=8, help='keep-alive connections per client process')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per server')
+    parser.add_argument('--workers', type=int, help='launcher workers (default: one per CPU)')
+    parser.add_argument('--threads', type=int, help='launcher threads per worker')
+    parser.add_argument('--path', action='append', help='request path (repeatable)')
+    parser.add_argument('--servers', default='dev,prefork', help='comma-separated: dev, prefork')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    paths = args.path or ['/api/files?per_page=50&sort_by=size', '/api/files?search=file_1&per_page=20', '/health']
+    results = []
+    with tempfile.TemporaryDirectory() as files_dir:
+        for i in range(args.files):
+            Path(files_dir, f'file_{i:06d}.txt').write_bytes(b'x' * (i % 4096))
+        env = dict(os.environ, FILES_DIRECTORY=files_dir, FILE_WATCHER='off', FLASK_DEBUG='false',
+                   PYTHONPATH=str(BACKEND))
+
+        for mode in args.servers.split(','):
+            port = free_port()
+            server = start_server(mode, port, env, args.workers, args.threads)
+            try:
+                wait_for(port)
+                stats = run_load(port, paths, args.clients, args.connections, args.duration)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+            results.append(dict(server=mode, **stats))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'server':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for r in results:
+        print(f"{r['server']:<10}{r['req_per_s']:>10}{r['p50_ms']!s:>10}{r['p99_ms']!s:>10}{r['errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
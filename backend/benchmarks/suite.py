@@ -0,0 +1,400 @@
+"""
+Benchmark suite for the file API: listing at scale, transfer throughput, memory.
+
+For each directory size, generates (or reuses) a synthetic directory of
+files with seeded random names, sizes and mtimes, then times
+GET /api/files for every sort_by, with no search, a common term and a
+single-match term, at the first, middle and last page. Uploads and
+downloads of small and large files are then timed under concurrency
+against a threaded server. Every scenario runs in a fresh process, whose
+peak RSS is recorded alongside its timings.
+
+Results are written as JSON. Given a saved baseline, any metric worse
+than the baseline by more than --tolerance (and a small absolute noise
+floor) is reported and the script exits with status 1, so it can gate CI.
+
+Usage:
+    python benchmarks/suite.py --sizes 1000,10000 --output results.json
+    python benchmarks/suite.py --sizes 1000,10000,100000,1000000 --data-dir /var/tmp/bench --save-baseline base.json
+    python benchmarks/suite.py --sizes 1000,10000 --baseline base.json --tolerance 0.2
+    python benchmarks/suite.py --only transfer --large-mb 100 --concurrency 8 --listing sqlite
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND))
+
+SORT_FIELDS = ('name', 'size', 'modified', 'type')
+DEPTHS = ('first', 'middle', 'last')
+WORDS = ('report', 'invoice', 'photo', 'backup', 'notes', 'draft', 'scan', 'export')
+EXTENSIONS = ('.txt', '.pdf', '.jpg', '.png', '.csv', '.log', '.zip', '.mp4')
+
+# Marks a generated directory as complete, so later runs can reuse it
+MARKER = '.benchmark-files'
+
+BLOCK = os.urandom(1024 * 1024)
+
+# Which way is better for each metric, and the smallest change that isn't noise
+METRICS = {
+    'p50_ms': ('lower', 0.5),
+    'p95_ms': ('lower', 1.0),
+    'seconds': ('lower', 0.05),
+    'mb_s': ('higher', 1.0),
+    'files_s': ('higher', 5.0),
+    'peak_rss_mb': ('lower', 5.0),
+}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summarize(samples):
+    """Latency percentiles of a list of durations in seconds."""
+    samples = sorted(samples)
+
+    def pct(q):
+        return round(samples[min(int(q * len(samples)), len(samples) - 1)] * 1000, 3)
+
+    return {'p50_ms': pct(0.50), 'p95_ms': pct(0.95)}
+
+
+def generate_files(directory, count, seed=0):
+    """Fill `directory` with `count` sparse files; reused if already generated."""
+    directory = Path(directory)
+    marker = directory / MARKER
+    if marker.exists() and marker.read_text().strip() == f'{count} {seed}':
+        return directory
+    if directory.exists():
+        shutil.rmtree(directory)
+    directory.mkdir(parents=True)
+
+    rng = random.Random(seed)
+    now = time.time()
+    for i in range(count):
+        name = f'{rng.choice(WORDS)}_{i:07d}{rng.choice(EXTENSIONS)}'
+        fd = os.open(directory / name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            # Sparse, so a million files take inodes but hardly any disk
+            os.ftruncate(fd, min(int(rng.lognormvariate(9, 2)), 1 << 30))
+            mtime = int((now - rng.uniform(0, 2 * 365 * 86400)) * 1e9)
+            os.utime(fd, ns=(mtime, mtime))
+        finally:
+            os.close(fd)
+    marker.write_text(f'{count} {seed}')
+    return directory
+
+
+def build_app(files_dir, listing, state_dir):
+    from main import create_app
+
+    app = create_app('testing')
+    app.config['FILES_DIRECTORY'] = str(files_dir)
+    app.config['LISTING_BACKEND'] = listing
+    # Keep persistent state out of reused data directories, so every run starts cold
+    app.config['CATALOG_PATH'] = os.path.join(state_dir, 'catalog.sqlite3')
+    app.config['JOBS_PATH'] = os.path.join(state_dir, 'jobs.sqlite3')
+    app.config['MAX_FILE_SIZE'] = 1 << 40
+    return app
+
+
+def listing_cases(count):
+    """(label, search term) pairs: none, about 1/8 of the names, and one name."""
+    return [('none', ''), ('common', WORDS[0]), ('rare', f'{count // 2:07d}')]
+
+
+def listing_process(files_dir, count, listing, repeat, per_page, results):
+    """Time the listing queries against one directory, in a process of its own."""
+    with tempfile.TemporaryDirectory() as state_dir:
+        client = build_app(files_dir, listing, state_dir).test_client()
+
+        # The first request builds the index (or catalog) from a scan
+        started = time.perf_counter()
+        response = client.get(f'/api/files?per_page={per_page}')
+        build = time.perf_counter() - started
+        assert response.status_code == 200, response.status_code
+
+        records = [{'id': f'index_build/{listing}/{count}', 'benchmark': 'index_build', 'listing': listing,
+                    'files': count, 'seconds': round(build, 3)}]
+        for sort_by in SORT_FIELDS:
+            for label, search in listing_cases(count):
+                base = f'/api/files?per_page={per_page}&sort_by={sort_by}&search={search}'
+                pages = client.get(base).get_json()['pagination']['total_pages']
+                for depth in DEPTHS:
+                    page = {'first': 1, 'middle': max(pages // 2, 1), 'last': max(pages, 1)}[depth]
+                    samples = []
+                    for _ in range(repeat):
+                        started = time.perf_counter()
+                        response = client.get(f'{base}&page={page}')
+                        samples.append(time.perf_counter() - started)
+                        assert response.status_code == 200, response.status_code
+                    records.append(dict(
+                        id=f'listing/{listing}/{count}/{sort_by}/{label}/{depth}', benchmark='listing',
+                        listing=listing, files=count, sort_by=sort_by, search=label, depth=depth,
+                        **summarize(samples)))
+        records.append({'id': f'listing_rss/{listing}/{count}', 'benchmark': 'listing_rss', 'listing': listing,
+                        'files': count, 'peak_rss_mb': peak_rss_mb()})
+    results.put(records)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def server_process(files_dir, listing, port, stop, results):
+    """Serve the app on `port` until `stop` is set, then report peak RSS."""
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as state_dir:
+        server = make_server('127.0.0.1', port, build_app(files_dir, listing, state_dir), threaded=True)
+        server.timeout = 0.2
+        while not stop.is_set():
+            server.handle_request()
+        server.server_close()
+    results.put(peak_rss_mb())
+
+
+def upload(port, name, size):
+    """POST one file of `size` bytes as multipart/form-data; returns seconds."""
+    boundary = secrets.token_hex(16)
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def body():
+        yield head
+        remaining = size
+        while remaining > 0:
+            chunk = BLOCK[:min(len(BLOCK), remaining)]
+            remaining -= len(chunk)
+            yield chunk
+        yield tail
+
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request('POST', '/api/files', body=body(), headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + size + len(tail)),
+        })
+        response = conn.getresponse()
+        response.read()
+        if response.status != 201:
+            raise RuntimeError(f'Upload of {name} failed with {response.status}')
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def download(port, name, size):
+    """GET one file and discard it; returns seconds."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request('GET', f'/download/{name}')
+        response = conn.getresponse()
+        received = 0
+        while True:
+            data = response.read(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+        if response.status != 200 or received != size:
+            raise RuntimeError(f'Download of {name} failed with {response.status} ({received} bytes)')
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def run_transfer(transfer, port, files, size, concurrency):
+    """Run one transfer per (name, size) on `concurrency` threads."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(lambda name: transfer(port, name, size), files))
+    wall = time.perf_counter() - started
+    return dict(summarize(samples), seconds=round(wall, 3), files_s=round(len(files) / wall, 1),
+                mb_s=round(len(files) * size / wall / 1e6, 1))
+
+
+def transfer_benchmarks(args, context):
+    """Upload then download small and large files against one server process."""
+    cases = [('small', args.small_kb * 1024, args.small_files), ('large', args.large_mb * 1024 * 1024,
+                                                                   args.large_files or args.concurrency)]
+    records = []
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as files_dir:
+        port = free_port()
+        stop, results = context.Event(), context.Queue()
+        server = context.Process(target=server_process, args=(files_dir, args.listing, port, stop, results))
+        server.start()
+        try:
+            wait_for_port(port)
+            for label, size, count in cases:
+                names = [f'{label}_{i:06d}.bin' for i in range(count)]
+                for direction, transfer in (('upload', upload), ('download', download)):
+                    stats = run_transfer(transfer, port, names, size, args.concurrency)
+                    records.append(dict(id=f'{direction}/{label}/c{args.concurrency}', benchmark=direction,
+                                        size=label, bytes=size, files=count, concurrency=args.concurrency, **stats))
+                    log(f'{direction} {count} x {size} bytes: {stats["mb_s"]} MB/s, {stats["files_s"]} files/s')
+        finally:
+            stop.set()
+            rss = results.get(timeout=60)
+            server.join()
+    records.append({'id': 'transfer_rss', 'benchmark': 'transfer_rss', 'peak_rss_mb': rss})
+    return records
+
+
+def listing_benchmarks(args, context):
+    records = []
+    data_dir = Path(args.data_dir or tempfile.mkdtemp(prefix='benchmark-'))
+    try:
+        for count in args.sizes:
+            started = time.perf_counter()
+            files_dir = generate_files(data_dir / f'files-{count}', count, args.seed)
+            log(f'{count} files ready in {time.perf_counter() - started:.1f}s')
+            results = context.Queue()
+            process = context.Process(target=listing_process,
+                                      args=(files_dir, count, args.listing, args.repeat, args.per_page, results))
+            process.start()
+            scenario = results.get()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError(f'Listing benchmark for {count} files failed')
+            records += scenario
+            log(f'listing {count} files: index built in {scenario[0]["seconds"]}s, '
+                f'peak RSS {scenario[-1]["peak_rss_mb"]} MB')
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    return records
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` against `baseline`: (id, metric, before, after) tuples."""
+    before = {record['id']: record for record in baseline['results']}
+    regressions = []
+    for record in results['results']:
+        old = before.get(record['id'])
+        if old is None:
+            continue
+        for metric, (better, floor) in METRICS.items():
+            if metric not in record or metric not in old:
+                continue
+            change = record[metric] - old[metric]
+            if better == 'higher':
+                change = -change
+            if change > floor and change > tolerance * abs(old[metric]):
+                regressions.append((record['id'], metric, old[metric], record[metric]))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated directory sizes')
+    parser.add_argument('--only', default='listing,transfer', help='comma-separated: listing, transfer')
+    parser.add_argument('--listing', choices=['memory', 'sqlite'], default='memory', help='LISTING_BACKEND')
+    parser.add_argument('--repeat', type=int, default=20, help='requests per listing query')
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated names, sizes and mtimes')
+    parser.add_argument('--data-dir', help='keep generated directories here and reuse them (default: temporary)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent transfers')
+    parser.add_argument('--small-kb', type=int, default=16)
+    parser.add_argument('--small-files', type=int, default=500)
+    parser.add_argument('--large-mb', type=int, default=100)
+    parser.add_argument('--large-files', type=int, help='default: one per concurrent transfer')
+    parser.add_argument('--output', help='write the results JSON here')
+    parser.add_argument('--baseline', help='compare against this results JSON; exit 1 on a regression')
+    parser.add_argument('--save-baseline', help='write the results JSON here as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown (default: 0.2)')
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+
+    # Fresh interpreters, so one scenario's memory doesn't count against the next
+    context = multiprocessing.get_context('spawn')
+    only = args.only.split(',')
+    records = []
+    if 'listing' in only:
+        records += listing_benchmarks(args, context)
+    if 'transfer' in only:
+        records += transfer_benchmarks(args, context)
+
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'baseline', 'save_baseline')},
+        },
+        'results': records,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+    if not args.output:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for id_, metric, old, new in regressions:
+            log(f'REGRESSION {id_} {metric}: {old} -> {new}')
+        if regressions:
+            log(f'{len(regressions)} regressions beyond {args.tolerance:.0%} of the baseline')
+            sys.exit(1)
+        log('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Bulk deletes: many files removed in one request.
+
+Unlinks run on a small thread pool so a large cleanup isn't bound by one
+syscall at a time, and the caller updates its listing state once with
+the names that were actually removed. Every file succeeds or fails on
+its own.
+"""
+
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import is_local
+
+DELETE_THREADS = 8
+
+
+def _delete_one(file_path, store, dry_run):
+    """Unlink one file (or just stat it on a dry run).
+
+    Returns its stat taken before the unlink, and whether a content-store
+    blob holds one more link to it.
+    """
+    st = os.lstat(file_path) if is_local(file_path) else file_path.stat()
+    if not stat.S_ISREG(st.st_mode):
+        raise IsADirectoryError(file_path)
+    in_store = store is not None and store.digest_of(file_path) is not None
+    if not dry_run:
+        if store is not None:
+            store.remove(file_path)
+        else:
+            file_path.unlink()
+    return st, in_store
+
+
+def _bytes_freed(removed):
+    """Bytes each removal releases, given (stat, in_store) per name.
+
+    Data is only released when the batch drops every link to it; the
+    content store's blob link doesn't count, since the store removes it
+    with the last name. Names sharing an inode count its size once, on the
+    first of them. The link count is read from the earliest stat of each
+    inode, which precedes every unlink of it in this batch.
+    """
+    groups = {}
+    for st, in_store in removed:
+        if getattr(st, 'st_nlink', 1) > 1:
+            names, nlink, blob = groups.get((st.st_dev, st.st_ino), (0, 0, False))
+            groups[(st.st_dev, st.st_ino)] = (names + 1, max(nlink, st.st_nlink), blob or in_store)
+    freed, counted = [], set()
+    for st, _ in removed:
+        if getattr(st, 'st_nlink', 1) <= 1:
+            freed.append(st.st_size)
+            continue
+        key = (st.st_dev, st.st_ino)
+        names, nlink, blob = groups[key]
+        freed.append(st.st_size if key not in counted and names + blob >= nlink else 0)
+        counted.add(key)
+    return freed
+
+
+def delete_failure(filename, code, message):
+    return {'filename': filename, 'error': {'code': code, 'message': message}}
+
+
+def _failure_for(filename, error):
+    if isinstance(error, FileNotFoundError):
+        return delete_failure(filename, 'FILE_NOT_FOUND', 'File not found')
+    if isinstance(error, PermissionError):
+        return delete_failure(filename, 'PERMISSION_DENIED', 'Permission denied')
+    return delete_failure(filename, 'DELETE_ERROR', 'Failed to delete file')
+
+
+def delete_files(paths, store=None, dry_run=False):
+    """Delete paths concurrently.
+
+    Returns (deleted, failures): deleted is a list of (name, bytes_freed)
+    in the order given, failures a list of
+    {'filename', 'error': {'code', 'message'}}. With dry_run nothing is
+    removed and deleted lists what would be, with the same byte counts.
+    """
+    names, removed, failures = [], [], []
+    if not paths:
+        return [], failures
+    with ThreadPoolExecutor(max_workers=min(DELETE_THREADS, len(paths)), thread_name_prefix='bulk-delete') as pool:
+        futures = [(path, pool.submit(_delete_one, path, store, dry_run)) for path in paths]
+        for path, future in futures:
+            try:
+                removed.append(future.result())
+                names.append(path.name)
+            except OSError as e:
+                failures.append(_failure_for(path.name, e))
+    return list(zip(names, _bytes_freed(removed))), failures
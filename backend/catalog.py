@@ -0,0 +1,444 @@
+"""
+Persistent SQLite catalog of file metadata.
+
+A drop-in alternative to FileIndex: the same methods, backed by a table
+with one index per sort order, so listings are ORDER BY ... LIMIT queries.
+The database is shared by every worker process, survives restarts, and
+is reconciled with the directory on startup.
+"""
+
+import logging
+import os
+import secrets
+import sqlite3
+import stat
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from compression import logical_size
+from metrics import LISTING_SCAN_FILES, LISTING_SCAN_SECONDS
+from search_index import GRAM, SCORE_LIMIT, FUZZY_CANDIDATES, rank_names, trigrams
+from storage import get_storage, is_local
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = '.catalog.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    name_lower TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    type TEXT NOT NULL,
+    content_hash TEXT,
+    uploaded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name_lower, name);
+CREATE INDEX IF NOT EXISTS files_by_size ON files (size, name_lower, name);
+CREATE INDEX IF NOT EXISTS files_by_modified ON files (mtime, name_lower, name);
+CREATE INDEX IF NOT EXISTS files_by_type ON files (type, name_lower, name);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# Trigram full-text index over names, kept in step with files by triggers
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE files_fts USING fts5(name, content='files', content_rowid='rowid', tokenize='trigram');
+CREATE TRIGGER files_fts_insert AFTER INSERT ON files BEGIN
+    INSERT INTO files_fts (rowid, name) VALUES (new.rowid, new.name);
+END;
+CREATE TRIGGER files_fts_delete AFTER DELETE ON files BEGIN
+    INSERT INTO files_fts (files_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+END;
+INSERT INTO files_fts (files_fts) VALUES ('rebuild');
+"""
+
+# Columns of each sort order, matching file_index.sort_key()
+SORT_COLUMNS = {
+    'name': ('name_lower', 'name'),
+    'size': ('size', 'name_lower', 'name'),
+    'modified': ('mtime', 'name_lower', 'name'),
+    'type': ('type', 'name_lower', 'name'),
+}
+
+
+def _row_to_info(row):
+    name, size, mtime, file_type = row
+    return {
+        'name': name,
+        'size': size,
+        'last_modified': datetime.fromtimestamp(mtime).isoformat(),
+        'type': file_type
+    }
+
+
+def _file_type(name):
+    return Path(name).suffix.lower() or 'no-extension'
+
+
+class FileCatalog:
+    """File metadata in SQLite, with the FileIndex interface."""
+
+    def __init__(self, directory, db_path=None):
+        self.directory = Path(directory)
+        self.storage = get_storage(directory)
+        self.db_path = str(db_path or self.directory / CATALOG_FILENAME)
+        self.watched = False
+        self.feed = None
+        self._local = threading.local()
+        self._synced_mtime = None
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone()
+            if not exists:
+                conn.executescript(SEARCH_SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', ?)", (secrets.token_hex(8),))
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _directory_mtime(self):
+        return self.storage.mtime()
+
+    def _set_synced_mtime(self, conn, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dir_mtime', ?)", (value,))
+        self._synced_mtime = value
+
+    @staticmethod
+    def _changed(conn):
+        # Random rather than a counter, so a recreated database can't repeat an old version
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (secrets.token_hex(8),))
+
+    def _publish(self, updates):
+        """Report {name: (info, mtime) or None} to the change feed, if any."""
+        if self.feed is None or not updates:
+            return
+        try:
+            self.feed.record(updates)
+        except sqlite3.Error:
+            # The listing stays right; only subscribers miss the event
+            logger.warning('Could not record %d changes in the change feed', len(updates), exc_info=True)
+
+    def attach_feed(self, feed):
+        """Report changes to feed from now on, after logging any made while nobody was watching."""
+        if self.feed is feed:
+            return
+        rows = self._connect().execute('SELECT name, size, mtime, type FROM files')
+        try:
+            feed.record({row[0]: (_row_to_info(row), row[2]) for row in rows}, full=True)
+        except sqlite3.Error:
+            logger.warning('Could not compare the catalog with the change feed', exc_info=True)
+        self.feed = feed
+
+    def _upsert(self, conn, path, st, content_hash=None, uploaded_at=None):
+        """Record a file's row and return its logical size."""
+        name = path.name
+        size = logical_size(path, st)
+        conn.execute(
+            """
+            INSERT INTO files (name, name_lower, size, mtime, type, content_hash, uploaded_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                size = excluded.size,
+                mtime = excluded.mtime,
+                content_hash = CASE
+                    WHEN excluded.content_hash IS NOT NULL THEN excluded.content_hash
+                    WHEN files.size = excluded.size AND files.mtime = excluded.mtime THEN files.content_hash
+                END,
+                uploaded_at = COALESCE(?, files.uploaded_at)
+            """,
+            (name, name.lower(), size, st.st_mtime, _file_type(name), content_hash,
+             uploaded_at or st.st_mtime, uploaded_at))
+        return size
+
+    def rebuild(self):
+        """Reconcile the table with the directory in one transaction."""
+        started = time.perf_counter()
+        dir_mtime = self._directory_mtime()
+        on_disk = {}
+        if dir_mtime is not None:
+            for entry in self.storage.scan():
+                try:
+                    path = Path(entry.path) if is_local(entry.path) else entry.path
+                    on_disk[entry.name] = (path, entry.stat())
+                except OSError:
+                    continue
+
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            known = {name: (size, mtime) for name, size, mtime in conn.execute('SELECT name, size, mtime FROM files')}
+            gone = [(name,) for name in known if name not in on_disk]
+            conn.executemany('DELETE FROM files WHERE name = ?', gone)
+            updates = {name: None for name, in gone}
+            for name, (path, st) in on_disk.items():
+                current = known.get(name)
+                # Only a size mismatch at the same mtime needs a look inside the file
+                if current is None or current[1] != st.st_mtime or (
+                        current[0] != st.st_size and current[0] != logical_size(path, st)):
+                    size = self._upsert(conn, path, st)
+                    updates[name] = (_row_to_info((name, size, st.st_mtime, _file_type(name))), st.st_mtime)
+            if updates:
+                self._changed(conn)
+            self._set_synced_mtime(conn, dir_mtime)
+        self._publish(updates)
+        LISTING_SCAN_SECONDS.observe(time.perf_counter() - started, backend='sqlite')
+        LISTING_SCAN_FILES.set(len(on_disk), backend='sqlite')
+
+    def sync(self):
+        """Reconcile if the directory changed since any worker last synced it."""
+        if self.watched and self._synced_mtime is not None:
+            return
+        current = self._directory_mtime()
+        if current is not None and current == self._synced_mtime:
+            return
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+        if current is None or row is None or row[0] != current:
+            self.rebuild()
+        else:
+            self._synced_mtime = current
+
+    def add(self, file_path, content_hash=None):
+        """Record an uploaded file and return its metadata."""
+        file_path = Path(file_path) if is_local(file_path) else file_path
+        try:
+            st = file_path.stat()
+        except OSError:
+            return None
+        conn = self._connect()
+        with conn:
+            size = self._upsert(conn, file_path, st, content_hash, time.time())
+            self._changed(conn)
+            self._set_synced_mtime(conn, self._directory_mtime())
+        info = _row_to_info((file_path.name, size, st.st_mtime, _file_type(file_path.name)))
+        self._publish({info['name']: (info, st.st_mtime)})
+        return info
+
+    def remove(self, name):
+        """Drop a file and return its last known metadata."""
+        conn = self._connect()
+        with conn:
+            row = conn.execute('SELECT name, size, mtime, type FROM files WHERE name = ?', (name,)).fetchone()
+            conn.execute('DELETE FROM files WHERE name = ?', (name,))
+            if row:
+                self._changed(conn)
+            self._set_synced_mtime(conn, self._directory_mtime())
+        if row is None:
+            return None
+        self._publish({name: None})
+        return _row_to_info(row)
+
+    def remove_many(self, names):
+        """Drop many files in one transaction; returns how many were catalogued."""
+        names = list(names)
+        conn = self._connect()
+        with conn:
+            removed = conn.executemany('DELETE FROM files WHERE name = ?', ((name,) for name in names)).rowcount
+            if removed:
+                self._changed(conn)
+            self._set_synced_mtime(conn, self._directory_mtime())
+        if removed:
+            # The feed skips names it never saw, so uncatalogued ones cost nothing
+            self._publish(dict.fromkeys(names))
+        return removed
+
+    def refresh(self, name):
+        """Re-read one file from disk, recording or dropping it as needed."""
+        if name.startswith('.'):
+            return None
+        path = self.storage.locate(name)
+        try:
+            st = path.stat() if path else None
+        except OSError:
+            st = None
+        conn = self._connect()
+        if st is None or not stat.S_ISREG(st.st_mode):
+            with conn:
+                gone = conn.execute('DELETE FROM files WHERE name = ?', (name,)).rowcount
+                if gone:
+                    self._changed(conn)
+            if gone:
+                self._publish({name: None})
+            return None
+        with conn:
+            size = self._upsert(conn, path, st)
+            self._changed(conn)
+        info = _row_to_info((name, size, st.st_mtime, _file_type(name)))
+        self._publish({name: (info, st.st_mtime)})
+        return info
+
+    def snapshot(self):
+        """Return {name: (size, mtime)} for every catalogued file."""
+        return {name: (size, mtime) for name, size, mtime in
+                self._connect().execute('SELECT name, size, mtime FROM files')}
+
+    def get(self, name):
+        """Return the catalogued metadata of a file, or None."""
+        self.sync()
+        row = self._connect().execute(
+            'SELECT name, size, mtime, type FROM files WHERE name = ?', (name,)).fetchone()
+        return _row_to_info(row) if row else None
+
+    def content_hash(self, name):
+        """Return the recorded SHA-256 of a file, if known."""
+        row = self._connect().execute('SELECT content_hash FROM files WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def version(self):
+        """Opaque token that changes whenever the catalogued files do; shared by all workers."""
+        self.sync()
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _order_by(sort_by, sort_order):
+        direction = ' DESC' if sort_order == 'desc' else ''
+        return ', '.join(column + direction for column in SORT_COLUMNS[sort_by])
+
+    @staticmethod
+    def _search_clause(search):
+        """SQL condition and parameter for a substring filter on names."""
+        if len(search) < GRAM:
+            # Too short for trigrams
+            return 'instr(name_lower, ?) > 0', search
+        phrase = '"' + search.replace('"', '""') + '"'
+        return 'rowid IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)', phrase
+
+    @classmethod
+    def _where(cls, search='', filters=None):
+        """WHERE conditions and parameters for a search and a ListingFilter."""
+        clauses, params = [], []
+        if search:
+            clause, param = cls._search_clause(search)
+            clauses.append(clause)
+            params.append(param)
+        if filters:
+            for clause, value in (('mtime >= ?', filters.modified_after), ('mtime < ?', filters.modified_before),
+                                  ('size >= ?', filters.min_size), ('size <= ?', filters.max_size)):
+                if value is not None:
+                    clauses.append(clause)
+                    params.append(value)
+            if filters.types:
+                clauses.append(f"type IN ({', '.join('?' * len(filters.types))})")
+                params.extend(sorted(filters.types))
+        return clauses, params
+
+    def _count(self, conn, search='', filters=None):
+        clauses, params = self._where(search, filters)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        return conn.execute(f'SELECT COUNT(*) FROM files {where}', params).fetchone()[0]
+
+    def page(self, sort_by='name', sort_order='asc', offset=0, limit=10, search='', filters=None):
+        """Return (total, files) for one page of the listing."""
+        self.sync()
+        conn = self._connect()
+        clauses, params = self._where(search, filters)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = conn.execute(
+            f'SELECT name, size, mtime, type FROM files {where} '
+            f'ORDER BY {self._order_by(sort_by, sort_order)} LIMIT ? OFFSET ?',
+            params + [limit, offset]).fetchall()
+        return self._count(conn, search, filters), [_row_to_info(row) for row in rows]
+
+    def page_after(self, sort_by='name', sort_order='asc', after=None, limit=10, search='', filters=None):
+        """Return (total, files, next_key) for the page that follows a sort key."""
+        self.sync()
+        conn = self._connect()
+        columns = SORT_COLUMNS[sort_by]
+        clauses, params = self._where(search, filters)
+        if after is not None:
+            op = '<' if sort_order == 'desc' else '>'
+            clauses.append(f"({', '.join(columns)}) {op} ({', '.join('?' * len(columns))})")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = conn.execute(
+            f"SELECT name, size, mtime, type, {', '.join(columns)} FROM files {where} "
+            f'ORDER BY {self._order_by(sort_by, sort_order)} LIMIT ?',
+            params + [limit + 1]).fetchall()
+        next_key = tuple(rows[limit - 1][4:]) if len(rows) > limit else None
+        return self._count(conn, search, filters), [_row_to_info(row[:4]) for row in rows[:limit]], next_key
+
+    def facets(self, search='', filters=None):
+        """Count matching files per type and per month without returning rows."""
+        self.sync()
+        conn = self._connect()
+        clauses, params = self._where(search, filters)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        types = conn.execute(
+            f'SELECT type, COUNT(*) AS n FROM files {where} GROUP BY type ORDER BY n DESC, type', params).fetchall()
+        months = conn.execute(
+            f"SELECT strftime('%Y-%m', mtime, 'unixepoch', 'localtime') AS month, COUNT(*) FROM files {where} "
+            'GROUP BY month ORDER BY month', params).fetchall()
+        return {'total_files': sum(n for _, n in types), 'types': dict(types), 'months': dict(months)}
+
+    def search(self, query, limit=20, fuzzy=True):
+        """Ranked filename search; returns (total matches, files with score and match kind)."""
+        self.sync()
+        conn = self._connect()
+        query = query.lower()
+        prefix = [name for (name,) in conn.execute(
+            'SELECT name FROM files WHERE name_lower >= ? AND name_lower < ? ORDER BY name_lower LIMIT ?',
+            (query, query + '\U0010ffff', SCORE_LIMIT if len(query) < GRAM else limit))]
+        if len(query) < GRAM:
+            # Only a bounded sample is ranked, but the total counts every match
+            total = conn.execute('SELECT COUNT(*) FROM files WHERE name_lower >= ? AND name_lower < ?',
+                                 (query, query + '\U0010ffff')).fetchone()[0]
+            candidates = prefix
+            fuzzy = False
+        else:
+            clause, param = self._search_clause(query)
+            total = self._count(conn, query)
+            candidates = set(prefix)
+            candidates.update(name for (name,) in conn.execute(
+                f'SELECT name FROM files WHERE {clause} LIMIT ?', (param, SCORE_LIMIT)))
+            if fuzzy and total < limit:
+                # Any shared trigram makes a candidate; bm25 puts the closest first
+                grams = ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in trigrams(query))
+                candidates.update(name for (name,) in conn.execute(
+                    'SELECT name FROM files_fts WHERE files_fts MATCH ? ORDER BY rank LIMIT ?',
+                    (grams, FUZZY_CANDIDATES)))
+
+        ranked = rank_names(query, candidates, limit, fuzzy)
+        rows = {row[0]: row for row in conn.execute(
+            f"SELECT name, size, mtime, type FROM files WHERE name IN ({', '.join('?' * len(ranked))})",
+            [hit['name'] for hit in ranked])}
+        return total, [dict(_row_to_info(rows[hit['name']]), score=hit['score'], match=hit['match'])
+                       for hit in ranked if hit['name'] in rows]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def _reset_connections():
+    # SQLite connections must not be shared across fork(); children open their own
+    for catalog in _catalogs.values():
+        catalog._local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_connections)
+
+
+def get_catalog(directory, db_path=None):
+    """Return the process-wide catalog for a directory, reconciling it on first use."""
+    key = os.path.realpath(directory)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = FileCatalog(key, db_path)
+    catalog.sync()
+    return catalog
@@ -0,0 +1,378 @@
+"""
+Change feed: file created, modified and deleted events with sequence numbers.
+
+The listing index (or catalog) reports every change it sees, whether from
+an API call, the watcher or a rescan, to a ChangeFeed. The feed appends
+each change to a SQLite log shared by every worker. It also keeps the
+last known size and mtime of each file, so the same change seen by
+several workers' watchers becomes one event. Sequence numbers therefore
+increase across all workers, and a client can resume from the last one
+it saw. Once that has been pruned from the log, the client gets a reset
+and refetches its listing instead.
+
+Waiting subscribers are served two ways. In WSGI mode, each one waits on
+a condition woken by this process's changes and by polling for other
+workers'. In ASGI mode, one poller task per process fans new events out
+to every subscriber on the event loop, so idle subscribers hold no
+thread.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CHANGES_FILENAME = '.changes.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    file TEXT,
+    at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# Most events returned by one read of the log
+PAGE_SIZE = 1000
+# Seconds between comments that keep idle event streams open through proxies
+HEARTBEAT_INTERVAL = 15.0
+# Milliseconds an EventSource waits before reconnecting
+RETRY_MS = 2000
+
+
+class ChangeFeedError(Exception):
+    """A change feed request that can't be served, with an error code and HTTP status."""
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def _row_to_event(row):
+    seq, kind, name, file, at = row
+    return {
+        'seq': seq,
+        'type': kind,
+        'name': name,
+        'file': json.loads(file) if file else None,
+        'time': datetime.fromtimestamp(at).isoformat()
+    }
+
+
+def format_sse(event):
+    """One event in the text/event-stream format."""
+    return (f"id: {event['seq']}\nevent: {event['type']}\n"
+            f"data: {json.dumps(event, separators=(',', ':'))}\n\n").encode()
+
+
+def format_sse_notice(kind, seq):
+    """A 'ready' or 'reset' event, which moves an EventSource's position to seq."""
+    return f'id: {seq}\nevent: {kind}\ndata: {{"seq":{seq}}}\n\n'.encode()
+
+
+def sse_preamble(seq):
+    """What an event stream starts with: the reconnect delay, and the position it starts from."""
+    return f'retry: {RETRY_MS}\n\n'.encode() + format_sse_notice('ready', seq)
+
+
+def long_poll_body(seq, events, reset):
+    """JSON body of a long poll: the events and the sequence number to ask for next."""
+    if events:
+        seq = events[-1]['seq']
+    elif reset is not None:
+        seq = reset
+    return {'events': events, 'last_seq': seq, 'reset': reset is not None}
+
+
+def parse_seq(value):
+    """A client's last sequence number, or None when absent or malformed."""
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+
+class ChangeFeed:
+    """An append-only log of file changes in SQLite, shared by every worker."""
+
+    def __init__(self, db_path, retention=10000):
+        self.db_path = str(db_path)
+        self.retention = retention
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        # Called after this process logs events, e.g. to wake an event loop
+        self.listeners = []
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def record(self, updates, full=False):
+        """Log what changed in updates, {name: (info, mtime) or None if gone}; returns the new events.
+
+        With full=True, updates holds every file, and files missing from it
+        are deleted. The first full record into an empty log only takes
+        note of the files, without an event for each.
+        """
+        conn = self._connect()
+        now = time.time()
+        events = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seeded = conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
+            if full:
+                known = {name: (size, mtime) for name, size, mtime in
+                         conn.execute('SELECT name, size, mtime FROM files')}
+                updates = dict(updates)
+                for name in known:
+                    updates.setdefault(name, None)
+            else:
+                known = {}
+                for name in updates:
+                    row = conn.execute('SELECT size, mtime FROM files WHERE name = ?', (name,)).fetchone()
+                    if row:
+                        known[name] = row
+            quiet = full and not seeded
+
+            for name, update in updates.items():
+                before = known.get(name)
+                if update is None:
+                    if before is None:
+                        continue
+                    conn.execute('DELETE FROM files WHERE name = ?', (name,))
+                    kind, info = 'deleted', None
+                else:
+                    info, mtime = update
+                    if before is not None and tuple(before) == (info['size'], mtime):
+                        continue
+                    conn.execute('INSERT OR REPLACE INTO files (name, size, mtime) VALUES (?, ?, ?)',
+                                 (name, info['size'], mtime))
+                    kind = 'modified' if before is not None else 'created'
+                if quiet:
+                    continue
+                file = json.dumps(info) if info is not None else None
+                seq = conn.execute('INSERT INTO changes (type, name, file, at) VALUES (?, ?, ?, ?)',
+                                   (kind, name, file, now)).lastrowid
+                events.append(_row_to_event((seq, kind, name, file, now)))
+
+            if full:
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('seeded', 1)")
+            if events:
+                conn.execute('DELETE FROM changes WHERE seq <= ?', (events[-1]['seq'] - self.retention,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        if events:
+            with self._condition:
+                self._condition.notify_all()
+            for listener in list(self.listeners):
+                listener()
+        return events
+
+    def latest(self):
+        """Sequence number of the newest event ever logged (0 if none)."""
+        row = self._connect().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def since(self, seq, limit=PAGE_SIZE):
+        """Events after seq, as (events, reset).
+
+        reset is None, unless the events right after seq are no longer in
+        the log or seq is from the future (say, a recreated database). Then
+        it is the latest sequence number: the client should refetch its
+        listing and resume from there.
+        """
+        conn = self._connect()
+        rows = conn.execute('SELECT seq, type, name, file, at FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                            (seq, limit)).fetchall()
+        if rows and rows[0][0] > seq + 1:
+            # Sequence numbers have no gaps, so the ones in between were pruned
+            return [], self.latest()
+        if rows:
+            return [_row_to_event(row) for row in rows], None
+        latest = self.latest()
+        return [], latest if seq > latest else None
+
+    def wait(self, seq, timeout, poll_interval=0.5):
+        """Like since(), but wait up to timeout seconds for an event."""
+        deadline = time.monotonic() + timeout
+        while True:
+            events, reset = self.since(seq)
+            remaining = deadline - time.monotonic()
+            if events or reset is not None or remaining <= 0:
+                return events, reset
+            # Woken at once by this process's changes, by polling for other workers'
+            with self._condition:
+                self._condition.wait(min(poll_interval, remaining))
+
+    def stream(self, seq, duration, poll_interval=0.5):
+        """Yield an event stream from seq (None for now) for duration seconds.
+
+        The stream ends so that a thread-per-request server gets its thread
+        back; the EventSource reconnects with the last id it saw.
+        """
+        if seq is None:
+            seq = self.latest()
+        yield sse_preamble(seq)
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            events, reset = self.wait(seq, min(remaining, HEARTBEAT_INTERVAL), poll_interval)
+            if reset is not None:
+                seq = reset
+                yield format_sse_notice('reset', seq)
+            elif events:
+                seq = events[-1]['seq']
+                yield b''.join(format_sse(event) for event in events)
+            else:
+                yield b': keepalive\n\n'
+
+
+class ChangeHub:
+    """Fans one feed's events out to any number of asyncio subscribers.
+
+    A single poller task per event loop reads new events from the log,
+    and only while someone is subscribed. Subscribers wait on an
+    asyncio.Event and are served from a buffer of recent events, so an
+    idle subscriber costs no thread and no query.
+    """
+
+    def __init__(self, feed, run, poll_interval=0.5, buffer_size=PAGE_SIZE):
+        self.feed = feed
+        # Runs a blocking call off the event loop: run(func, *args) -> awaitable
+        self._run = run
+        self.poll_interval = poll_interval
+        self._recent = deque(maxlen=buffer_size)
+        self._last = None
+        self._subscribers = 0
+        self._task = None
+        self._kick = None
+        self._wakeup = None
+
+    async def _start(self):
+        if self._last is None:
+            self._last = await self._run(self.feed.latest)
+        if self._task is None:
+            self._kick = asyncio.Event()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._poll())
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+
+        def notify():
+            loop.call_soon_threadsafe(self._kick.set)
+
+        self.feed.listeners.append(notify)
+        try:
+            while self._subscribers:
+                try:
+                    await asyncio.wait_for(self._kick.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._kick.clear()
+                try:
+                    events, reset = await self._run(self.feed.since, self._last)
+                except sqlite3.Error:
+                    logger.warning('Could not read the change feed', exc_info=True)
+                    continue
+                if reset is not None:
+                    self._recent.clear()
+                    self._last = reset
+                elif events:
+                    self._recent.extend(events)
+                    self._last = events[-1]['seq']
+                    if len(events) >= PAGE_SIZE:
+                        # More are waiting; fetch them without sleeping
+                        self._kick.set()
+                else:
+                    continue
+                wakeup, self._wakeup = self._wakeup, asyncio.Event()
+                wakeup.set()
+        finally:
+            self.feed.listeners.remove(notify)
+            self._task = None
+
+    async def wait(self, seq, timeout):
+        """Events after seq, waiting up to timeout seconds for one; returns (events, reset)."""
+        self._subscribers += 1
+        try:
+            await self._start()
+            deadline = time.monotonic() + timeout
+            while True:
+                # Taken before looking, so a batch that lands meanwhile still wakes us
+                wakeup = self._wakeup
+                if seq != self._last:
+                    recent = self._recent
+                    if recent and recent[0]['seq'] <= seq + 1 and seq < self._last:
+                        return [event for event in recent if event['seq'] > seq], None
+                    events, reset = await self._run(self.feed.since, seq)
+                    if events or reset is not None:
+                        return events, reset
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], None
+                try:
+                    await asyncio.wait_for(wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return [], None
+        finally:
+            self._subscribers -= 1
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def _reset_connections():
+    # SQLite connections must not be shared across fork(); children open their own
+    for feed in _feeds.values():
+        feed._local = threading.local()
+        feed.listeners = []
+
+
+os.register_at_fork(after_in_child=_reset_connections)
+
+
+def get_change_feed(db_path, retention=10000):
+    """Return the process-wide change feed stored at db_path."""
+    key = os.path.realpath(db_path)
+    with _feeds_lock:
+        feed = _feeds.get(key)
+        if feed is None:
+            Path(key).parent.mkdir(parents=True, exist_ok=True)
+            feed = _feeds[key] = ChangeFeed(key, retention)
+        return feed
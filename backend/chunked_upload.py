@@ -0,0 +1,275 @@
+"""
+Resumable chunked uploads.
+
+A session is a hidden directory under FILES_DIRECTORY holding a small JSON
+manifest and one file per received chunk. Chunks can arrive in any order
+and in parallel; finalizing assembles them into the target file.
+"""
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from streaming_upload import UploadError, place_file, validate_upload_name, write_temp
+from utils import format_file_size
+
+SESSIONS_DIRNAME = '.uploads'
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+GC_INTERVAL = 300
+
+_SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_CHECKSUM_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+_last_gc = {}
+_gc_lock = threading.Lock()
+
+
+def sessions_root(files_dir):
+    """Directory holding all in-progress upload sessions."""
+    return Path(files_dir) / SESSIONS_DIRNAME
+
+
+def _session_dir(files_dir, upload_id, ttl=None):
+    """A session's directory; with ttl, a session idle for longer is removed and refused."""
+    if not _SESSION_ID_RE.match(upload_id or ''):
+        raise UploadError('UPLOAD_NOT_FOUND', 'Upload session not found', 404)
+    session_dir = sessions_root(files_dir) / upload_id
+    if not session_dir.is_dir():
+        raise UploadError('UPLOAD_NOT_FOUND', 'Upload session not found', 404)
+    if ttl is not None:
+        try:
+            updated_at = (session_dir / 'manifest.json').stat().st_mtime
+        except OSError:
+            raise UploadError('UPLOAD_NOT_FOUND', 'Upload session not found', 404)
+        # Enforced here, since collect_expired only runs now and then
+        if time.time() - updated_at > ttl:
+            shutil.rmtree(session_dir, ignore_errors=True)
+            raise UploadError('UPLOAD_NOT_FOUND', 'Upload session has expired', 410)
+    return session_dir
+
+
+def _read_manifest(session_dir):
+    try:
+        return json.loads((session_dir / 'manifest.json').read_text())
+    except (OSError, ValueError):
+        raise UploadError('UPLOAD_NOT_FOUND', 'Upload session not found', 404)
+
+
+def _touch(session_dir):
+    os.utime(session_dir / 'manifest.json')
+
+
+def _chunk_path(session_dir, index):
+    return session_dir / f'{index:06d}.chunk'
+
+
+def _received(session_dir, manifest):
+    return [i for i in range(manifest['total_chunks']) if _chunk_path(session_dir, i).exists()]
+
+
+def _as_ranges(indexes):
+    """Collapse sorted chunk indexes into [first, last] ranges."""
+    ranges = []
+    for i in indexes:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def _expected_length(manifest, index):
+    if index == manifest['total_chunks'] - 1:
+        return manifest['size'] - index * manifest['chunk_size']
+    return manifest['chunk_size']
+
+
+def parse_checksum(checksum):
+    """Normalise an optional SHA-256 hex digest, so a bad one fails before any data is sent."""
+    if checksum is None or checksum == '':
+        return None
+    if not isinstance(checksum, str) or not _CHECKSUM_RE.match(checksum):
+        raise UploadError('INVALID_CHECKSUM', 'Checksum must be a SHA-256 hex digest')
+    return checksum.lower()
+
+
+def create_session(files_dir, filename, size, max_size, chunk_size, checksum=None):
+    """Start an upload session and return its manifest."""
+    checksum = parse_checksum(checksum)
+    validate_upload_name(filename, Path(files_dir))
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise UploadError('INVALID_UPLOAD', 'Upload size must be a non-negative integer')
+    if size > max_size:
+        raise UploadError('FILE_TOO_LARGE', f'File size exceeds maximum allowed size of {format_file_size(max_size)}')
+    if not isinstance(chunk_size, int) or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise UploadError('INVALID_UPLOAD', 'Invalid chunk size')
+
+    upload_id = secrets.token_hex(16)
+    session_dir = sessions_root(files_dir) / upload_id
+    session_dir.mkdir(parents=True)
+    manifest = {
+        'upload_id': upload_id,
+        'filename': filename,
+        'size': size,
+        'chunk_size': chunk_size,
+        'total_chunks': max(1, -(-size // chunk_size)),
+        'checksum': checksum,
+        'created_at': time.time(),
+    }
+    (session_dir / 'manifest.json').write_text(json.dumps(manifest))
+    return manifest
+
+
+def session_status(files_dir, upload_id, ttl):
+    """Describe which chunks of a session have been received."""
+    session_dir = _session_dir(files_dir, upload_id, ttl)
+    manifest = _read_manifest(session_dir)
+    received = _received(session_dir, manifest)
+    received_bytes = sum(_expected_length(manifest, i) for i in received)
+    updated_at = (session_dir / 'manifest.json').stat().st_mtime
+    return {
+        'upload_id': upload_id,
+        'filename': manifest['filename'],
+        'size': manifest['size'],
+        'chunk_size': manifest['chunk_size'],
+        'total_chunks': manifest['total_chunks'],
+        'received': _as_ranges(received),
+        'received_bytes': received_bytes,
+        'complete': len(received) == manifest['total_chunks'],
+        'expires_at': updated_at + ttl,
+    }
+
+
+class ChunkWriter:
+    """Receives one chunk into a temp file, checking its length and SHA-256."""
+
+    def __init__(self, files_dir, upload_id, index, ttl=None, checksum=None):
+        self.checksum = parse_checksum(checksum)
+        self._session_dir = _session_dir(files_dir, upload_id, ttl)
+        manifest = _read_manifest(self._session_dir)
+        if not 0 <= index < manifest['total_chunks']:
+            raise UploadError('INVALID_CHUNK', 'Chunk index out of range')
+        self.index = index
+        self.expected = _expected_length(manifest, index)
+        self.received = 0
+        self._digest = hashlib.sha256()
+        fd, self._temp_path = tempfile.mkstemp(dir=self._session_dir, prefix='.chunk-')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.received += len(data)
+        if self.received > self.expected:
+            raise UploadError('INVALID_CHUNK', 'Chunk is larger than expected')
+        self._digest.update(data)
+        self._file.write(data)
+
+    def commit(self):
+        """Verify the chunk and move it into place; returns its summary."""
+        self._file.close()
+        if self.received != self.expected:
+            raise UploadError('INVALID_CHUNK', f'Expected {self.expected} bytes, got {self.received}')
+        if self.checksum and self._digest.hexdigest() != self.checksum:
+            raise UploadError('CHECKSUM_MISMATCH', 'Chunk checksum does not match')
+        os.replace(self._temp_path, _chunk_path(self._session_dir, self.index))
+        _touch(self._session_dir)
+        return {'index': self.index, 'size': self.received, 'checksum': self._digest.hexdigest()}
+
+    def abort(self):
+        """Discard whatever was received."""
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.unlink(self._temp_path)
+
+
+def write_chunk(files_dir, upload_id, index, stream, checksum=None, ttl=None):
+    """Store one chunk, verifying its length and optional SHA-256."""
+    writer = ChunkWriter(files_dir, upload_id, index, ttl, checksum)
+    try:
+        while True:
+            # Ask for one byte more than expected so an oversized chunk is caught
+            data = stream.read(min(64 * 1024, writer.expected + 1 - writer.received))
+            if not data:
+                break
+            writer.write(data)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def _iter_chunks(session_dir, manifest, digest):
+    for i in range(manifest['total_chunks']):
+        with open(_chunk_path(session_dir, i), 'rb') as chunk:
+            while True:
+                data = chunk.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+                yield data
+
+
+def finalize_session(files_dir, upload_id, max_size, store=None, compression=None, ttl=None):
+    """Assemble a complete session into its target file.
+
+    Returns (path, SHA-256 hex) of the finished file.
+    """
+    files_dir = Path(files_dir)
+    session_dir = _session_dir(files_dir, upload_id, ttl)
+    manifest = _read_manifest(session_dir)
+    missing = manifest['total_chunks'] - len(_received(session_dir, manifest))
+    if missing:
+        raise UploadError('UPLOAD_INCOMPLETE', f'{missing} chunk(s) still missing', 409)
+
+    # Same checks as a single-shot upload, as the name may have been taken since
+    file_path = validate_upload_name(manifest['filename'], files_dir)
+    digest = hashlib.sha256()
+    temp_path, size = write_temp(_iter_chunks(session_dir, manifest, digest), files_dir, max_size)
+    if size != manifest['size'] or (manifest['checksum'] and digest.hexdigest() != manifest['checksum']):
+        os.unlink(temp_path)
+        raise UploadError('CHECKSUM_MISMATCH', 'Assembled file does not match the declared size or checksum')
+    place_file(temp_path, file_path, store, digest.hexdigest(), compression)
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return file_path, digest.hexdigest()
+
+
+def abort_session(files_dir, upload_id):
+    """Discard a session and its chunks."""
+    shutil.rmtree(_session_dir(files_dir, upload_id), ignore_errors=True)
+
+
+def collect_expired(files_dir, ttl, now=None):
+    """Remove sessions idle for longer than ttl seconds; return how many."""
+    root = sessions_root(files_dir)
+    now = now or time.time()
+    removed = 0
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            updated_at = os.stat(os.path.join(entry.path, 'manifest.json')).st_mtime
+        except OSError:
+            updated_at = entry.stat().st_mtime
+        if now - updated_at > ttl:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def maybe_collect_expired(files_dir, ttl):
+    """Run collect_expired at most once every GC_INTERVAL seconds per directory."""
+    key = str(files_dir)
+    now = time.time()
+    with _gc_lock:
+        if now - _last_gc.get(key, 0) < GC_INTERVAL:
+            return 0
+        _last_gc[key] = now
+    return collect_expired(files_dir, ttl, now)
@@ -0,0 +1,251 @@
+"""
+Transparent compression at rest for compressible uploads.
+
+Text-like files are stored as a standard gzip or zstd stream under their
+own name, so they can be sent as-is with Content-Encoding or decoded
+while streaming. The logical size lives in the stream header: the gzip
+header carries an 'FM' extra field with the 64-bit size, and zstd frames
+record it as their content size. Listings report that size, so the API
+doesn't change. zstd needs the optional zstandard package and falls
+back to gzip without it.
+"""
+
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from storage import is_local
+
+CODECS = ('gzip', 'zstd')
+
+COMPRESSIBLE_TYPES = frozenset({
+    '.cfg', '.conf', '.css', '.csv', '.htm', '.html', '.ini', '.js', '.json', '.jsonl', '.log', '.md',
+    '.ndjson', '.py', '.rst', '.sql', '.svg', '.tex', '.toml', '.tsv', '.txt', '.xml', '.yaml', '.yml',
+})
+
+CHUNK_SIZE = 256 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Smaller files, or ones that shrink by less than this, are kept raw
+MIN_SIZE = 1024
+MIN_SAVING = 0.1
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+GZIP_FEXTRA = 0x04
+GZIP_SUBFIELD = b'FM'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Enough for the longest header either format can start with
+HEADER_PEEK = 24
+
+_sizes = {}
+_sizes_lock = threading.Lock()
+MAX_REMEMBERED = 65536
+
+
+def is_compressible(name):
+    """Whether a filename's type is worth compressing at rest."""
+    return os.path.splitext(name)[1].lower() in COMPRESSIBLE_TYPES
+
+
+def resolve_codec(name):
+    """The codec that will actually be used for a STORAGE_COMPRESSION value, or None."""
+    if not name or name == 'off':
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown storage compression '{name}'")
+    if name == 'zstd' and zstandard is None:
+        return 'gzip'
+    return name
+
+
+def _gzip_header(size):
+    extra = GZIP_SUBFIELD + struct.pack('<HQ', 8, size)
+    # No name or mtime, so equal content compresses to equal bytes
+    return GZIP_MAGIC + bytes([GZIP_FEXTRA]) + b'\0\0\0\0' + b'\0\xff' + struct.pack('<H', len(extra)) + extra
+
+
+def _write_gzip(src, dst, size):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    dst.write(_gzip_header(size))
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        dst.write(compressor.compress(data))
+    dst.write(compressor.flush())
+    dst.write(struct.pack('<II', crc, size & 0xffffffff))
+
+
+def _write_zstd(src, dst, size):
+    zstandard.ZstdCompressor(level=ZSTD_LEVEL, write_content_size=True).copy_stream(src, dst, size=size)
+
+
+def compress_file(temp_path, codec):
+    """Compress a finished temp file next to itself.
+
+    Returns the path to move into place: the compressed temp file, or
+    temp_path unchanged when compression isn't worth it. Whichever file
+    isn't returned is removed.
+    """
+    codec = resolve_codec(codec)
+    size = os.path.getsize(temp_path)
+    if codec is None or size < MIN_SIZE:
+        return temp_path
+    fd, compressed_path = tempfile.mkstemp(dir=os.path.dirname(temp_path), prefix='.upload-', suffix='.part')
+    try:
+        with open(temp_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            if codec == 'zstd':
+                _write_zstd(src, dst, size)
+            else:
+                _write_gzip(src, dst, size)
+    except BaseException:
+        os.unlink(compressed_path)
+        raise
+    if os.path.getsize(compressed_path) > size * (1 - MIN_SAVING):
+        os.unlink(compressed_path)
+        return temp_path
+    os.unlink(temp_path)
+    return compressed_path
+
+
+def _zstd_content_size(head):
+    """Frame content size from a zstd frame header, or None if it isn't recorded."""
+    if len(head) < 5:
+        return None
+    descriptor = head[4]
+    size_flag = descriptor >> 6
+    single_segment = descriptor >> 5 & 1
+    offset = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3]
+    width = (1 if single_segment else 0, 2, 4, 8)[size_flag]
+    if not width or len(head) < offset + width:
+        return None
+    value = int.from_bytes(head[offset:offset + width], 'little')
+    return value + 256 if width == 2 else value
+
+
+def _parse_header(head):
+    if head[:3] == GZIP_MAGIC and len(head) >= 24 and head[3] & GZIP_FEXTRA and head[12:14] == GZIP_SUBFIELD:
+        length, size = struct.unpack('<HQ', head[14:24])
+        if length == 8:
+            return 'gzip', size
+    if head[:4] == ZSTD_MAGIC:
+        size = _zstd_content_size(head)
+        if size is not None:
+            return 'zstd', size
+    return None
+
+
+def stored_encoding(path, st=None):
+    """Return (encoding, logical size) for a file stored compressed, else None."""
+    # Only local files are ever stored compressed
+    if not is_local(path) or not is_compressible(os.path.basename(path)):
+        return None
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    try:
+        return _sizes[key]
+    except KeyError:
+        pass
+    try:
+        with open(path, 'rb') as f:
+            result = _parse_header(f.read(HEADER_PEEK))
+    except OSError:
+        return None
+    with _sizes_lock:
+        if len(_sizes) >= MAX_REMEMBERED:
+            _sizes.clear()
+        _sizes[key] = result
+    return result
+
+
+def logical_size(path, st):
+    """Size of a file's content as uploaded, whether or not it is stored compressed."""
+    stored = stored_encoding(path, st)
+    return stored[1] if stored else st.st_size
+
+
+class _GzipReader:
+    """Decode a gzip file while reading, CHUNK_SIZE of output at a time."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._pending = b''
+
+    def read(self, size=CHUNK_SIZE):
+        while True:
+            if self._decompressor.unconsumed_tail:
+                data = self._decompressor.unconsumed_tail
+            elif self._decompressor.eof:
+                return b''
+            else:
+                data = self._raw.read(CHUNK_SIZE)
+                if not data:
+                    return b''
+            # Bound the output so a single call never inflates a whole file
+            out = self._decompressor.decompress(data, size)
+            if out:
+                return out
+
+    def close(self):
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_stored(path):
+    """Open a file for reading its logical content; returns (file object, logical size).
+
+    Compressed files are decoded on the fly; read() may return fewer bytes
+    than asked for, and only b'' means the end.
+    """
+    if not is_local(path):
+        raw = path.open('rb')
+        return raw, raw.size
+    raw = open(path, 'rb')
+    try:
+        st = os.fstat(raw.fileno())
+        stored = stored_encoding(path, st)
+        if stored is None:
+            return raw, st.st_size
+        encoding, size = stored
+        if encoding == 'gzip':
+            return _GzipReader(raw), size
+        if zstandard is None:
+            raise RuntimeError('Decoding zstd files needs the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_size=CHUNK_SIZE), size
+    except BaseException:
+        raw.close()
+        raise
+
+
+def read_logical_range(path, start, stop):
+    """Yield the bytes in [start, stop) of a file's logical content."""
+    f, _ = open_stored(path)
+    with f:
+        position = 0
+        while position < stop:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            end = position + len(data)
+            if end > start:
+                yield data[max(start - position, 0):stop - position]
+            position = end
@@ -2,6 +2,14 @@ import os
 from datetime import datetime
 from pathlib import Path
 
+from catalog import get_catalog
+from changes import CHANGES_FILENAME, get_change_feed
+from file_index import get_index
+from file_watcher import start_watcher
+from jobs import JOBS_FILENAME, get_job_queue, start_job_workers
+from storage import get_storage, s3_options
+from tasks import JOB_HANDLERS
+
 class Config:
     """Application configuration settings."""
     
@@ -13,6 +21,109 @@ class Config:
     FILES_DIRECTORY = os.environ.get('FILES_DIRECTORY') or './files'
     MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 104857600))  # 100MB default
     
+    # Stream uploads straight to disk instead of letting Werkzeug spool them
+    STREAMING_UPLOADS = os.environ.get('STREAMING_UPLOADS', 'True').lower() == 'true'
+    
+    # Store each distinct content once and hard-link filenames to it
+    CONTENT_ADDRESSED_STORAGE = os.environ.get('CONTENT_ADDRESSED_STORAGE', 'False').lower() == 'true'
+    
+    # Where files live: flat in FILES_DIRECTORY, or sharded into .shards/<hash prefix>/ (see migrate_layout.py)
+    STORAGE_LAYOUT = os.environ.get('STORAGE_LAYOUT', 'flat')
+    
+    # Where files are stored: local (FILES_DIRECTORY) or s3 (any S3-compatible service, shared by every server)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://s3.amazonaws.com')
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX', '')  # key prefix for the files, e.g. files/
+    S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+    S3_ACCESS_KEY_ID = os.environ.get('S3_ACCESS_KEY_ID')  # unset = unsigned requests
+    S3_SECRET_ACCESS_KEY = os.environ.get('S3_SECRET_ACCESS_KEY')
+    S3_MAX_CONNECTIONS = int(os.environ.get('S3_MAX_CONNECTIONS', 64))  # pooled keep-alive connections per worker
+    S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 16777216))  # 16MB: larger uploads go in parts
+    S3_MULTIPART_CHUNK_SIZE = int(os.environ.get('S3_MULTIPART_CHUNK_SIZE', 8388608))  # 8MB parts
+    S3_MULTIPART_CONCURRENCY = int(os.environ.get('S3_MULTIPART_CONCURRENCY', 4))  # parts in flight per upload
+    
+    # Most files accepted by one POST /api/files/batch request
+    BATCH_UPLOAD_MAX_FILES = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', 1000))
+    
+    # Most files streamed by one /api/files/archive download
+    ARCHIVE_MAX_FILES = int(os.environ.get('ARCHIVE_MAX_FILES', 10000))
+    
+    # Compress text-like uploads at rest: off, gzip or zstd (needs the zstandard package)
+    STORAGE_COMPRESSION = os.environ.get('STORAGE_COMPRESSION', 'off')
+    
+    # Most files removed by one POST /api/files/bulk-delete request
+    BULK_DELETE_MAX_FILES = int(os.environ.get('BULK_DELETE_MAX_FILES', 10000))
+    
+    # Thumbnails at /api/files/<name>/thumbnail: images need Pillow, PDFs PyMuPDF
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))  # render processes per server worker
+    PREVIEW_QUEUE_SIZE = int(os.environ.get('PREVIEW_QUEUE_SIZE', 64))  # renders in flight before 503s
+    PREVIEW_TIMEOUT = float(os.environ.get('PREVIEW_TIMEOUT', 30))  # seconds a request waits for a render
+    PREVIEW_CACHE_SIZE = int(os.environ.get('PREVIEW_CACHE_SIZE', 268435456))  # 256MB default
+    PREVIEW_CACHE_MAX_AGE = int(os.environ.get('PREVIEW_CACHE_MAX_AGE', 31536000))  # for versioned (?v=) URLs
+    PREVIEW_ON_UPLOAD = os.environ.get('PREVIEW_ON_UPLOAD', 'True').lower() == 'true'  # as a background job
+    
+    # Background jobs after uploads, kept in SQLite so they survive restarts
+    JOBS_PATH = os.environ.get('JOBS_PATH')  # defaults to FILES_DIRECTORY/.jobs.sqlite3
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # job threads per server worker, 0 = don't run jobs here
+    JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+    JOBS_RETRY_DELAY = float(os.environ.get('JOBS_RETRY_DELAY', 2))  # seconds before the first retry, doubling after
+    JOBS_LEASE = float(os.environ.get('JOBS_LEASE', 60))  # seconds before a silent worker's job is retried
+    JOBS_RETENTION = float(os.environ.get('JOBS_RETENTION', 604800))  # seconds finished jobs stay visible
+    
+    # Resumable chunked uploads
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8388608))  # 8MB default
+    UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 86400))  # idle seconds before GC
+    
+    # Cache-Control for downloads; no-cache still allows cheap 304 revalidation
+    DOWNLOAD_CACHE_CONTROL = os.environ.get('DOWNLOAD_CACHE_CONTROL', 'private, no-cache')
+    
+    # How download bytes are moved: stream, sendfile, x-accel-redirect or x-sendfile
+    DOWNLOAD_BACKEND = os.environ.get('DOWNLOAD_BACKEND', 'sendfile')
+    # nginx internal location aliased to FILES_DIRECTORY (x-accel-redirect only)
+    DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-files')
+    
+    # Compress JSON responses (zstd, br or gzip, as the client accepts) from this size up
+    RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'True').lower() == 'true'
+    RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+    
+    # Listing state: in-process memory index, or a SQLite catalog shared by all workers
+    LISTING_BACKEND = os.environ.get('LISTING_BACKEND', 'memory')
+    CATALOG_PATH = os.environ.get('CATALOG_PATH')  # defaults to FILES_DIRECTORY/.catalog.sqlite3
+    
+    # Change feed at /api/changes: file events with sequence numbers, by SSE or long poll
+    CHANGE_FEED = os.environ.get('CHANGE_FEED', 'True').lower() == 'true'
+    CHANGES_PATH = os.environ.get('CHANGES_PATH')  # defaults to FILES_DIRECTORY/.changes.sqlite3
+    CHANGE_FEED_RETENTION = int(os.environ.get('CHANGE_FEED_RETENTION', 10000))  # newest events a client can resume from
+    CHANGE_FEED_POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 0.5))  # seconds between checks for other workers' events
+    CHANGE_FEED_WAIT = float(os.environ.get('CHANGE_FEED_WAIT', 25))  # longest long poll, and event stream outside ASGI
+    
+    # Prometheus metrics at /metrics, and profiling of a sample of requests (see PUT /api/profiling)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+    METRICS_DIR = os.environ.get('METRICS_DIR')  # shared by the workers; defaults to FILES_DIRECTORY/.metrics
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # fraction of requests, until changed at runtime
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 100))  # newest profiles kept
+    # /api/profiling: off by default; with no token only loopback clients may use it
+    PROFILING_CONTROL_ENABLED = os.environ.get('PROFILING_CONTROL_ENABLED', 'False').lower() == 'true'
+    PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')  # required as "Authorization: Bearer <token>" when set
+    
+    # Directory watcher: auto (inotify, else polling), inotify, poll or off
+    FILE_WATCHER = os.environ.get('FILE_WATCHER', 'auto')
+    FILE_WATCHER_DEBOUNCE = float(os.environ.get('FILE_WATCHER_DEBOUNCE', 0.2))
+    FILE_WATCHER_POLL_INTERVAL = float(os.environ.get('FILE_WATCHER_POLL_INTERVAL', 2.0))
+    
+    # Thread pool for file I/O and proxied routes in ASGI mode (asgi.py)
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 64))
+    ASGI_MAX_BODY = int(os.environ.get('ASGI_MAX_BODY', 10485760))  # 10MB: largest body spooled for other routes
+    
+    # Production launcher (server.py): pre-forked workers, each with a thread pool
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 0))  # 0 = one per CPU
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+    SERVER_RATE_LIMIT = float(os.environ.get('SERVER_RATE_LIMIT', 0))  # requests/second per worker, 0 = off
+    SERVER_RATE_BURST = int(os.environ.get('SERVER_RATE_BURST', 50))
+    SERVER_KEEPALIVE = float(os.environ.get('SERVER_KEEPALIVE', 5))  # idle seconds before closing a connection
+    SERVER_GRACEFUL_TIMEOUT = float(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+    
     # CORS settings
     CORS_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:5173').split(',')
     
@@ -32,6 +143,44 @@ class Config:
         # Ensure files directory is readable
         if not os.access(Config.FILES_DIRECTORY, os.R_OK):
             raise RuntimeError(f"Files directory '{Config.FILES_DIRECTORY}' is not readable")
+        
+        backend = app.config['STORAGE_BACKEND']
+        get_storage(Config.FILES_DIRECTORY, app.config['STORAGE_LAYOUT'], backend,
+                    s3_options(app.config) if backend == 's3' else None)
+        
+        # Build the listing index now so the first request doesn't pay for the scan
+        Config.listing_index(app)
+        Config.watch_files(app)
+        Config.run_jobs(app)
+    
+    @staticmethod
+    def listing_index(app):
+        """Get the listing index (memory or SQLite catalog) for FILES_DIRECTORY, reporting to the change feed."""
+        if app.config['LISTING_BACKEND'] == 'sqlite':
+            index = get_catalog(Config.FILES_DIRECTORY, app.config['CATALOG_PATH'])
+        else:
+            index = get_index(Config.FILES_DIRECTORY)
+        if app.config['CHANGE_FEED']:
+            changes_path = app.config['CHANGES_PATH'] or Path(Config.FILES_DIRECTORY) / CHANGES_FILENAME
+            index.attach_feed(get_change_feed(changes_path, app.config['CHANGE_FEED_RETENTION']))
+        return index
+    
+    @staticmethod
+    def watch_files(app):
+        """Keep the listing index current with files written outside the API."""
+        return start_watcher(Config.listing_index(app), app.config['FILE_WATCHER'],
+                             app.config['FILE_WATCHER_DEBOUNCE'],
+                             app.config['FILE_WATCHER_POLL_INTERVAL'])
+
+    @staticmethod
+    def run_jobs(app):
+        """Run background jobs in this process, unless JOB_WORKERS is 0."""
+        if app.config['JOB_WORKERS'] <= 0:
+            return None
+        queue = get_job_queue(app.config['JOBS_PATH'] or Path(Config.FILES_DIRECTORY) / JOBS_FILENAME,
+                              app.config['JOBS_MAX_ATTEMPTS'], app.config['JOBS_RETRY_DELAY'])
+        return start_job_workers(app, queue, JOB_HANDLERS, app.config['JOB_WORKERS'], app.config['JOBS_LEASE'],
+                                 retention=app.config['JOBS_RETENTION'])
 
 class DevelopmentConfig(Config):
     """Development environment configuration."""
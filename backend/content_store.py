@@ -0,0 +1,142 @@
+"""
+Content-addressed storage with deduplication.
+
+Each distinct content is stored once as a read-only blob under
+.blobs/<aa>/<sha256>, and every visible filename is a hard link to its
+blob. Listing, stat and download keep working on the names unchanged;
+the link count is the reference count, and a blob is removed when its
+last name goes away.
+"""
+
+import errno
+import os
+import stat
+import threading
+from pathlib import Path
+
+BLOBS_DIRNAME = '.blobs'
+
+# Hard-linked files remembered as not being blobs, so they don't force rescans
+NOT_BLOB_CACHE_SIZE = 10000
+
+
+class ContentStore:
+    """Deduplicating blob store for one files directory."""
+
+    def __init__(self, files_dir):
+        self.files_dir = Path(files_dir)
+        self.root = self.files_dir / BLOBS_DIRNAME
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._loaded = False
+        self._not_blobs = set()
+
+    def blob_path(self, digest):
+        """Where the blob for a SHA-256 hex digest lives."""
+        return self.root / digest[:2] / digest
+
+    def _load(self):
+        # name -> digest is derived from inodes, so it can't drift from disk
+        if self._loaded:
+            return
+        digests = {}
+        if self.root.is_dir():
+            for fanout in os.scandir(self.root):
+                if not fanout.is_dir():
+                    continue
+                for blob in os.scandir(fanout.path):
+                    try:
+                        digests[blob.stat().st_ino] = blob.name
+                    except OSError:
+                        continue
+        self._digests = digests
+        self._loaded = True
+
+    def digest_of(self, file_path):
+        """Digest of the blob a name points at, or None for a plain file."""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        # A reused inode number has a new ctime, and linking changes the link count
+        key = (st.st_ino, st.st_ctime_ns, st.st_nlink)
+        with self._lock:
+            self._load()
+            digest = self._digests.get(st.st_ino)
+            if digest is None and st.st_nlink > 1 and key not in self._not_blobs:
+                # Linked by another worker since we last looked, or a hard link of the user's
+                self._loaded = False
+                self._load()
+                digest = self._digests.get(st.st_ino)
+                if digest is None:
+                    if len(self._not_blobs) >= NOT_BLOB_CACHE_SIZE:
+                        self._not_blobs.clear()
+                    self._not_blobs.add(key)
+            return digest
+
+    def refcount(self, digest):
+        """How many names currently reference a blob."""
+        try:
+            return os.stat(self.blob_path(digest)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def add(self, temp_path, digest, file_path):
+        """Store a finished temp file under its digest and link a name to it.
+
+        The temp file is always consumed. Raises FileExistsError if the name
+        is taken.
+        """
+        blob = self.blob_path(digest)
+        try:
+            with self._lock:
+                self._load()
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(blob, file_path)
+                except FileNotFoundError:
+                    if blob.exists():
+                        raise
+                    # First copy of this content: the temp file becomes the blob.
+                    # Read-only, since an in-place write would change every alias.
+                    os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    try:
+                        os.link(temp_path, blob)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                    os.link(blob, file_path)
+                self._digests[os.stat(blob).st_ino] = digest
+        finally:
+            os.unlink(temp_path)
+        return Path(file_path)
+
+    def remove(self, file_path):
+        """Delete a name and release its blob if nothing else references it."""
+        digest = self.digest_of(file_path)
+        with self._lock:
+            os.unlink(file_path)
+            if digest is None:
+                return
+            blob = self.blob_path(digest)
+            try:
+                st = os.stat(blob)
+            except FileNotFoundError:
+                return
+            if st.st_nlink == 1:
+                os.unlink(blob)
+                self._digests.pop(st.st_ino, None)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(files_dir):
+    """Return the process-wide content store for a directory."""
+    key = os.path.realpath(files_dir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ContentStore(key)
+        return store
@@ -0,0 +1,270 @@
+"""
+File download responses with byte ranges and conditional requests.
+
+Bytes can be moved by the app itself or handed off to the server/proxy:
+
+- stream: read the file in Python and yield chunks
+- sendfile: pass the open file to wsgi.file_wrapper, which server.py and
+  gunicorn send with os.sendfile (no copies through Python), as do ASGI
+  servers with the zerocopy or pathsend extension
+- x-accel-redirect: nginx serves the file from an internal location
+- x-sendfile: Apache/lighttpd serve the file from its path
+
+Files compressed at rest are sent as stored, with Content-Encoding, to
+clients that accept the encoding, and decoded while streaming otherwise.
+Objects in remote storage are always streamed, each range from a ranged
+GET.
+"""
+
+import mimetypes
+import os
+import secrets
+import unicodedata
+from urllib.parse import quote
+
+from flask import Response
+from werkzeug.http import http_date, parse_date, parse_etags
+from werkzeug.wsgi import wrap_file
+
+from compression import read_logical_range, stored_encoding
+from storage import is_local
+
+CHUNK_SIZE = 256 * 1024
+
+DOWNLOAD_BACKENDS = ('stream', 'sendfile', 'x-accel-redirect', 'x-sendfile')
+
+# Past this many ranges a multipart response costs more than the whole file
+MAX_RANGES = 16
+
+
+def make_etag(stat):
+    """Strong ETag from inode, size and mtime."""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_byte_ranges(header, size):
+    """Parse a Range header against a file size.
+
+    Returns None when the header should be ignored (absent, malformed or
+    not in bytes), otherwise a list of (start, stop) pairs; an empty list
+    means nothing is satisfiable. Overlapping or adjacent ranges are merged.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length == 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else size
+        except ValueError:
+            return None
+        if start < 0 or stop <= start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(stop, size)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def content_disposition(filename):
+    """Attachment header value, with an RFC 5987 fallback for non-ASCII names."""
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        return f'attachment; filename="{simple}"; filename*=UTF-8\'\'{quoted}'
+    return f'attachment; filename="{filename}"'
+
+
+def not_modified(req, etag, mtime):
+    """Evaluate If-None-Match / If-Modified-Since for a GET or HEAD."""
+    if_none_match = req.headers.get('If-None-Match')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etags.star_tag or etags.contains_weak(etag.strip('"'))
+    since = parse_date(req.headers.get('If-Modified-Since'))
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+def if_range_matches(req, etag, mtime):
+    """Whether a Range request may be honoured given If-Range."""
+    if_range = req.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only a strong comparison counts for ranges
+        return if_range == etag
+    date = parse_date(if_range)
+    return date is not None and int(mtime) == date.timestamp()
+
+
+def read_range(file_path, start, stop):
+    """Yield the bytes in [start, stop) of a file."""
+    if not is_local(file_path):
+        yield from file_path.iter_range(start, stop, CHUNK_SIZE)
+        return
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def range_body(req, file_path, start, stop, size, backend):
+    """Response body for [start, stop), zero-copy where the server allows it."""
+    if backend == 'sendfile' and stop == size:
+        # The wrapper sends to EOF, so only ranges that end there can use it
+        f = open(file_path, 'rb')
+        f.seek(start)
+        return wrap_file(req.environ, f, CHUNK_SIZE)
+    return read_range(file_path, start, stop)
+
+
+def offload_response(file_path, download_name, cache_control, backend, accel_prefix, content_encoding=None,
+                     relative_path=None):
+    """Let the front-end proxy move the bytes; it handles ranges and validators.
+
+    relative_path is the file's path under the directory the nginx location
+    aliases (the basename by default).
+    """
+    headers = {
+        'Cache-Control': cache_control,
+        'Content-Disposition': content_disposition(download_name),
+    }
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+        headers['Vary'] = 'Accept-Encoding'
+    if backend == 'x-accel-redirect':
+        relative_path = relative_path or os.path.basename(file_path)
+        headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{quote(str(relative_path))}"
+    else:
+        headers['X-Sendfile'] = os.path.abspath(file_path)
+    content_type = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    return Response(status=200, headers=headers, mimetype=content_type)
+
+
+def part_header(boundary, content_type, start, stop, size):
+    """Headers that open one part of a multipart/byteranges body."""
+    return (f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode()
+
+
+def read_multipart_ranges(file_path, ranges, size, content_type, boundary, read=read_range):
+    """Yield a multipart/byteranges body."""
+    for start, stop in ranges:
+        yield part_header(boundary, content_type, start, stop, size)
+        yield from read(file_path, start, stop)
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+
+def file_response(req, file_path, download_name, cache_control, backend='stream',
+                  accel_prefix='/protected-files', relative_path=None):
+    """Build a download response honouring Range and conditional headers."""
+    if backend not in DOWNLOAD_BACKENDS:
+        raise ValueError(f"Unknown download backend '{backend}'")
+    if not is_local(file_path):
+        # Neither the server nor the proxy can reach an object by path
+        backend = 'stream'
+
+    stat = os.stat(file_path) if is_local(file_path) else file_path.stat()
+    stored = stored_encoding(file_path, stat)
+    # Stored bytes go out as they are when the client can decode them; a
+    # Range is about the content itself, so it gets the decoded bytes
+    encoding = stored[0] if stored else None
+    send_encoded = encoding is not None and req.accept_encodings[encoding] > 0 and 'Range' not in req.headers
+
+    if backend in ('x-accel-redirect', 'x-sendfile') and (stored is None or send_encoded):
+        return offload_response(file_path, download_name, cache_control, backend, accel_prefix, encoding,
+                                relative_path)
+
+    size = stat.st_size
+    etag = make_etag(stat)
+    read = read_range
+    content_type = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': cache_control,
+        'Content-Disposition': content_disposition(download_name),
+    }
+    if stored is not None:
+        headers['Vary'] = 'Accept-Encoding'
+        if send_encoded:
+            etag = f'{etag[:-1]}-{encoding}"'
+            headers['Content-Encoding'] = encoding
+        else:
+            size = stored[1]
+            read = read_logical_range
+            # Decoded bytes can't be handed to the server as a file
+            backend = 'stream'
+    headers['ETag'] = etag
+    headers['Last-Modified'] = http_date(stat.st_mtime)
+
+    if not_modified(req, etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    ranges = None
+    if if_range_matches(req, etag, stat.st_mtime):
+        ranges = parse_byte_ranges(req.headers.get('Range'), size)
+
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    def body(start, stop):
+        if read is read_range:
+            return range_body(req, file_path, start, stop, size, backend)
+        return read(file_path, start, stop)
+
+    if ranges is None:
+        headers['Content-Length'] = str(size)
+        return Response(body(0, size), status=200, headers=headers,
+                        mimetype=content_type, direct_passthrough=True)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(body(start, stop), status=206, headers=headers,
+                        mimetype=content_type, direct_passthrough=True)
+
+    boundary = secrets.token_hex(12)
+    body_length = sum(
+        len(part_header(boundary, content_type, start, stop, size)) + stop - start
+        for start, stop in ranges
+    ) + len(f'\r\n--{boundary}--\r\n')
+    headers['Content-Length'] = str(body_length)
+    return Response(read_multipart_ranges(file_path, ranges, size, content_type, boundary, read), status=206,
+                    headers=headers, content_type=f'multipart/byteranges; boundary={boundary}',
+                    direct_passthrough=True)
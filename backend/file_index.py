@@ -0,0 +1,476 @@
+"""
+In-memory index of the files directory used by the listing endpoint.
+"""
+
+import base64
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import stat
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from compression import logical_size
+from metrics import LISTING_SCAN_FILES, LISTING_SCAN_SECONDS
+from search_index import NameSearchIndex
+from storage import get_storage, is_local
+from utils import file_info_from_stat
+
+logger = logging.getLogger(__name__)
+
+SORT_FIELDS = ('name', 'size', 'modified', 'type')
+
+
+def sort_key(sort_by, info, mtime):
+    """Build the sort key of a file for one view; the name breaks ties."""
+    name = info['name']
+    if sort_by == 'name':
+        return (name.lower(), name)
+    if sort_by == 'size':
+        return (info['size'], name.lower(), name)
+    if sort_by == 'modified':
+        return (mtime, name.lower(), name)
+    return (info['type'].lower(), name.lower(), name)
+
+
+def encode_cursor(sort_by, sort_order, key):
+    """Encode a sort position as an opaque, URL-safe cursor."""
+    raw = json.dumps([sort_by, sort_order, list(key)], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (sort_by, sort_order, key), or None if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_by, sort_order, key = json.loads(raw)
+    except Exception:
+        return None
+    if sort_by not in SORT_FIELDS or sort_order not in ('asc', 'desc') or not isinstance(key, list):
+        return None
+    # The key must look like the one sort_key() builds, or bisect can't compare it
+    if sort_by == 'name':
+        expected = (str, str)
+    elif sort_by == 'type':
+        expected = (str, str, str)
+    else:
+        expected = ((int, float), str, str)
+    if len(key) != len(expected) or isinstance(key[0], bool):
+        return None
+    if not all(isinstance(value, kind) for value, kind in zip(key, expected)):
+        return None
+    return sort_by, sort_order, tuple(key)
+
+
+def parse_timestamp(value, end_of_day=False):
+    """Parse an ISO 8601 date or datetime into a POSIX timestamp.
+
+    Naive values are local time, like last_modified. A bare date means the
+    start of that day, or the start of the next one with end_of_day.
+    """
+    parsed = datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed.timestamp()
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_duration(value):
+    """Parse '90', '45m', '12h', '30d' or '2w' into seconds."""
+    value = value.strip().lower()
+    unit = DURATION_UNITS.get(value[-1:])
+    seconds = float(value[:-1] if unit else value) * (unit or 1)
+    if not seconds >= 0:
+        raise ValueError('Duration must not be negative')
+    return seconds
+
+
+def normalize_type(value):
+    """Turn 'PDF', 'pdf' or '.pdf' into the '.pdf' form used by file types."""
+    value = value.strip().lower()
+    if not value or value == 'no-extension' or value.startswith('.'):
+        return value
+    return '.' + value
+
+
+class ListingFilter:
+    """Metadata filters applied inside the listing engine.
+
+    Modification times are a half-open [modified_after, modified_before)
+    range of timestamps; sizes are inclusive. None means unbounded.
+    """
+
+    def __init__(self, modified_after=None, modified_before=None, types=None, min_size=None, max_size=None):
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.types = frozenset(types) if types else None
+        self.min_size = min_size
+        self.max_size = max_size
+
+    @classmethod
+    def from_args(cls, args):
+        """Build a filter from query parameters; raises ValueError if any is malformed.
+
+        older_than (a duration such as '30d') is another way to give
+        modified_before; the earlier of the two bounds wins.
+        """
+        after = args.get('modified_after')
+        before = args.get('modified_before')
+        older_than = args.get('older_than')
+        types = [normalize_type(t) for t in args.get('types', '').split(',')]
+        sizes = []
+        for param in ('min_size', 'max_size'):
+            value = args.get(param)
+            if value is not None:
+                value = int(value)
+                if value < 0:
+                    raise ValueError(f'{param} must not be negative')
+            sizes.append(value)
+        before = parse_timestamp(before, end_of_day=True) if before else None
+        if older_than:
+            cutoff = time.time() - parse_duration(older_than)
+            before = cutoff if before is None else min(before, cutoff)
+        return cls(parse_timestamp(after) if after else None, before, [t for t in types if t], *sizes)
+
+    def __bool__(self):
+        return any(value is not None for value in
+                   (self.modified_after, self.modified_before, self.types, self.min_size, self.max_size))
+
+    def matches(self, info, mtime):
+        if self.modified_after is not None and mtime < self.modified_after:
+            return False
+        if self.modified_before is not None and mtime >= self.modified_before:
+            return False
+        if self.min_size is not None and info['size'] < self.min_size:
+            return False
+        if self.max_size is not None and info['size'] > self.max_size:
+            return False
+        return self.types is None or info['type'] in self.types
+
+    def narrow(self, sort_by, view):
+        """Slice a sorted view down to the range its leading column allows."""
+        if sort_by == 'size':
+            low, high = self.min_size, None if self.max_size is None else self.max_size + 1
+        elif sort_by == 'modified':
+            low, high = self.modified_after, self.modified_before
+        else:
+            return view
+        start = 0 if low is None else bisect_left(view, (low,))
+        stop = len(view) if high is None else bisect_left(view, (high,))
+        return view[start:stop]
+
+
+class FileIndex:
+    """Sorted views over the visible files of one directory."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.storage = get_storage(directory)
+        self._lock = threading.RLock()
+        self._entries = {}
+        # {name: (sha256, mtime)} of uploads, valid while the file keeps that mtime
+        self._hashes = {}
+        self._views = {field: [] for field in SORT_FIELDS}
+        self._search = NameSearchIndex()
+        self._dir_mtime = None
+        self._version = None
+        self.watched = False
+        self.feed = None
+
+    def _changed(self):
+        # Random rather than a counter, so versions from different worker processes never collide
+        self._version = secrets.token_hex(8)
+
+    def _publish(self, updates):
+        """Report {name: (info, mtime) or None} to the change feed, if any."""
+        if self.feed is None or not updates:
+            return
+        try:
+            self.feed.record(updates)
+        except sqlite3.Error:
+            # The listing stays right; only subscribers miss the event
+            logger.warning('Could not record %d changes in the change feed', len(updates), exc_info=True)
+
+    def attach_feed(self, feed):
+        """Report changes to feed from now on, after logging any made while nobody was watching."""
+        with self._lock:
+            if self.feed is feed:
+                return
+            try:
+                feed.record(dict(self._entries), full=True)
+            except sqlite3.Error:
+                logger.warning('Could not compare the listing with the change feed', exc_info=True)
+            self.feed = feed
+
+    def _directory_mtime(self):
+        return self.storage.mtime()
+
+    def rebuild(self):
+        """Rescan the directory and rebuild every view."""
+        with self._lock:
+            started = time.perf_counter()
+            dir_mtime = self._directory_mtime()
+            entries = {}
+            if dir_mtime is not None:
+                for entry in self.storage.scan():
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    info = file_info_from_stat(entry.name, st, logical_size(entry.path, st))
+                    entries[entry.name] = (info, st.st_mtime)
+            LISTING_SCAN_SECONDS.observe(time.perf_counter() - started, backend='memory')
+            LISTING_SCAN_FILES.set(len(entries), backend='memory')
+            if self.feed is not None:
+                updates = {name: None for name in self._entries if name not in entries}
+                for name, (info, mtime) in entries.items():
+                    current = self._entries.get(name)
+                    if current is None or current[0]['size'] != info['size'] or current[1] != mtime:
+                        updates[name] = (info, mtime)
+                self._publish(updates)
+            self._entries = entries
+            self._hashes = {name: known for name, known in self._hashes.items() if name in entries}
+            self._views = {
+                field: sorted(sort_key(field, info, mtime) for info, mtime in entries.values())
+                for field in SORT_FIELDS
+            }
+            self._search.clear()
+            for name in entries:
+                self._search.add(name)
+            self._dir_mtime = dir_mtime
+            self._changed()
+
+    def sync(self):
+        """Rebuild if the directory changed behind our back."""
+        with self._lock:
+            if self.watched and self._dir_mtime is not None:
+                # A watcher feeds changes in, no need to stat the directory
+                return
+            if self._dir_mtime is None or self._directory_mtime() != self._dir_mtime:
+                self.rebuild()
+
+    def _insert(self, info, mtime):
+        self._entries[info['name']] = (info, mtime)
+        for field, view in self._views.items():
+            insort(view, sort_key(field, info, mtime))
+        self._search.add(info['name'])
+        self._changed()
+
+    def _discard(self, name):
+        current = self._entries.pop(name, None)
+        if current is None:
+            return None
+        info, mtime = current
+        for field, view in self._views.items():
+            key = sort_key(field, info, mtime)
+            pos = bisect_left(view, key)
+            if pos < len(view) and view[pos] == key:
+                del view[pos]
+        self._hashes.pop(name, None)
+        self._search.remove(name)
+        self._changed()
+        return info
+
+    def add(self, file_path, content_hash=None):
+        """Index (or re-index) a file and return its metadata."""
+        file_path = Path(file_path) if is_local(file_path) else file_path
+        with self._lock:
+            try:
+                st = file_path.stat()
+            except OSError:
+                return None
+            info = file_info_from_stat(file_path.name, st, logical_size(file_path, st))
+            mtime = st.st_mtime
+            self._discard(info['name'])
+            self._insert(info, mtime)
+            if content_hash:
+                self._hashes[info['name']] = (content_hash, mtime)
+            if self.storage.local and file_path.parent != self.directory:
+                self.storage.touch()
+            self._dir_mtime = self._directory_mtime()
+            self._publish({info['name']: (info, mtime)})
+            return info
+
+    def remove(self, name):
+        """Drop a file from the index and return its last known metadata."""
+        with self._lock:
+            info = self._discard(name)
+            self.storage.touch()
+            self._dir_mtime = self._directory_mtime()
+            if info is not None:
+                self._publish({name: None})
+            return info
+
+    def remove_many(self, names):
+        """Drop many files with one pass over each view; returns how many were indexed."""
+        with self._lock:
+            gone = set()
+            for name in names:
+                if self._entries.pop(name, None) is not None:
+                    self._search.remove(name)
+                    gone.add(name)
+            if gone:
+                self._views = {field: [key for key in view if key[-1] not in gone]
+                               for field, view in self._views.items()}
+                self._changed()
+                self.storage.touch()
+            self._dir_mtime = self._directory_mtime()
+            self._publish(dict.fromkeys(gone))
+            return len(gone)
+
+    def refresh(self, name):
+        """Re-read one file from disk, indexing or dropping it as needed."""
+        with self._lock:
+            if name.startswith('.'):
+                return None
+            path = self.storage.locate(name)
+            try:
+                st = path.stat() if path else None
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                if self._discard(name) is not None:
+                    self._publish({name: None})
+                return None
+            size = logical_size(path, st)
+            current = self._entries.get(name)
+            if current and current[0]['size'] == size and current[1] == st.st_mtime:
+                return current[0]
+            info = file_info_from_stat(name, st, size)
+            self._discard(name)
+            self._insert(info, st.st_mtime)
+            self._publish({name: (info, st.st_mtime)})
+            return info
+
+    def snapshot(self):
+        """Return {name: (size, mtime)} for every indexed file."""
+        with self._lock:
+            return {name: (info['size'], mtime) for name, (info, mtime) in self._entries.items()}
+
+    def get(self, name):
+        """Return the indexed metadata of a file, or None."""
+        with self._lock:
+            self.sync()
+            current = self._entries.get(name)
+            return current[0] if current else None
+
+    def content_hash(self, name):
+        """Return the SHA-256 recorded when a file was uploaded, while it is unchanged."""
+        with self._lock:
+            known = self._hashes.get(name)
+            current = self._entries.get(name)
+            if known is None or current is None or current[1] != known[1]:
+                return None
+            return known[0]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def version(self):
+        """Opaque token that changes whenever the indexed files do."""
+        with self._lock:
+            self.sync()
+            return self._version
+
+    def _search_view(self, sort_by, search):
+        """Sorted keys of the files whose name contains search."""
+        view = self._views[sort_by]
+        matches = self._search.substring_matches(search)
+        if matches is None:
+            # Too short for the trigram index
+            return [key for key in view if search in key[-1].lower()]
+        if len(matches) * 8 < len(view):
+            # Few hits: sorting them is cheaper than a pass over the view
+            return sorted(sort_key(sort_by, *self._entries[name]) for name in matches)
+        return [key for key in view if key[-1] in matches]
+
+    def _matching_view(self, sort_by, search='', filters=None):
+        """Sorted keys of the files that pass the search and filters."""
+        view = self._search_view(sort_by, search) if search else self._views[sort_by]
+        if not filters:
+            return view
+        view = filters.narrow(sort_by, view)
+        return [key for key in view if filters.matches(*self._entries[key[-1]])]
+
+    def page(self, sort_by='name', sort_order='asc', offset=0, limit=10, search='', filters=None):
+        """Return (total, files) for one page of the listing."""
+        with self._lock:
+            self.sync()
+            view = self._matching_view(sort_by, search, filters)
+            total = len(view)
+            if sort_order == 'desc':
+                stop = max(total - offset, 0)
+                start = max(stop - limit, 0)
+                selected = [key[-1] for key in reversed(view[start:stop])]
+            else:
+                selected = [key[-1] for key in view[offset:offset + limit]]
+            return total, [self._entries[name][0] for name in selected]
+
+    def page_after(self, sort_by='name', sort_order='asc', after=None, limit=10, search='', filters=None):
+        """Return (total, files, next_key) for the page that follows a sort key.
+
+        Only the returned rows are visited when there's no search or filter,
+        so deep pages cost the same as the first one. next_key is None on the
+        last page.
+        """
+        with self._lock:
+            self.sync()
+            view = self._matching_view(sort_by, search, filters)
+            if sort_order == 'desc':
+                stop = len(view) if after is None else bisect_left(view, after)
+                keys = view[max(stop - limit - 1, 0):stop][::-1]
+            else:
+                start = 0 if after is None else bisect_right(view, after)
+                keys = view[start:start + limit + 1]
+
+            next_key = keys[limit - 1] if len(keys) > limit else None
+            return len(view), [self._entries[key[-1]][0] for key in keys[:limit]], next_key
+
+    def search(self, query, limit=20, fuzzy=True):
+        """Ranked filename search; returns (total matches, files with score and match kind)."""
+        with self._lock:
+            self.sync()
+            total, ranked = self._search.search(query, limit, fuzzy)
+            return total, [dict(self._entries[hit['name']][0], score=hit['score'], match=hit['match'])
+                           for hit in ranked]
+
+    def facets(self, search='', filters=None):
+        """Count matching files per type and per month without building rows."""
+        with self._lock:
+            self.sync()
+            # The modified view lets a date filter skip straight to its range
+            keys = self._matching_view('modified', search, filters)
+            types, months = Counter(), Counter()
+            for key in keys:
+                info, mtime = self._entries[key[-1]]
+                types[info['type']] += 1
+                months[datetime.fromtimestamp(mtime).strftime('%Y-%m')] += 1
+            return {
+                'total_files': len(keys),
+                'types': dict(sorted(types.items(), key=lambda item: (-item[1], item[0]))),
+                'months': dict(sorted(months.items()))
+            }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(directory):
+    """Return the process-wide index for a directory, building it on first use."""
+    key = os.path.realpath(directory)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = FileIndex(key)
+    index.sync()
+    return index
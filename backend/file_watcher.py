@@ -0,0 +1,272 @@
+"""
+Background watcher that keeps a FileIndex in step with external writes.
+
+Uses inotify on Linux and falls back to polling file mtimes elsewhere.
+With the sharded layout inotify also watches every fanout directory,
+adding new ones as they appear; if the kernel's watch limit runs out it
+falls back to polling. Files in object storage are always polled, by
+listing the bucket.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from compression import logical_size
+from storage import SHARDS_DIRNAME, get_storage
+
+logger = logging.getLogger(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+BACKENDS = ('auto', 'inotify', 'poll', 'off')
+
+
+def _load_libc():
+    """Return libc with the inotify calls, or None when unavailable."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """Apply debounced, coalesced directory changes to a FileIndex."""
+
+    def __init__(self, index, backend='auto', debounce=0.2, poll_interval=2.0):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown watcher backend '{backend}'")
+        self.index = index
+        self.backend = backend
+        self.debounce = debounce
+        self.max_delay = max(debounce * 10, 1.0)
+        self.poll_interval = poll_interval
+        self.active_backend = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching in a daemon thread."""
+        if self.backend == 'off' or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name='file-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Stop the watcher and hand freshness checks back to the index."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.index.watched = False
+
+    def _run(self):
+        try:
+            local = get_storage(self.index.directory).local
+            if self.backend in ('auto', 'inotify') and local and self._run_inotify():
+                return
+            if not self._stop.is_set():
+                self._run_polling()
+        except Exception:
+            logger.exception('File watcher crashed, falling back to per-request checks')
+            self.index.watched = False
+
+    def _flush(self, names, resync):
+        """Apply pending changes, or rescan everything after an overflow."""
+        if resync:
+            logger.info('File watcher resyncing %s', self.index.directory)
+            self.index.rebuild()
+            return
+        for name in names:
+            self.index.refresh(name)
+
+    def _run_inotify(self):
+        """Watch with inotify; return False if it can't be used."""
+        libc = _load_libc()
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning('inotify_init1 failed: %s', os.strerror(ctypes.get_errno()))
+            return False
+        storage = get_storage(self.index.directory)
+        watched = {}
+        
+        def watch(path):
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                logger.warning('inotify_add_watch failed on %s: %s', path, os.strerror(ctypes.get_errno()))
+                return False
+            watched[wd] = str(path)
+            return True
+        
+        def watch_tree(path):
+            """Watch a fanout directory, or the shards root and everything in it."""
+            if not watch(path):
+                return False
+            if os.path.basename(path) == SHARDS_DIRNAME:
+                return all(watch_tree(shard) for shard in storage.shard_dirs())
+            return True
+        
+        try:
+            if not watch(storage.directory):
+                return False
+            top_wd = next(iter(watched))
+            if storage.has_shards() and not watch_tree(storage.shards_root):
+                return False
+            # Only now may the index skip its own freshness checks; the rebuild
+            # catches anything that happened before the watch was in place
+            self.index.watched = True
+            self.index.rebuild()
+            self.active_backend = 'inotify'
+
+            pending = set()
+            resync = False
+            first_event = last_event = None
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], self.debounce)
+                now = time.monotonic()
+                if ready:
+                    try:
+                        data = os.read(fd, 64 * 1024)
+                    except BlockingIOError:
+                        data = b''
+                    new_dirs = []
+                    lost, overflow = self._parse_events(data, pending, top_wd, new_dirs)
+                    for wd, name in new_dirs:
+                        path = os.path.join(watched.get(wd, ''), name)
+                        if path != str(storage.shards_root) and os.path.dirname(path) != str(storage.shards_root):
+                            continue
+                        if not watch_tree(path):
+                            self._flush(pending, True)
+                            return False
+                        # Files may have landed before the watch was in place
+                        resync = True
+                    if lost:
+                        # The directory itself went away; poll until it's back
+                        self._flush(pending, True)
+                        return False
+                    resync = resync or overflow
+                    if pending or resync:
+                        first_event = first_event or now
+                        last_event = now
+                if first_event is None:
+                    continue
+                quiet = now - last_event >= self.debounce
+                overdue = now - first_event >= self.max_delay
+                if quiet or overdue:
+                    self._flush(pending, resync)
+                    pending = set()
+                    resync = False
+                    first_event = last_event = None
+            return True
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _parse_events(data, pending, top_wd=None, new_dirs=None):
+        """Collect changed names from raw inotify events.
+
+        With top_wd, only that watch going away counts as lost. With
+        new_dirs, directories created or moved in are appended to it as
+        (wd, name) instead of being treated as files.
+        """
+        lost = overflow = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # A fanout directory removed by a migration back to flat is no loss
+                lost = lost or top_wd is None or wd == top_wd
+            elif new_dirs is not None and mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    new_dirs.append((wd, os.fsdecode(name)))
+            elif name:
+                pending.add(os.fsdecode(name))
+        return lost, overflow
+
+    def _run_polling(self):
+        """Diff file mtimes against the index at a fixed interval."""
+        # Changes from here on are found by the next round's diff
+        self.index.watched = True
+        self.index.rebuild()
+        self.active_backend = 'poll'
+        while not self._stop.wait(self.poll_interval):
+            known = self.index.snapshot()
+            changed = set()
+            try:
+                # A missing directory yields nothing: everything indexed is gone
+                for entry in get_storage(self.index.directory).scan():
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    current = known.pop(entry.name, None)
+                    if current is None or current[1] != st.st_mtime or (
+                            current[0] != st.st_size and current[0] != logical_size(entry.path, st)):
+                        changed.add(entry.name)
+            except OSError:
+                # Object storage unreachable: keep the index as it is until the next round
+                logger.warning('File watcher could not list %s', self.index.directory, exc_info=True)
+                continue
+            changed.update(known)
+            if changed:
+                self._flush(changed, False)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def start_watcher(index, backend='auto', debounce=0.2, poll_interval=2.0):
+    """Start (once per index) a watcher for the given index."""
+    with _watchers_lock:
+        watcher = _watchers.get(index.directory)
+        if watcher is None:
+            watcher = FileWatcher(index, backend, debounce, poll_interval).start()
+            _watchers[index.directory] = watcher
+        return watcher
+
+
+def stop_watchers():
+    """Stop every running watcher, e.g. before forking worker processes."""
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+        _watchers.clear()
+    for watcher in watchers:
+        watcher.stop()
@@ -0,0 +1,340 @@
+"""
+Persistent background jobs for per-file work after uploads.
+
+Jobs are rows in a SQLite table next to the files, so they survive
+restarts and are shared by every worker process. A worker claims a job
+inside an IMMEDIATE transaction, which holds SQLite's write lock, so two
+workers in any process can never claim the same job. A claim is a lease
+that the worker renews while the job runs. If the worker's process dies,
+the lease runs out and another worker picks the job up. A job can only
+be finished under the claim that started it, so a worker that lost its
+lease can't overwrite the outcome of the one that took over. Failures
+are retried with exponential backoff until a job runs out of attempts.
+"""
+
+import json
+import logging
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+JOBS_FILENAME = '.jobs.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    claim TEXT,
+    lease_until REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+CREATE INDEX IF NOT EXISTS jobs_leased ON jobs (status, lease_until);
+"""
+
+JOB_COLUMNS = 'id, kind, payload, status, attempts, max_attempts, run_after, error, created_at, updated_at'
+
+MAX_RETRY_DELAY = 600.0
+# How often a worker looks for finished jobs past their retention
+PRUNE_INTERVAL = 3600.0
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler for a failure that retrying can't fix."""
+
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value).isoformat() if value is not None else None
+
+
+def _row_to_job(row):
+    job_id, kind, payload, status, attempts, max_attempts, run_after, error, created_at, updated_at = row
+    return {
+        'id': job_id,
+        'kind': kind,
+        'payload': json.loads(payload),
+        'status': status,
+        'attempts': attempts,
+        'max_attempts': max_attempts,
+        'run_after': _timestamp(run_after) if status == 'queued' else None,
+        'error': error,
+        'created_at': _timestamp(created_at),
+        'updated_at': _timestamp(updated_at)
+    }
+
+
+def retry_delay(attempts, base):
+    """Seconds before retry number `attempts`: exponential, capped, with jitter."""
+    delay = min(base * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+    # Jitter spreads out jobs that failed together
+    return delay * random.uniform(0.5, 1.0)
+
+
+class JobQueue:
+    """Durable job table: enqueue, claim under a lease, then finish or retry."""
+
+    def __init__(self, db_path, max_attempts=5, retry_base=2.0):
+        self.db_path = str(db_path)
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self._local = threading.local()
+        self.wakeup = threading.Event()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit, so claim() can open its own IMMEDIATE transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, kind, payload, max_attempts=None):
+        """Add a job and return its id."""
+        job_id = secrets.token_hex(12)
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO jobs (id, kind, payload, status, max_attempts, run_after, created_at, updated_at) '
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), max_attempts or self.max_attempts, now, now, now))
+        self.wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job's status, or None."""
+        row = self._connect().execute(f'SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def claim(self, lease):
+        """Lease the next due job for `lease` seconds; returns (job, claim token) or None.
+
+        Jobs whose worker stopped renewing their lease are due again.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = conn.execute(
+                    f"SELECT {JOB_COLUMNS} FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                    "OR (status = 'running' AND lease_until < ?) ORDER BY run_after LIMIT 1",
+                    (now, now)).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                job = _row_to_job(row)
+                if job['attempts'] >= job['max_attempts']:
+                    # Its worker died on the last attempt
+                    conn.execute("UPDATE jobs SET status = 'failed', claim = NULL, lease_until = NULL, "
+                                 "error = COALESCE(error, 'Worker stopped while running the job'), updated_at = ? "
+                                 'WHERE id = ?', (now, job['id']))
+                    continue
+                token = secrets.token_hex(8)
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, claim = ?, "
+                             'lease_until = ?, updated_at = ? WHERE id = ?',
+                             (token, now + lease, now, job['id']))
+                conn.execute('COMMIT')
+                job.update(status='running', attempts=job['attempts'] + 1, run_after=None)
+                return job, token
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def renew(self, tokens, lease):
+        """Extend the leases of jobs still held under these claim tokens."""
+        if not tokens:
+            return
+        placeholders = ','.join('?' * len(tokens))
+        self._connect().execute(
+            f"UPDATE jobs SET lease_until = ? WHERE status = 'running' AND claim IN ({placeholders})",
+            (time.time() + lease, *tokens))
+
+    def complete(self, job_id, token):
+        """Mark a job done; False if its claim was lost meanwhile."""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = 'succeeded', claim = NULL, lease_until = NULL, error = NULL, updated_at = ? "
+            "WHERE id = ? AND claim = ? AND status = 'running'", (time.time(), job_id, token))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, token, error, retry=True):
+        """Record a failed attempt: queue a retry after a backoff, or give up for good.
+
+        False if the claim was lost meanwhile.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND claim = ? AND status = 'running'",
+                           (job_id, token)).fetchone()
+        if row is None:
+            return False
+        attempts, max_attempts = row
+        now = time.time()
+        if retry and attempts < max_attempts:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', run_after = ?, claim = NULL, lease_until = NULL, error = ?, "
+                "updated_at = ? WHERE id = ? AND claim = ? AND status = 'running'",
+                (now + retry_delay(attempts, self.retry_base), error, now, job_id, token))
+        else:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'failed', claim = NULL, lease_until = NULL, error = ?, updated_at = ? "
+                "WHERE id = ? AND claim = ? AND status = 'running'", (error, now, job_id, token))
+        return cursor.rowcount == 1
+
+    def prune(self, older_than):
+        """Delete jobs that finished more than `older_than` seconds ago; returns how many."""
+        cursor = self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?", (time.time() - older_than,))
+        return cursor.rowcount
+
+    def counts(self):
+        """Number of jobs in each status."""
+        return dict(self._connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+
+class JobWorkers:
+    """A pool of threads running queued jobs inside the app context."""
+
+    def __init__(self, app, queue, handlers, workers=2, lease=60.0, poll_interval=1.0, retention=604800.0):
+        self.app = app
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._held = set()
+
+    def start(self):
+        """Start the worker threads and the lease keeper."""
+        if self._threads:
+            return self
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        keeper = threading.Thread(target=self._keep_leases, name='job-leases', daemon=True)
+        keeper.start()
+        self._threads.append(keeper)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop taking jobs and wait briefly for running ones; unfinished jobs are retried after their lease."""
+        self._stop.set()
+        self.queue.wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _keep_leases(self):
+        last_prune = 0.0
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                held = list(self._held)
+            try:
+                self.queue.renew(held, self.lease)
+                if time.monotonic() - last_prune > PRUNE_INTERVAL:
+                    self.queue.prune(self.retention)
+                    last_prune = time.monotonic()
+            except sqlite3.Error:
+                logger.exception('Failed to renew job leases')
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.queue.claim(self.lease)
+            except sqlite3.Error:
+                logger.exception('Failed to claim a job')
+                claimed = None
+            if claimed is None:
+                # Woken early by an enqueue in this process; other processes' jobs wait for the poll
+                self.queue.wakeup.wait(self.poll_interval)
+                self.queue.wakeup.clear()
+                continue
+            self.run(*claimed)
+
+    def run(self, job, token):
+        """Run one claimed job and record its outcome."""
+        with self._lock:
+            self._held.add(token)
+        try:
+            handler = self.handlers.get(job['kind'])
+            if handler is None:
+                self.queue.fail(job['id'], token, f"No handler for job kind '{job['kind']}'", retry=False)
+                return
+            try:
+                with self.app.app_context():
+                    handler(job['payload'])
+            except PermanentJobError as e:
+                self.queue.fail(job['id'], token, str(e) or type(e).__name__, retry=False)
+            except Exception as e:
+                logger.warning('Job %s (%s) failed on attempt %d: %s', job['id'], job['kind'], job['attempts'], e)
+                self.queue.fail(job['id'], token, str(e) or type(e).__name__)
+            else:
+                self.queue.complete(job['id'], token)
+        finally:
+            with self._lock:
+                self._held.discard(token)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def _reset_connections():
+    # SQLite connections must not be shared across fork(); children open their own
+    for queue in _queues.values():
+        queue._local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_connections)
+
+
+def get_job_queue(db_path, max_attempts=5, retry_base=2.0):
+    """Return the process-wide job queue stored at db_path."""
+    key = os.path.realpath(db_path)
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            Path(key).parent.mkdir(parents=True, exist_ok=True)
+            queue = _queues[key] = JobQueue(key, max_attempts, retry_base)
+        return queue
+
+
+def start_job_workers(app, queue, handlers, workers=2, lease=60.0, poll_interval=1.0, retention=604800.0):
+    """Start (once per queue) the worker pool for a queue."""
+    with _workers_lock:
+        pool = _workers.get(queue.db_path)
+        if pool is None:
+            pool = JobWorkers(app, queue, handlers, workers, lease, poll_interval, retention).start()
+            _workers[queue.db_path] = pool
+        return pool
+
+
+def stop_job_workers():
+    """Stop every worker pool, e.g. before forking worker processes."""
+    with _workers_lock:
+        pools = list(_workers.values())
+        _workers.clear()
+    for pool in pools:
+        pool.stop()
@@ -0,0 +1,48 @@
+"""
+JSON provider that encodes with orjson when it is installed.
+
+Listing responses are mostly lists of small file records, where the
+stdlib encoder's per-object overhead dominates. orjson encodes them
+several times faster. Output follows the same settings as Flask's default
+provider (sorted keys, indented in debug mode), and anything orjson
+can't encode falls back to the default encoder.
+"""
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """DefaultJSONProvider with orjson doing the encoding."""
+
+    def _encode(self, obj, indent):
+        # Dates and dataclasses go through default() so they match Flask's output
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and set(kwargs) <= {'indent', 'separators'}:
+            try:
+                return self._encode(obj, kwargs.get('indent')).decode()
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            body = self._encode(obj, indent)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
@@ -5,12 +5,16 @@ Simplified Flask application factory.
 from flask import Flask
 from flask_cors import CORS
 from config import config
+from json_provider import FastJSONProvider
+from metrics import install_metrics
+from response_compression import install_response_compression
 from routes import bp as api_blueprint
 
 
 def create_app(config_name='development'):
     """Create and configure Flask app."""
     app = Flask(__name__)
+    app.json = FastJSONProvider(app)
     
     # Load configuration
     app.config.from_object(config[config_name])
@@ -19,10 +23,16 @@ def create_app(config_name='development'):
     # Configure CORS
     CORS(app, 
          origins=app.config['CORS_ORIGINS'],
-         methods=['GET', 'POST', 'DELETE', 'OPTIONS'],
-         allow_headers=['Content-Type'])
+         methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
+         allow_headers=['Content-Type', 'X-Chunk-Checksum'])
     
     # Register blueprints
     app.register_blueprint(api_blueprint)
     
+    if app.config['RESPONSE_COMPRESSION']:
+        install_response_compression(app, app.config['RESPONSE_COMPRESSION_MIN_SIZE'])
+    
+    if app.config['METRICS_ENABLED']:
+        install_metrics(app)
+    
     return app
\ No newline at end of file
@@ -0,0 +1,565 @@
+"""
+Prometheus metrics and sampled request profiling.
+
+Metrics are module-level objects that any module updates in place, and
+GET /metrics renders them in the Prometheus text format. Each process
+keeps its own values; with several workers (server.py) every process
+also writes a snapshot of them to the metrics directory about once a
+second, and whichever worker answers a scrape adds up the others'
+snapshots with its own live values. Gauges only count live processes,
+and counters of exited ones are folded into an archive file so they
+never go backwards.
+
+A fraction of requests can be run under cProfile, set at runtime through
+PUT /api/profiling for every worker at once. Each profile is a pstats
+file in the profiles directory (`python -m pstats <file>`).
+"""
+
+import cProfile
+import fcntl
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from pathlib import Path
+
+from werkzeug.exceptions import HTTPException
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SCAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+METRICS_DIRNAME = '.metrics'
+ARCHIVE_FILENAME = 'archive.json'
+PROFILING_FILENAME = 'profiling.json'
+PROFILES_DIRNAME = 'profiles'
+
+# Seconds between snapshots of a process's values, and between checks of the profiling setting
+FLUSH_INTERVAL = 1.0
+SETTINGS_INTERVAL = 1.0
+
+# Endpoints whose requests count as transfers in flight
+TRANSFER_ENDPOINTS = {
+    'api.upload_file': 'upload',
+    'api.upload_batch': 'upload',
+    'api.put_upload_chunk': 'upload',
+    'api.download_file': 'download',
+    'api.download_archive': 'download',
+}
+
+_registry = []
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """A named family of values, one per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), aggregate='sum'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # How values from several processes combine: sum, or max for last-seen readings
+        self.aggregate = aggregate
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value if not isinstance(value, list) else list(value)]
+                    for key, value in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def merge(self, current, value):
+        if current is None:
+            return value
+        return max(current, value) if self.aggregate == 'max' else current + value
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key in sorted(values):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(values[key])}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Observations counted into buckets; stored as [per-bucket counts..., sum, count]."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def merge(self, current, value):
+        if current is None:
+            return list(value)
+        return [a + b for a, b in zip(current, value)]
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key in sorted(values):
+            counts = values[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {counts[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram('filemanager_request_duration_seconds',
+                            'Time from the start of a request until its response body is sent.', ('route', 'method'))
+REQUESTS = Counter('filemanager_requests_total', 'Requests answered, by status.', ('route', 'method', 'status'))
+RECEIVED_BYTES = Counter('filemanager_received_bytes_total', 'Request body bytes received.', ('route',))
+SENT_BYTES = Counter('filemanager_sent_bytes_total', 'Response body bytes sent.', ('route',))
+TRANSFERS_IN_FLIGHT = Gauge('filemanager_transfers_in_flight', 'Uploads and downloads in progress.', ('direction',))
+ERRORS = Counter('filemanager_errors_total', 'Error responses, by error code.', ('code',))
+LISTING_SCAN_SECONDS = Histogram('filemanager_listing_scan_seconds',
+                                 'Time spent rescanning the files directory for the listing.', ('backend',),
+                                 SCAN_BUCKETS)
+LISTING_SCAN_FILES = Gauge('filemanager_listing_scan_files', 'Files found by the latest listing scan.', ('backend',),
+                           aggregate='max')
+PROFILED_REQUESTS = Counter('filemanager_profiled_requests_total', 'Requests run under the profiler.', ('route',))
+
+
+class _ProcessState:
+    """Per-process bookkeeping; replaced after fork() so a worker starts from zero."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.token = secrets.token_hex(4)
+        self.directory = None
+        self.flusher = None
+        self.flushed = None
+        self.lock = threading.Lock()
+        self.profiler_lock = threading.Lock()
+        self.sample_rate = None
+        self.settings_checked = 0.0
+        self.settings_mtime = None
+
+    @property
+    def filename(self):
+        return f'{self.pid}-{self.token}.json'
+
+
+_state = _ProcessState()
+
+
+def _reset_after_fork():
+    global _state
+    _state = _ProcessState()
+    # The parent's values are in the parent's snapshot, not ours
+    for metric in _registry:
+        metric.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def metrics_dir(config):
+    """METRICS_DIR, or .metrics under FILES_DIRECTORY."""
+    return Path(config.get('METRICS_DIR') or Path(config['FILES_DIRECTORY']) / METRICS_DIRNAME)
+
+
+def _write_json(path, data):
+    temp = path.with_name(f'.{path.name}.{secrets.token_hex(4)}')
+    temp.write_text(json.dumps(data))
+    os.replace(temp, path)
+
+
+def _read_json(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _snapshot():
+    return {'pid': _state.pid, 'metrics': {metric.name: metric.snapshot() for metric in _registry}}
+
+
+def flush(directory):
+    """Write this process's values to the metrics directory, if they changed."""
+    snapshot = _snapshot()
+    if snapshot == _state.flushed:
+        return
+    directory = Path(directory)
+    directory.mkdir(exist_ok=True)
+    _write_json(directory / _state.filename, snapshot)
+    _state.flushed = snapshot
+
+
+def _flush_loop(state):
+    while _state is state:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush(state.directory)
+        except OSError:
+            pass
+
+
+def _start_flusher(directory):
+    """Snapshot this process's values to `directory` from now on."""
+    state = _state
+    state.directory = directory
+    if state.flusher is None:
+        with state.lock:
+            if state.flusher is None:
+                state.flusher = threading.Thread(target=_flush_loop, args=(state,), name='metrics-flush',
+                                                 daemon=True)
+                state.flusher.start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(totals, snapshot, gauges=True):
+    for metric in _registry:
+        if metric.kind == 'gauge' and not gauges:
+            continue
+        values = totals.setdefault(metric.name, {})
+        for key, value in snapshot.get(metric.name, []):
+            key = tuple(key)
+            values[key] = metric.merge(values.get(key), value)
+
+
+def collect(directory=None):
+    """Values of every metric summed over this process and the snapshots of others."""
+    totals = {}
+    _add(totals, _snapshot()['metrics'])
+    if directory is None:
+        return totals
+    directory = Path(directory)
+    if not directory.is_dir():
+        return totals
+
+    with open(directory / '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = _read_json(directory / ARCHIVE_FILENAME) or {'metrics': {}}
+        exited = []
+        for path in directory.glob('*-*.json'):
+            if path.name == _state.filename:
+                continue
+            snapshot = _read_json(path)
+            if snapshot is None:
+                continue
+            if _alive(snapshot['pid']):
+                _add(totals, snapshot['metrics'])
+                continue
+            # An exited process: keep its counters in the archive, drop its gauges
+            merged = {}
+            _add(merged, archive['metrics'], gauges=False)
+            _add(merged, snapshot['metrics'], gauges=False)
+            archive['metrics'] = {name: [[list(key), value] for key, value in values.items()]
+                                  for name, values in merged.items()}
+            exited.append(path)
+        if exited:
+            # Archive first: a crash in between may count a process twice, but never loses it
+            _write_json(directory / ARCHIVE_FILENAME, archive)
+            for path in exited:
+                path.unlink()
+    _add(totals, archive['metrics'], gauges=False)
+    return totals
+
+
+def render(directory=None):
+    """Every metric in the Prometheus text exposition format."""
+    totals = collect(directory)
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(totals.get(metric.name, {})))
+    return '\n'.join(lines) + '\n'
+
+
+def profiling_settings(directory):
+    """The sample rate set through set_sample_rate, or None if never set."""
+    data = _read_json(Path(directory) / PROFILING_FILENAME)
+    return data.get('sample_rate') if data else None
+
+
+def set_sample_rate(directory, rate):
+    """Profile this fraction of requests in every process using `directory`."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    _write_json(directory / PROFILING_FILENAME, {'sample_rate': rate})
+    _state.settings_checked = 0.0
+
+
+def sample_rate(directory, default):
+    """Current sample rate, re-read from the settings file at most once a second."""
+    state = _state
+    now = time.monotonic()
+    if now - state.settings_checked >= SETTINGS_INTERVAL:
+        state.settings_checked = now
+        try:
+            mtime = os.stat(Path(directory) / PROFILING_FILENAME).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != state.settings_mtime:
+            state.settings_mtime = mtime
+            state.sample_rate = profiling_settings(directory) if mtime is not None else None
+    return default if state.sample_rate is None else state.sample_rate
+
+
+def list_profiles(directory):
+    """Saved profiles, newest first."""
+    profiles_dir = Path(directory) / PROFILES_DIRNAME
+    if not profiles_dir.is_dir():
+        return []
+    profiles = []
+    for entry in os.scandir(profiles_dir):
+        if entry.name.endswith('.prof'):
+            st = entry.stat()
+            profiles.append({'name': entry.name, 'size': st.st_size, 'created': st.st_mtime})
+    profiles.sort(key=lambda p: p['created'], reverse=True)
+    return profiles
+
+
+def save_profile(directory, profiler, endpoint, keep):
+    """Dump a profile and delete the oldest beyond `keep`."""
+    profiles_dir = Path(directory) / PROFILES_DIRNAME
+    profiles_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{secrets.token_hex(3)}-{endpoint}.prof"
+    profiler.dump_stats(profiles_dir / name)
+    for old in list_profiles(directory)[keep:]:
+        try:
+            os.unlink(profiles_dir / old['name'])
+        except OSError:
+            pass
+
+
+class TrackedRequest:
+    """Latency, bytes and in-flight accounting for one request."""
+
+    def __init__(self, route, method, endpoint):
+        self.route = route
+        self.method = method
+        self.endpoint = endpoint or 'unmatched'
+        self.direction = TRANSFER_ENDPOINTS.get(endpoint)
+        self.started = time.perf_counter()
+        self.finished = False
+        if self.direction:
+            TRANSFERS_IN_FLIGHT.inc(direction=self.direction)
+
+    def received(self, size):
+        """Count body bytes as they are read, so chunked bodies count too."""
+        if size:
+            RECEIVED_BYTES.inc(size, route=self.route)
+
+    def finish(self, status, sent):
+        if self.finished:
+            return
+        self.finished = True
+        if self.direction:
+            TRANSFERS_IN_FLIGHT.dec(direction=self.direction)
+        REQUEST_LATENCY.observe(time.perf_counter() - self.started, route=self.route, method=self.method)
+        REQUESTS.inc(route=self.route, method=self.method, status=status)
+        if sent:
+            SENT_BYTES.inc(sent, route=self.route)
+
+
+class CountingInput:
+    """wsgi.input wrapper that counts the bytes the app reads."""
+
+    def __init__(self, stream, tracked):
+        self._stream = stream
+        self._tracked = tracked
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self._tracked.received(len(data))
+        return data
+
+    def readline(self, *args):
+        line = self._stream.readline(*args)
+        self._tracked.received(len(line))
+        return line
+
+    def readlines(self, *args):
+        lines = self._stream.readlines(*args)
+        self._tracked.received(sum(len(line) for line in lines))
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class TrackedBody:
+    """Response iterable that counts the bytes sent and finishes the request on close."""
+
+    def __init__(self, iterable, tracked, status):
+        self._iterable = iterable
+        self._tracked = tracked
+        self._status = status
+        self._sent = 0
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            self._sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._tracked.finish(self._status.get('code', '500'), self._sent)
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording every request, and profiling a sample of them."""
+
+    def __init__(self, flask_app, wsgi_app):
+        self.flask_app = flask_app
+        self.wsgi_app = wsgi_app
+
+    def track(self, environ):
+        """Start accounting for a request; the ASGI wrapper calls this before reading a body.
+
+        Body bytes are counted by whoever reads them: run() for requests it
+        tracks itself, the ASGI wrapper for the ones it passes in.
+        """
+        try:
+            rule, _ = self.flask_app.url_map.bind_to_environ(environ).match(return_rule=True)
+            route, endpoint = rule.rule, rule.endpoint
+        except HTTPException:
+            route, endpoint = 'unmatched', None
+        return TrackedRequest(route, environ.get('REQUEST_METHOD', 'GET'), endpoint)
+
+    def __call__(self, environ, start_response):
+        return self.run(self.wsgi_app, environ, start_response)
+
+    def run(self, wsgi_app, environ, start_response, tracked=None):
+        """Call wsgi_app as part of the request `tracked` (a new one by default)."""
+        if tracked is None:
+            tracked = self.track(environ)
+            if environ.get('wsgi.input') is not None:
+                environ['wsgi.input'] = CountingInput(environ['wsgi.input'], tracked)
+        status = {}
+
+        def start(status_line, headers, exc_info=None):
+            status['code'] = status_line.split(' ', 1)[0]
+            status['length'] = next((value for key, value in headers if key.lower() == 'content-length'), None)
+            return start_response(status_line, headers, exc_info)
+
+        config = self.flask_app.config
+        directory = metrics_dir(config)
+        _start_flusher(directory)
+        profiler = None
+        rate = sample_rate(directory, config['PROFILE_SAMPLE_RATE'])
+        if rate > 0 and random.random() < rate and _state.profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        try:
+            if profiler is None:
+                iterable = wsgi_app(environ, start)
+            else:
+                # Only the view is profiled, not the streaming of its body
+                try:
+                    iterable = profiler.runcall(wsgi_app, environ, start)
+                finally:
+                    _state.profiler_lock.release()
+                    PROFILED_REQUESTS.inc(route=tracked.route)
+                    save_profile(directory, profiler, tracked.endpoint, config['PROFILE_MAX_FILES'])
+        except BaseException:
+            tracked.finish('500', 0)
+            raise
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(file_wrapper, type) and isinstance(iterable, file_wrapper):
+            # Wrapping it would hide it from the server's sendfile path, so patch close in place
+            original_close = getattr(iterable, 'close', None)
+
+            def close():
+                try:
+                    if original_close:
+                        original_close()
+                finally:
+                    tracked.finish(status.get('code', '500'), int(status.get('length') or 0))
+
+            try:
+                iterable.close = close
+                return iterable
+            except AttributeError:
+                pass
+        return TrackedBody(iterable, tracked, status)
+
+
+def install_metrics(app):
+    """Record every request to app in the metrics; returns the middleware."""
+    middleware = MetricsMiddleware(app, app.wsgi_app)
+    app.wsgi_app = middleware
+    app.extensions['metrics'] = middleware
+    return middleware
@@ -0,0 +1,133 @@
+"""
+Move an existing files directory to another storage layout while it is served.
+
+Restart the servers with the new STORAGE_LAYOUT first, so new uploads
+already go to the target layout, then run this to move the existing
+files across:
+
+    python migrate_layout.py --files-dir ./files --to sharded
+    python migrate_layout.py --files-dir ./files --to flat --batch 500 --pause 0.5
+
+Each file is hard-linked at its new path before its old name is
+removed, so at every moment it can be found in at least one place, and
+lookups check the target layout both first and last. Content-store
+blobs keep their link counts, since the inode doesn't change. Running it
+again picks up anything left over; it stops with an error count if a
+name exists in both layouts as two different files.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import sys
+import time
+
+from storage import LAYOUTS, LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+def _move(source, target):
+    """Link source at target, then drop source; returns 'moved', 'done' or 'conflict'."""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        if not os.path.samefile(source, target):
+            return 'conflict'
+        # Linked by an earlier run that stopped before the unlink
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK):
+            raise
+        # No hard links here: a rename is atomic too, just not overlapping
+        if os.path.exists(target):
+            return 'conflict'
+        os.rename(source, target)
+        return 'moved'
+    try:
+        os.unlink(source)
+    except FileNotFoundError:
+        return 'done'
+    return 'moved'
+
+
+def _remove_empty_shards(storage):
+    for shard in storage.shard_dirs():
+        try:
+            os.rmdir(shard)
+        except OSError:
+            pass
+    try:
+        os.rmdir(storage.shards_root)
+    except OSError:
+        pass
+
+
+def migrate(directory, layout, batch=1000, pause=0.0, dry_run=False):
+    """Move every file not yet in `layout`; returns {'moved', 'conflicts', 'errors'}.
+
+    Sleeps `pause` seconds after every `batch` files to leave I/O for the
+    servers.
+    """
+    storage = LocalStorage(directory, layout)
+    if layout == 'sharded':
+        sources = ((entry.name, entry.path) for entry in os.scandir(storage.directory)
+                   if not entry.name.startswith('.') and entry.is_file())
+    else:
+        sources = ((entry.name, entry.path) for shard in storage.shard_dirs() for entry in os.scandir(shard)
+                   if not entry.name.startswith('.') and entry.is_file())
+
+    counts = {'moved': 0, 'conflicts': 0, 'errors': 0}
+    for name, source in list(sources):
+        if dry_run:
+            counts['moved'] += 1
+            continue
+        try:
+            outcome = _move(source, storage.prepare(name))
+        except FileNotFoundError:
+            # Deleted or moved by someone else meanwhile
+            continue
+        except OSError as e:
+            logger.error('Could not move %s: %s', name, e)
+            counts['errors'] += 1
+            continue
+        if outcome == 'conflict':
+            logger.error('%s exists in both layouts as different files; left in place', name)
+            counts['conflicts'] += 1
+            continue
+        counts['moved'] += 1
+        if batch and counts['moved'] % batch == 0:
+            logger.info('Moved %d files', counts['moved'])
+            if pause:
+                time.sleep(pause)
+
+    if dry_run:
+        return counts
+    if layout == 'sharded':
+        # Other processes' in-memory indexes notice the move by the directory mtime
+        storage.touch()
+    else:
+        _remove_empty_shards(storage)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files-dir', default=os.environ.get('FILES_DIRECTORY') or './files',
+                        help='files directory (default: FILES_DIRECTORY or ./files)')
+    parser.add_argument('--to', choices=LAYOUTS, required=True, help='target layout')
+    parser.add_argument('--batch', type=int, default=1000, help='files between pauses')
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep after each batch')
+    parser.add_argument('--dry-run', action='store_true', help='only count the files that would move')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s')
+    counts = migrate(args.files_dir, args.to, args.batch, args.pause, args.dry_run)
+    verb = 'Would move' if args.dry_run else 'Moved'
+    logger.info('%s %d files to the %s layout (%d conflicts, %d errors)',
+                verb, counts['moved'], args.to, counts['conflicts'], counts['errors'])
+    sys.exit(1 if counts['conflicts'] or counts['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
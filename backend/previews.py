@@ -0,0 +1,370 @@
+"""
+Thumbnails for images and the first page of PDFs.
+
+Rendering runs in a small process pool so decoding a large image never
+holds the GIL of a request thread, and a bounded number of renders can
+be queued at once. Results live in an on-disk cache under
+.thumbnails/<aa>/<key>.jpg, keyed by content hash and thumbnail size, so
+a changed file gets a fresh thumbnail and identical files share one,
+whenever they were uploaded. The
+cache is least-recently-used: hits touch their file, and once the cache
+grows past its limit the oldest thumbnails are removed.
+
+Images are rendered with Pillow and PDFs with PyMuPDF, both listed in
+requirements.txt; types without an installed renderer are reported as
+unavailable. Files in remote
+storage are copied next to the cache for their render, and keyed by
+their ETag instead of a content hash.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+from compression import open_stored
+from storage import is_local
+
+CACHE_DIRNAME = '.thumbnails'
+
+IMAGE_TYPES = frozenset({'.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'})
+DOCUMENT_TYPES = frozenset({'.pdf'})
+
+THUMBNAIL_SIZES = (128, 256, 512)
+DEFAULT_SIZE = 256
+JPEG_QUALITY = 85
+
+# Once over the limit, evict down to this share of it so eviction isn't run on every render
+EVICT_TO = 0.9
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+MAX_REMEMBERED = 65536
+MAX_FAILURES = 4096
+
+
+class PreviewError(Exception):
+    """A thumbnail that can't be served, with an error code and HTTP status."""
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def preview_kind(name):
+    """'image' or 'document' for a previewable filename, else None."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_TYPES:
+        return 'image'
+    if extension in DOCUMENT_TYPES:
+        return 'document'
+    return None
+
+
+def renderer_available(kind):
+    """Whether the package that renders this kind of file is installed."""
+    if kind == 'image':
+        return Image is not None
+    return kind == 'document' and fitz is not None
+
+
+def _hash_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _remember_hash(st, digest):
+    with _hashes_lock:
+        if len(_hashes) >= MAX_REMEMBERED:
+            _hashes.clear()
+        _hashes[_hash_key(st)] = digest
+    return digest
+
+
+def content_hash(file_path, st):
+    """SHA-256 of a file's content, remembered by inode, size and mtime."""
+    try:
+        return _hashes[_hash_key(st)]
+    except KeyError:
+        pass
+    digest = hashlib.sha256()
+    f, _ = open_stored(file_path)
+    with f:
+        for data in iter(f.read, b''):
+            digest.update(data)
+    return _remember_hash(st, digest.hexdigest())
+
+
+def _render_image(source, dest, size):
+    with Image.open(source) as image:
+        # Decode at a fraction of full size where the format allows it
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(dest, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+
+
+def _render_document(source, dest, size):
+    with fitz.open(source) as document:
+        page = document[0]
+        zoom = size / max(page.rect.width, page.rect.height)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        if Image is not None:
+            Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples).save(
+                dest, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        else:
+            pixmap.save(dest, output='jpg', jpg_quality=JPEG_QUALITY)
+
+
+def render_thumbnail(source, dest, size, kind):
+    """Write a JPEG thumbnail of source, at most size pixels on each side, to dest.
+
+    Runs in a pool process.
+    """
+    if kind == 'image':
+        _render_image(source, dest, size)
+    else:
+        _render_document(source, dest, size)
+
+
+class ThumbnailCache:
+    """Size-limited on-disk LRU cache of rendered thumbnails."""
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None
+
+    def path_for(self, key):
+        return self.root / key[:2] / f'{key}.jpg'
+
+    def get(self, key):
+        """Path of a cached thumbnail, marked as just used, or None."""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temp_path(self, key, prefix='.render-', suffix='.jpg'):
+        """A fresh temp file next to where key's thumbnail goes."""
+        directory = self.path_for(key).parent
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def commit(self, key, temp_path):
+        """Move a rendered temp file into place and evict if the cache is over its limit."""
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._total is None:
+                self._total = self.size()
+            else:
+                self._total += path.stat().st_size
+            if self._total > self.max_bytes:
+                self._total = self.evict(int(self.max_bytes * EVICT_TO))
+        return path
+
+    def _entries(self):
+        if not self.root.is_dir():
+            return
+        for fanout in os.scandir(self.root):
+            if not fanout.is_dir():
+                continue
+            for entry in os.scandir(fanout.path):
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    yield entry.path, entry.stat()
+                except FileNotFoundError:
+                    continue
+
+    def size(self):
+        """Bytes currently held by cached thumbnails."""
+        return sum(st.st_size for _, st in self._entries())
+
+    def evict(self, target):
+        """Remove least recently used thumbnails until at most target bytes remain; returns the total."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime_ns)
+        total = sum(st.st_size for _, st in entries)
+        for path, st in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= st.st_size
+        return total
+
+
+class Previewer:
+    """Serve thumbnails from the cache, rendering misses on a bounded process pool."""
+
+    def __init__(self, cache_dir, max_bytes, workers, max_pending):
+        self.cache = ThumbnailCache(cache_dir, max_bytes)
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = {}
+        self._hashing = {}
+        self._failed = set()
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: forking a process that runs request threads can copy held locks
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _content_hash(self, file_path, st, timeout):
+        """content_hash(), computed in the render pool so a large file doesn't tie up a request thread."""
+        key = _hash_key(st)
+        digest = _hashes.get(key)
+        if digest is not None:
+            return digest
+        with self._lock:
+            future = self._hashing.get(key)
+            if future is None:
+                future = self._hashing[key] = self._executor().submit(content_hash, str(file_path), st)
+                future.add_done_callback(lambda done: self._hashing.pop(key, None))
+        try:
+            return _remember_hash(st, future.result(timeout))
+        except FutureTimeoutError:
+            raise PreviewError('PREVIEW_PENDING', 'The thumbnail is still being rendered', 503)
+
+    def cache_key(self, file_path, size, known_hash=None, timeout=None):
+        """Key of a file's thumbnail: content hash and thumbnail size.
+
+        The mtime is left out, since the hash already follows the content:
+        it is recomputed whenever the mtime changes.
+        """
+        if not is_local(file_path):
+            # An object's ETag already identifies its content
+            return f'{known_hash or hashlib.sha256(file_path.stat().etag.encode()).hexdigest()}-{size}'
+        st = os.stat(file_path)
+        digest = known_hash or self._content_hash(file_path, st, timeout)
+        return f'{digest}-{size}'
+
+    def _finish(self, key, temp_path, render, future, staged=None):
+        if staged is not None:
+            os.unlink(staged)
+        failed = future.exception() is not None
+        if not failed:
+            try:
+                self.cache.commit(key, temp_path)
+            except OSError:
+                failed = True
+        if failed:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._pending.pop(key, None)
+            if failed:
+                if len(self._failed) >= MAX_FAILURES:
+                    self._failed.clear()
+                self._failed.add(key)
+        # Set only once the thumbnail is in place, which future.result() doesn't promise
+        render.set()
+
+    def _submit(self, file_path, key, size, kind):
+        """An Event set when key's render is over, starting the render if it isn't already running."""
+        with self._lock:
+            if key in self._failed:
+                raise PreviewError('PREVIEW_FAILED', 'The file could not be rendered', 422)
+            render = self._pending.get(key)
+            if render is not None:
+                return render
+            if len(self._pending) >= self.max_pending:
+                raise PreviewError('PREVIEW_BUSY', 'Too many thumbnails are being rendered', 503)
+            temp_path = self.cache.temp_path(key)
+            render = self._pending[key] = threading.Event()
+        staged = None
+        try:
+            if not is_local(file_path):
+                # Renderers read local files; the copy goes once the render is over
+                staged = self.cache.temp_path(key, '.source-', file_path.suffix)
+                file_path.download(staged)
+            future = self._executor().submit(render_thumbnail, staged or str(file_path), temp_path, size, kind)
+        except BaseException:
+            # Not remembered as failed: fetching the copy may well work next time
+            for path in (temp_path, staged):
+                if path is not None and os.path.exists(path):
+                    os.unlink(path)
+            with self._lock:
+                self._pending.pop(key, None)
+            render.set()
+            raise
+        future.add_done_callback(lambda done: self._finish(key, temp_path, render, done, staged))
+        return render
+
+    def thumbnail(self, file_path, size=DEFAULT_SIZE, known_hash=None, timeout=None):
+        """Return (path, cache key) of a file's thumbnail, rendering it first if needed.
+
+        Raises PreviewError when the type isn't previewable, its renderer
+        isn't installed, rendering failed, or it didn't finish in time.
+        """
+        kind = preview_kind(Path(file_path).name if is_local(file_path) else file_path.name)
+        if kind is None:
+            raise PreviewError('PREVIEW_UNSUPPORTED', 'No preview for this file type', 415)
+        if not renderer_available(kind):
+            raise PreviewError('PREVIEW_UNAVAILABLE', f'No renderer is installed for {kind} previews', 501)
+        key = self.cache_key(file_path, size, known_hash, timeout)
+        path = self.cache.get(key)
+        if path is not None:
+            return path, key
+        if not self._submit(file_path, key, size, kind).wait(timeout):
+            raise PreviewError('PREVIEW_PENDING', 'The thumbnail is still being rendered', 503)
+        path = self.cache.get(key)
+        if path is None:
+            raise PreviewError('PREVIEW_FAILED', 'The file could not be rendered', 422)
+        return path, key
+
+    def shutdown(self):
+        """Stop the render processes; queued renders are dropped."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+_previewers = {}
+_previewers_lock = threading.Lock()
+
+
+def get_previewer(files_dir, max_bytes, workers, max_pending):
+    """Get the shared previewer for a files directory."""
+    key = os.path.realpath(files_dir)
+    with _previewers_lock:
+        previewer = _previewers.get(key)
+        if previewer is None:
+            previewer = _previewers[key] = Previewer(Path(files_dir) / CACHE_DIRNAME, max_bytes, workers, max_pending)
+        return previewer
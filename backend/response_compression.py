@@ -0,0 +1,80 @@
+"""
+Negotiated compression of JSON API responses.
+
+Bodies above a size threshold are compressed with the best encoding the
+client accepts: zstd or brotli when their optional packages are
+installed, otherwise gzip. Levels favour speed, because listings are
+rebuilt on every request and never precompressed.
+"""
+
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+
+
+def available_encodings():
+    """Encodings this process can produce, most preferred first."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def negotiate_encoding(accept_encodings, encodings=None):
+    """Pick the encoding the client rates highest; ties go to our preference order."""
+    best, best_quality = None, 0
+    for encoding in encodings or available_encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return zlib.compress(data, GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+
+
+def install_response_compression(app, min_size):
+    """Compress JSON responses of at least min_size bytes for clients that accept it."""
+    encodings = available_encodings()
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough
+                or response.is_streamed or not 200 <= response.status_code < 300
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        encoding = negotiate_encoding(request.accept_encodings, encodings)
+        if encoding is not None:
+            response.set_data(compress(data, encoding))
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return compress_response
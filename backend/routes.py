@@ -2,28 +2,177 @@
 Simplified route handlers for the Flask application.
 """
 
-from flask import Blueprint, jsonify, send_file, request, current_app
+from flask import Blueprint, Response, jsonify, request, current_app, send_file
 from datetime import datetime
 from pathlib import Path
+import hashlib
+import hmac
 import os
+import tempfile
 
+import chunked_upload
+from archives import ARCHIVE_FORMATS, tar_stream, zip_stream
+from batch_upload import stream_batch_upload
+from bulk_delete import delete_failure, delete_files
+from catalog import get_catalog
+from changes import CHANGES_FILENAME, ChangeFeedError, get_change_feed, long_poll_body, parse_seq
+from compression import is_compressible, resolve_codec
+from content_store import get_store
+from downloads import content_disposition, file_response
+from file_index import ListingFilter, decode_cursor, encode_cursor, get_index
+from jobs import JOBS_FILENAME, get_job_queue
+from metrics import ERRORS, PROFILES_DIRNAME, list_profiles, metrics_dir, render, sample_rate, set_sample_rate
+from previews import DEFAULT_SIZE, THUMBNAIL_SIZES, PreviewError, get_previewer, preview_kind, renderer_available
+from storage import get_storage, is_local, s3_options
+from streaming_upload import UploadError, place_file, stream_single_upload
 from utils import format_file_size, get_file_info, is_safe_filename, sanitize_filename
 
 bp = Blueprint('api', __name__)
 
+# Event streams must reach the client as they are written, not when a proxy's buffer fills
+EVENT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
 
 def get_files_dir():
     """Get files directory path."""
     return Path(current_app.config['FILES_DIRECTORY'])
 
 
+def get_file_storage():
+    """Get the storage backend (local in the flat or sharded layout, or S3) for the files directory."""
+    config = current_app.config
+    options = s3_options(config) if config['STORAGE_BACKEND'] == 's3' else None
+    return get_storage(get_files_dir(), config['STORAGE_LAYOUT'], config['STORAGE_BACKEND'], options)
+
+
+def prepare_files_dir():
+    """Create the files directory if needed and apply the storage layout; returns its path."""
+    files_dir = get_files_dir()
+    files_dir.mkdir(parents=True, exist_ok=True)
+    get_file_storage()
+    return files_dir
+
+
+def get_file_index():
+    """Get the listing index (memory or SQLite catalog) for the files directory."""
+    # The index scans whichever backend is configured, so set that up first
+    get_file_storage()
+    if current_app.config['LISTING_BACKEND'] == 'sqlite':
+        index = get_catalog(get_files_dir(), current_app.config['CATALOG_PATH'])
+    else:
+        index = get_index(get_files_dir())
+    feed = get_changes()
+    if feed is not None and index.feed is not feed:
+        index.attach_feed(feed)
+    return index
+
+
+def get_changes():
+    """Get the change feed shared by every worker, or None when it is disabled."""
+    config = current_app.config
+    if not config['CHANGE_FEED']:
+        return None
+    return get_change_feed(config['CHANGES_PATH'] or get_files_dir() / CHANGES_FILENAME,
+                           config['CHANGE_FEED_RETENTION'])
+
+
+def change_feed_request():
+    """Read a GET /api/changes request as (feed, seq, stream, wait).
+
+    seq is the last sequence number the client saw, from ?since= or an
+    EventSource's Last-Event-ID header, or None to start from now. stream
+    is whether the client asked for text/event-stream rather than JSON.
+    """
+    feed = get_changes()
+    if feed is None:
+        raise ChangeFeedError('CHANGE_FEED_DISABLED', 'The change feed is disabled', 404)
+    
+    raw = request.args.get('since', request.headers.get('Last-Event-ID'))
+    seq = parse_seq(raw)
+    if raw not in (None, '') and seq is None:
+        raise ChangeFeedError('INVALID_SEQUENCE', 'since must be a non-negative integer')
+    
+    limit = current_app.config['CHANGE_FEED_WAIT']
+    try:
+        wait = float(request.args.get('wait', limit))
+    except ValueError:
+        raise ChangeFeedError('INVALID_WAIT', 'wait must be a number of seconds')
+    if not wait >= 0:
+        raise ChangeFeedError('INVALID_WAIT', 'wait must be a number of seconds')
+    
+    stream = request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+    return feed, seq, stream, min(wait, limit)
+
+
+def get_content_store():
+    """Get the deduplicating content store, or None when it is disabled."""
+    # Deduplication works by hard links, so it needs local storage
+    if not current_app.config['CONTENT_ADDRESSED_STORAGE'] or not get_file_storage().local:
+        return None
+    return get_store(get_files_dir())
+
+
+def get_compression():
+    """Codec for compressing uploads at rest, or None when storage compression is off."""
+    if not get_file_storage().local:
+        return None
+    return resolve_codec(current_app.config['STORAGE_COMPRESSION'])
+
+
+def get_file_previewer():
+    """Get the thumbnail renderer and cache for the files directory."""
+    return get_previewer(get_files_dir(), current_app.config['PREVIEW_CACHE_SIZE'],
+                         current_app.config['PREVIEW_WORKERS'], current_app.config['PREVIEW_QUEUE_SIZE'])
+
+
+def job_queue_args():
+    """Arguments for get_job_queue() from the app config."""
+    return (current_app.config['JOBS_PATH'] or get_files_dir() / JOBS_FILENAME,
+            current_app.config['JOBS_MAX_ATTEMPTS'], current_app.config['JOBS_RETRY_DELAY'])
+
+
+def get_jobs():
+    """Get the persistent background job queue."""
+    return get_job_queue(*job_queue_args())
+
+
+def upload_recorder(index):
+    """Callback for a saved upload: index it and queue its background jobs.
+
+    Returns the file's metadata with the ids of the queued jobs under
+    'jobs'. Safe to call from threads outside the request.
+    """
+    # The queue is opened on first use, so uploads that queue nothing don't create it
+    queue_args = job_queue_args() if current_app.config['PREVIEW_ON_UPLOAD'] else None
+    
+    def record(file_path, content_hash=None):
+        info = index.add(file_path, content_hash)
+        if info is None:
+            return None
+        name = info['name']
+        queued = []
+        kind = preview_kind(name)
+        if queue_args is not None and kind and renderer_available(kind):
+            job = {'name': name, 'content_hash': content_hash}
+            queued.append(get_job_queue(*queue_args).enqueue('thumbnail', job))
+        # A copy: the index may hold on to info itself
+        return dict(info, jobs=queued)
+    
+    return record
+
+
 def validate_file_path(filename):
     """Validate and return safe file path."""
     if not is_safe_filename(filename):
         return None
     
     safe_name = sanitize_filename(filename)
-    file_path = get_files_dir() / safe_name
+    file_path = get_file_storage().resolve(safe_name)
+    if not is_local(file_path):
+        # An object key is the name itself; there is no directory to escape
+        return file_path
     
     try:
         # Ensure path is within files directory
@@ -36,9 +185,37 @@ def validate_file_path(filename):
 
 def error_response(code, message):
     """Create standardized error response."""
+    ERRORS.inc(code=code)
     return jsonify({'error': {'code': code, 'message': message}})
 
 
+def listing_etag(index):
+    """Weak ETag for a listing request: the index version plus the query, or None."""
+    if 'older_than' in request.args:
+        # Relative to now, so the same query selects different files over time
+        return None
+    version = index.version()
+    if version is None:
+        return None
+    state = f"{version}|{request.path}|{request.query_string.decode('latin-1')}"
+    return hashlib.blake2b(state.encode(), digest_size=12).hexdigest()
+
+
+def not_modified_listing(etag):
+    """A 304 if the client already holds this listing state, else None."""
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    return tag_listing(current_app.response_class(status=304), etag)
+
+
+def tag_listing(response, etag):
+    """Mark a listing response for revalidation against its ETag."""
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @bp.route('/api/files', methods=['GET'])
 def list_files():
     """Get list of files with basic filtering and pagination."""
@@ -49,6 +226,7 @@ def list_files():
         search = request.args.get('search', '').lower()
         sort_by = request.args.get('sort_by', 'name')
         sort_order = request.args.get('sort_order', 'asc')
+        cursor = request.args.get('cursor')
         
         # Validate parameters
         if page < 1 or per_page < 1 or per_page > 100:
@@ -60,56 +238,137 @@ def list_files():
         if sort_order not in ['asc', 'desc']:
             return error_response('INVALID_SORT_ORDER', 'Invalid sort order'), 400
         
+        try:
+            filters = ListingFilter.from_args(request.args)
+        except ValueError:
+            return error_response('INVALID_FILTER', 'Invalid filter parameters'), 400
+        
         # Get files directory
         files_dir = get_files_dir()
         if not files_dir.exists():
             return jsonify({'files': [], 'pagination': {'total_files': 0, 'page': 1, 'total_pages': 1, 'per_page': per_page}}), 200
         
-        # Collect files
-        files = []
-        for file_path in files_dir.iterdir():
-            if file_path.is_file() and not file_path.name.startswith('.'):
-                file_info = get_file_info(file_path)
-                if file_info:
-                    files.append(file_info)
-        
-        # Apply search filter
-        if search:
-            files = [f for f in files if search in f['name'].lower()]
-        
-        # Sort files
-        reverse = sort_order == 'desc'
-        if sort_by == 'name':
-            files.sort(key=lambda x: x['name'].lower(), reverse=reverse)
-        elif sort_by == 'size':
-            files.sort(key=lambda x: x['size'], reverse=reverse)
-        elif sort_by == 'modified':
-            files.sort(key=lambda x: x['last_modified'], reverse=reverse)
-        elif sort_by == 'type':
-            files.sort(key=lambda x: x['type'].lower(), reverse=reverse)
-        
-        # Paginate
-        total = len(files)
-        pages = (total + per_page - 1) // per_page
+        index = get_file_index()
+        etag = listing_etag(index)
+        cached = not_modified_listing(etag)
+        if cached is not None:
+            return cached
+        
+        # Keyset mode: continue from the position encoded in the cursor
+        if cursor is not None:
+            after = None
+            if cursor:
+                decoded = decode_cursor(cursor)
+                if not decoded or decoded[:2] != (sort_by, sort_order):
+                    return error_response('INVALID_CURSOR', 'Invalid or mismatched cursor'), 400
+                after = decoded[2]
+            
+            total, files, next_key = index.page_after(sort_by, sort_order, after, per_page, search, filters)
+            return tag_listing(jsonify({'files': files,
+                'pagination': {
+                    'total_files': total,
+                    'per_page': per_page,
+                    'next_cursor': encode_cursor(sort_by, sort_order, next_key) if next_key else None
+                }
+            }), etag), 200
+        
+        # Read one page from the index
         start = (page - 1) * per_page
-        end = start + per_page
+        total, files = index.page(sort_by, sort_order, start, per_page, search, filters)
+        pages = (total + per_page - 1) // per_page
         
-        return jsonify({'files': files[start:end],
+        return tag_listing(jsonify({'files': files,
             'pagination': {
                 'total_files': total,
                 'page': page,
                 'total_pages': pages,
                 'per_page': per_page
             }
-        }), 200
+        }), etag), 200
         
     except:
         return error_response('INTERNAL_ERROR', 'Failed to list files'), 500
 
 
+@bp.route('/api/files/facets', methods=['GET'])
+def file_facets():
+    """Count files per type and per month, with the same filters as the listing."""
+    try:
+        search = request.args.get('search', '').lower()
+        try:
+            filters = ListingFilter.from_args(request.args)
+        except ValueError:
+            return error_response('INVALID_FILTER', 'Invalid filter parameters'), 400
+        
+        if not get_files_dir().exists():
+            return jsonify({'total_files': 0, 'types': {}, 'months': {}}), 200
+        
+        index = get_file_index()
+        etag = listing_etag(index)
+        cached = not_modified_listing(etag)
+        if cached is not None:
+            return cached
+        
+        return tag_listing(jsonify(index.facets(search, filters)), etag), 200
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to count files'), 500
+
+
+@bp.route('/api/files/search', methods=['GET'])
+def search_files():
+    """Ranked filename search with prefix, substring and typo-tolerant matches."""
+    try:
+        query = request.args.get('q', '').strip()
+        limit = int(request.args.get('limit', 20))
+        fuzzy = request.args.get('fuzzy', 'true').lower() not in ('0', 'false', 'no')
+        
+        if limit < 1 or limit > 100:
+            return error_response('INVALID_PAGINATION', 'Invalid pagination parameters'), 400
+        
+        if not query or not get_files_dir().exists():
+            return jsonify({'results': [], 'total_matches': 0}), 200
+        
+        index = get_file_index()
+        etag = listing_etag(index)
+        cached = not_modified_listing(etag)
+        if cached is not None:
+            return cached
+        
+        total, results = index.search(query, limit, fuzzy)
+        return tag_listing(jsonify({'results': results, 'total_matches': total}), etag), 200
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to search files'), 500
+
+
+def stream_upload():
+    """Upload a file by streaming the request body straight to disk."""
+    try:
+        files_dir = prepare_files_dir()
+        record = upload_recorder(get_file_index())
+        
+        file_path, content_hash = stream_single_upload(request.stream, request.content_type, request.content_length,
+                                         files_dir, current_app.config['MAX_FILE_SIZE'], get_content_store(),
+                                         get_compression())
+        
+        return jsonify({
+            'message': 'File uploaded successfully',
+            'file': record(file_path, content_hash)
+        }), 201
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to upload file'), 500
+
+
 @bp.route('/api/files', methods=['POST'])
 def upload_file():
     """Upload a file."""
+    if current_app.config['STREAMING_UPLOADS']:
+        return stream_upload()
+    
     try:
         if 'file' not in request.files:
             return error_response('NO_FILE_PART', 'No file part in the request'), 400
@@ -122,13 +381,13 @@ def upload_file():
             return error_response('INVALID_FILENAME', 'Invalid filename'), 400
         
         safe_name = sanitize_filename(file.filename)
-        files_dir = get_files_dir()
-        files_dir.mkdir(parents=True, exist_ok=True)
-        
-        file_path = files_dir / safe_name
+        files_dir = prepare_files_dir()
+        storage = get_file_storage()
+        index = get_file_index()
         
-        if file_path.exists():
+        if storage.locate(safe_name):
             return error_response('FILE_EXISTS', 'File already exists'), 409
+        file_path = storage.prepare(safe_name)
         
         # Check file size
         file.seek(0, os.SEEK_END)
@@ -139,17 +398,173 @@ def upload_file():
         if size > max_size:
             return error_response('FILE_TOO_LARGE', f'File size exceeds maximum allowed size of {format_file_size(max_size)}'), 400
         
-        file.save(file_path)
+        compression = get_compression()
+        if (compression and is_compressible(safe_name)) or not storage.local:
+            fd, temp_path = tempfile.mkstemp(dir=files_dir, prefix='.upload-', suffix='.part')
+            os.close(fd)
+            file.save(temp_path)
+            place_file(temp_path, file_path, compression=compression)
+        else:
+            file.save(file_path)
         
         return jsonify({
             'message': 'File uploaded successfully',
-            'file': get_file_info(file_path)
+            'file': upload_recorder(index)(file_path)
         }), 201
         
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
     except:
         return error_response('UPLOAD_ERROR', 'Failed to upload file'), 500
 
 
+def batch_upload_response(results):
+    """201 with every per-file result, or 207 if any file failed."""
+    uploaded = sum(1 for result in results if result['status'] == 'uploaded')
+    return jsonify({
+        'results': results,
+        'summary': {'total': len(results), 'uploaded': uploaded, 'failed': len(results) - uploaded}
+    }), 201 if uploaded == len(results) else 207
+
+
+@bp.route('/api/files/batch', methods=['POST'])
+def upload_batch():
+    """Upload many files (parts named 'files') in one request; each succeeds or fails on its own."""
+    try:
+        files_dir = prepare_files_dir()
+        index = get_file_index()
+        
+        results = stream_batch_upload(request.stream, request.content_type, request.content_length, files_dir,
+                                      current_app.config['MAX_FILE_SIZE'], current_app.config['BATCH_UPLOAD_MAX_FILES'],
+                                      get_content_store(), upload_recorder(index), compression=get_compression())
+        return batch_upload_response(results)
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to upload files'), 500
+
+
+@bp.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable chunked upload."""
+    try:
+        body = request.get_json(silent=True) or {}
+        files_dir = prepare_files_dir()
+        chunked_upload.maybe_collect_expired(files_dir, current_app.config['UPLOAD_SESSION_TTL'])
+        
+        manifest = chunked_upload.create_session(
+            files_dir,
+            body.get('filename', ''),
+            body.get('size'),
+            current_app.config['MAX_FILE_SIZE'],
+            body.get('chunk_size', current_app.config['UPLOAD_CHUNK_SIZE']),
+            body.get('checksum'))
+        
+        return jsonify({
+            'upload_id': manifest['upload_id'],
+            'chunk_size': manifest['chunk_size'],
+            'total_chunks': manifest['total_chunks'],
+            'expires_at': manifest['created_at'] + current_app.config['UPLOAD_SESSION_TTL']
+        }), 201
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to start upload'), 500
+
+
+@bp.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Report which chunks of an upload have been received."""
+    try:
+        status = chunked_upload.session_status(get_files_dir(), upload_id, current_app.config['UPLOAD_SESSION_TTL'])
+        return jsonify(status), 200
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to read upload status'), 500
+
+
+@bp.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(upload_id, index):
+    """Receive one numbered chunk of an upload."""
+    try:
+        chunk = chunked_upload.write_chunk(get_files_dir(), upload_id, index, request.stream,
+                                           request.headers.get('X-Chunk-Checksum'),
+                                           current_app.config['UPLOAD_SESSION_TTL'])
+        return jsonify(chunk), 200
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to store chunk'), 500
+
+
+@bp.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """Assemble a fully received upload into the files directory."""
+    try:
+        record = upload_recorder(get_file_index())
+        file_path, content_hash = chunked_upload.finalize_session(prepare_files_dir(), upload_id, current_app.config['MAX_FILE_SIZE'],
+                                                    get_content_store(), get_compression(),
+                                                    current_app.config['UPLOAD_SESSION_TTL'])
+        
+        return jsonify({
+            'message': 'File uploaded successfully',
+            'file': record(file_path, content_hash)
+        }), 201
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to complete upload'), 500
+
+
+@bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Cancel an upload and discard its chunks."""
+    try:
+        chunked_upload.abort_session(get_files_dir(), upload_id)
+        return jsonify({'message': 'Upload cancelled'}), 200
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('UPLOAD_ERROR', 'Failed to cancel upload'), 500
+
+
+def selection_params():
+    """Names and listing query of a multi-file request, from the JSON body (POST) or query string (GET)."""
+    if request.method == 'GET':
+        return request.args.getlist('name'), request.args
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ValueError('Expected a JSON object')
+    names = body.get('names') or []
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError('names must be a list of filenames')
+    params = {key: value for key, value in body.items() if key != 'names' and value is not None}
+    if isinstance(params.get('types'), list):
+        params['types'] = ','.join(params['types'])
+    return names, {key: str(value) for key, value in params.items()}
+
+
+def matching_files(params, max_files, require_filter=False):
+    """Metadata of every file matching a listing query (search plus filters), by name."""
+    try:
+        filters = ListingFilter.from_args(params)
+    except ValueError:
+        raise UploadError('INVALID_FILTER', 'Invalid filter parameters')
+    search = params.get('search', '').lower()
+    if require_filter and not (search or filters):
+        raise UploadError('NO_FILTER', 'Give file names or at least one filter')
+    if not get_files_dir().exists():
+        return []
+    total, files = get_file_index().page('name', 'asc', 0, max_files, search, filters)
+    if total > max_files:
+        raise UploadError('TOO_MANY_FILES', f'A request may select at most {max_files} files ({total} match)')
+    return files
+
+
 @bp.route('/api/files/<path:filename>', methods=['DELETE'])
 def delete_file(filename):
     """Delete a file."""
@@ -161,8 +576,14 @@ def delete_file(filename):
         if not file_path.exists():
             return error_response('FILE_NOT_FOUND', 'File not found'), 404
         
+        index = get_file_index()
         file_info = get_file_info(file_path)
-        file_path.unlink()
+        store = get_content_store()
+        if store:
+            store.remove(file_path)
+        else:
+            file_path.unlink()
+        index.remove(file_path.name)
         
         return jsonify({
             'message': 'File deleted successfully',
@@ -173,6 +594,58 @@ def delete_file(filename):
         return error_response('DELETE_ERROR', 'Failed to delete file'), 500
 
 
+@bp.route('/api/files/bulk-delete', methods=['POST'])
+def bulk_delete():
+    """Delete the named files, or every file matching a filter; each succeeds or fails on its own."""
+    try:
+        try:
+            names, params = selection_params()
+        except ValueError:
+            return error_response('INVALID_REQUEST', 'Invalid delete request'), 400
+        dry_run = params.get('dry_run', 'false').lower() in ('1', 'true', 'yes')
+        
+        max_files = current_app.config['BULK_DELETE_MAX_FILES']
+        paths, failures = [], []
+        if names:
+            if len(names) > max_files:
+                return error_response('TOO_MANY_FILES', f'A request may select at most {max_files} files'), 400
+            for name in dict.fromkeys(names):
+                file_path = validate_file_path(name)
+                if file_path:
+                    paths.append(file_path)
+                else:
+                    failures.append(delete_failure(name, 'INVALID_FILENAME', 'Invalid filename'))
+        else:
+            storage = get_file_storage()
+            paths = [storage.resolve(info['name']) for info in matching_files(params, max_files, require_filter=True)]
+        
+        index = get_file_index()
+        deleted, errors = delete_files(paths, get_content_store(), dry_run)
+        failures.extend(errors)
+        if deleted and not dry_run:
+            # One listing update for the whole batch
+            index.remove_many(name for name, _ in deleted)
+        
+        result = {
+            'dry_run': dry_run,
+            'summary': {
+                'total': len(deleted) + len(failures),
+                'deleted': len(deleted),
+                'failed': len(failures),
+                'bytes_freed': sum(freed for _, freed in deleted)
+            },
+            'failures': failures
+        }
+        if dry_run:
+            result['files'] = [name for name, _ in deleted]
+        return jsonify(result), 207 if failures else 200
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('DELETE_ERROR', 'Failed to delete files'), 500
+
+
 @bp.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
     """Download a file."""
@@ -184,18 +657,232 @@ def download_file(filename):
         if not file_path.exists():
             return error_response('FILE_NOT_FOUND', 'File not found'), 404
         
-        return send_file(file_path, as_attachment=True, download_name=file_path.name)
+        return file_response(request, file_path, file_path.name,
+                             current_app.config['DOWNLOAD_CACHE_CONTROL'],
+                             current_app.config['DOWNLOAD_BACKEND'],
+                             current_app.config['DOWNLOAD_ACCEL_PREFIX'],
+                             file_path.relative_to(get_file_storage().directory) if is_local(file_path) else None)
         
     except:
         return error_response('DOWNLOAD_ERROR', 'Failed to download file'), 500
 
 
+@bp.route('/api/files/<path:filename>/thumbnail', methods=['GET'])
+def file_thumbnail(filename):
+    """Serve a JPEG thumbnail of an image or of a PDF's first page."""
+    try:
+        file_path = validate_file_path(filename)
+        if not file_path:
+            return error_response('INVALID_FILENAME', 'Invalid filename'), 400
+        
+        if not file_path.is_file():
+            return error_response('FILE_NOT_FOUND', 'File not found'), 404
+        
+        try:
+            size = int(request.args.get('size', DEFAULT_SIZE))
+        except ValueError:
+            size = None
+        if size not in THUMBNAIL_SIZES:
+            sizes = ', '.join(map(str, THUMBNAIL_SIZES))
+            return error_response('INVALID_SIZE', f'Thumbnail size must be one of {sizes}'), 400
+        
+        # Hashes already on record spare hashing the file for its cache key
+        store = get_content_store()
+        index = get_file_index()
+        known_hash = store.digest_of(file_path) if store else None
+        if known_hash is None:
+            known_hash = index.content_hash(file_path.name)
+        
+        path, key = get_file_previewer().thumbnail(file_path, size, known_hash,
+                                                   current_app.config['PREVIEW_TIMEOUT'])
+        response = send_file(path, mimetype='image/jpeg', etag=key, conditional=True)
+        if 'v' in request.args:
+            # The URL names one version of the file, so the thumbnail behind it never changes
+            response.headers['Cache-Control'] = f"public, max-age={current_app.config['PREVIEW_CACHE_MAX_AGE']}, immutable"
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+        
+    except PreviewError as e:
+        response = error_response(e.code, e.message)
+        if e.status == 503:
+            response.headers['Retry-After'] = '1'
+        return response, e.status
+    except:
+        return error_response('PREVIEW_ERROR', 'Failed to build thumbnail'), 500
+
+
+@bp.route('/api/files/archive', methods=['GET', 'POST'])
+def download_archive():
+    """Stream the named files, or every file matching a listing query, as one ZIP or tar archive."""
+    try:
+        try:
+            names, params = selection_params()
+        except ValueError:
+            return error_response('INVALID_REQUEST', 'Invalid archive request'), 400
+        
+        archive_format = params.get('format', 'zip')
+        if archive_format not in ARCHIVE_FORMATS:
+            return error_response('INVALID_FORMAT', 'Archive format must be zip or tar'), 400
+        
+        max_files = current_app.config['ARCHIVE_MAX_FILES']
+        if names:
+            if len(names) > max_files:
+                return error_response('TOO_MANY_FILES', f'An archive may contain at most {max_files} files'), 400
+            paths = []
+            for name in dict.fromkeys(names):
+                file_path = validate_file_path(name)
+                if not file_path:
+                    return error_response('INVALID_FILENAME', f'Invalid filename: {name}'), 400
+                if not file_path.is_file():
+                    return error_response('FILE_NOT_FOUND', f'File not found: {name}'), 404
+                paths.append(file_path)
+        else:
+            storage = get_file_storage()
+            paths = [storage.resolve(info['name']) for info in matching_files(params, max_files)]
+        
+        if not paths:
+            return error_response('FILE_NOT_FOUND', 'No files match'), 404
+        
+        body = zip_stream(paths) if archive_format == 'zip' else tar_stream(paths)
+        return Response(body, mimetype=ARCHIVE_FORMATS[archive_format], headers={
+            'Content-Disposition': content_disposition(f'files.{archive_format}'),
+            'Cache-Control': 'no-store',
+            'X-Archive-Files': str(len(paths)),
+        })
+        
+    except UploadError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('DOWNLOAD_ERROR', 'Failed to build archive'), 500
+
+
+@bp.route('/api/changes', methods=['GET'])
+def change_feed():
+    """File created, modified and deleted events after a sequence number, by long poll or event stream."""
+    try:
+        feed, seq, stream, wait = change_feed_request()
+        poll_interval = current_app.config['CHANGE_FEED_POLL_INTERVAL']
+        if stream:
+            return Response(feed.stream(seq, current_app.config['CHANGE_FEED_WAIT'], poll_interval),
+                            mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+        if seq is None:
+            # Nothing to wait for yet: just tell the client where to start
+            return jsonify(long_poll_body(feed.latest(), [], None)), 200
+        
+        events, reset = feed.wait(seq, wait, poll_interval)
+        return jsonify(long_poll_body(seq, events, reset)), 200
+        
+    except ChangeFeedError as e:
+        return error_response(e.code, e.message), e.status
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to read changes'), 500
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of a background job."""
+    try:
+        job = get_jobs().get(job_id)
+        if job is None:
+            return error_response('JOB_NOT_FOUND', 'Job not found'), 404
+        return jsonify(job), 200
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to get job'), 500
+
+
 @bp.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()}), 200
 
 
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, summed over every worker."""
+    if not current_app.config['METRICS_ENABLED']:
+        return error_response('METRICS_DISABLED', 'Metrics are disabled'), 404
+    try:
+        return Response(render(metrics_dir(current_app.config)), mimetype='text/plain; version=0.0.4')
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to collect metrics'), 500
+
+
+def profiling_refusal():
+    """Error response if this caller may not use the profiling routes, else None.
+
+    They can slow every worker down and expose code paths, so they are off
+    unless PROFILING_CONTROL_ENABLED, and then need PROFILING_TOKEN or, with
+    no token configured, a loopback client.
+    """
+    if not current_app.config['METRICS_ENABLED']:
+        return error_response('METRICS_DISABLED', 'Metrics are disabled'), 404
+    if not current_app.config['PROFILING_CONTROL_ENABLED']:
+        return error_response('PROFILING_DISABLED', 'Profiling control is disabled'), 404
+    token = current_app.config['PROFILING_TOKEN']
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            return error_response('FORBIDDEN', 'Profiling needs a valid token'), 403
+    elif request.remote_addr not in LOOPBACK_ADDRESSES:
+        return error_response('FORBIDDEN', 'Profiling is only available from this host'), 403
+    return None
+
+
+@bp.route('/api/profiling', methods=['GET'])
+def get_profiling():
+    """Current profiling sample rate and the saved profiles."""
+    refused = profiling_refusal()
+    if refused:
+        return refused
+    try:
+        directory = metrics_dir(current_app.config)
+        return jsonify({
+            'sample_rate': sample_rate(directory, current_app.config['PROFILE_SAMPLE_RATE']),
+            'profiles': list_profiles(directory)
+        }), 200
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to get profiling settings'), 500
+
+
+@bp.route('/api/profiling', methods=['PUT'])
+def update_profiling():
+    """Profile a fraction of requests in every worker, from now on."""
+    refused = profiling_refusal()
+    if refused:
+        return refused
+    try:
+        payload = request.get_json(silent=True) or {}
+        rate = payload.get('sample_rate')
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+            return error_response('INVALID_SAMPLE_RATE', 'sample_rate must be a number from 0 to 1'), 400
+        
+        set_sample_rate(metrics_dir(current_app.config), rate)
+        return jsonify({'sample_rate': rate}), 200
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to update profiling settings'), 500
+
+
+@bp.route('/api/profiling/<name>', methods=['GET'])
+def get_profile(name):
+    """Download one saved profile (pstats format)."""
+    refused = profiling_refusal()
+    if refused:
+        return refused
+    try:
+        directory = metrics_dir(current_app.config) / PROFILES_DIRNAME
+        if not name.endswith('.prof') or not is_safe_filename(name) or not (directory / name).is_file():
+            return error_response('PROFILE_NOT_FOUND', 'Profile not found'), 404
+        return send_file(directory / name, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=name)
+        
+    except:
+        return error_response('INTERNAL_ERROR', 'Failed to get profile'), 500
+
+
 # Error handlers
 @bp.app_errorhandler(404)
 def not_found(error):
@@ -0,0 +1,178 @@
+"""
+Trigram index over filenames for substring, prefix and fuzzy search.
+"""
+
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from itertools import islice
+
+GRAM = 3
+
+# Above this many substring matches only a bounded sample is scored for ranking
+SCORE_LIMIT = 5000
+
+# Trigrams this common say little about a typo'd query, so fuzzy search skips them
+FUZZY_POSTING_LIMIT = 20000
+FUZZY_CANDIDATES = 200
+
+WORD_SEPARATORS = ' _-.()[]'
+
+
+def trigrams(text):
+    """Distinct trigrams of a (lowercased) string."""
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def substring_distance(query, text):
+    """Smallest edit distance between query and any substring of text."""
+    # Sellers' algorithm: Levenshtein with a free start and end in text
+    previous = [0] * (len(text) + 1)
+    for i, qc in enumerate(query, 1):
+        current = [i] + [0] * len(text)
+        for j, tc in enumerate(text, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (qc != tc))
+        previous = current
+    return min(previous)
+
+
+def fuzzy_budget(query):
+    """How many typos a query of this length may contain."""
+    return 1 if len(query) <= 6 else 2
+
+
+def score_name(query, name, fuzzy=True):
+    """Return (score, match kind) for a name against a lowercased query, or None."""
+    lowered = name.lower()
+    length_bonus = 10 * len(query) / max(len(lowered), 1)
+    stem = lowered.rsplit('.', 1)[0]
+    if lowered == query or stem == query:
+        return 100.0, 'exact'
+    if lowered.startswith(query):
+        return 80 + length_bonus, 'prefix'
+    pos = lowered.find(query)
+    if pos >= 0:
+        if lowered[pos - 1] in WORD_SEPARATORS:
+            return 60 + length_bonus, 'word'
+        return 40 + length_bonus, 'substring'
+    if fuzzy and len(query) >= GRAM:
+        distance = substring_distance(query, lowered)
+        if distance <= fuzzy_budget(query):
+            return 20 - 5 * distance + length_bonus, 'fuzzy'
+    return None
+
+
+def rank_names(query, names, limit, fuzzy=True):
+    """Score candidate names and return the best as [{'name', 'score', 'match'}]."""
+    scored = []
+    for name in names:
+        result = score_name(query, name, fuzzy)
+        if result:
+            scored.append((result[0], name, result[1]))
+    best = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1].lower(), item[1]))
+    return [{'name': name, 'score': round(score, 2), 'match': kind} for score, name, kind in best]
+
+
+class NameSearchIndex:
+    """Incrementally maintained trigram postings plus a sorted name list."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = {}
+        self._names = {}
+        self._postings = defaultdict(set)
+        self._sorted = []
+        self._next_id = 0
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+            self._postings.clear()
+            self._sorted = []
+
+    def add(self, name):
+        with self._lock:
+            if name in self._ids:
+                return
+            doc_id = self._next_id
+            self._next_id += 1
+            self._ids[name] = doc_id
+            self._names[doc_id] = name
+            lowered = name.lower()
+            for gram in trigrams(lowered):
+                self._postings[gram].add(doc_id)
+            insort(self._sorted, (lowered, name))
+
+    def remove(self, name):
+        with self._lock:
+            doc_id = self._ids.pop(name, None)
+            if doc_id is None:
+                return
+            del self._names[doc_id]
+            lowered = name.lower()
+            for gram in trigrams(lowered):
+                posting = self._postings.get(gram)
+                if posting is not None:
+                    posting.discard(doc_id)
+                    if not posting:
+                        del self._postings[gram]
+            pos = bisect_left(self._sorted, (lowered, name))
+            if pos < len(self._sorted) and self._sorted[pos] == (lowered, name):
+                del self._sorted[pos]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def substring_matches(self, query):
+        """Names containing query, or None if the query is too short to index."""
+        if len(query) < GRAM:
+            return None
+        with self._lock:
+            postings = sorted((self._postings.get(gram, set()) for gram in trigrams(query)), key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                ids &= posting
+                if not ids:
+                    break
+            names = (self._names[doc_id] for doc_id in ids)
+            # Trigrams can co-occur without being contiguous, so confirm each hit
+            return {name for name in names if query in name.lower()}
+
+    def prefix_matches(self, query, limit):
+        """Up to limit names starting with query, in name order."""
+        with self._lock:
+            start = bisect_left(self._sorted, (query,))
+            return [name for lowered, name in islice(self._sorted, start, start + limit)
+                    if lowered.startswith(query)]
+
+    def prefix_count(self, query):
+        """How many names start with query."""
+        with self._lock:
+            return bisect_left(self._sorted, (query + '\U0010ffff',)) - bisect_left(self._sorted, (query,))
+
+    def fuzzy_candidates(self, query, limit=FUZZY_CANDIDATES):
+        """Names sharing the most selective trigrams with query."""
+        with self._lock:
+            counts = Counter()
+            for gram in trigrams(query):
+                posting = self._postings.get(gram)
+                if posting and len(posting) <= FUZZY_POSTING_LIMIT:
+                    counts.update(posting)
+            return [self._names[doc_id] for doc_id, _ in counts.most_common(limit)]
+
+    def search(self, query, limit=20, fuzzy=True):
+        """Ranked search; returns (total substring matches, results)."""
+        query = query.lower()
+        matches = self.substring_matches(query)
+        if matches is None:
+            # Only a bounded sample is ranked, but the total counts every match
+            candidates = self.prefix_matches(query, SCORE_LIMIT)
+            return self.prefix_count(query), rank_names(query, candidates, limit, False)
+
+        candidates = set(self.prefix_matches(query, limit))
+        candidates.update(islice(matches, SCORE_LIMIT))
+        if fuzzy and len(matches) < limit:
+            candidates.update(self.fuzzy_candidates(query))
+        return len(matches), rank_names(query, candidates, limit, fuzzy)
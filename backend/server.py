@@ -0,0 +1,376 @@
+"""
+Production launcher: pre-forked workers, each serving from a thread pool.
+
+The master builds the app and warms the listing index once, then forks
+SERVER_WORKERS workers that share it copy-on-write. Every worker binds
+its own SO_REUSEPORT socket, so the kernel spreads connections across
+them, and rate-limits its own requests. Files the app wraps with
+wsgi.file_wrapper (the sendfile download backend) are sent with
+sendfile(2), so their bytes never pass through Python.
+
+Signals to the master:
+    TERM, INT  stop accepting, finish in-flight requests, exit
+    HUP        zero-downtime reload: re-exec with fresh code and config,
+               start a new generation of workers, then drain the old one
+
+Usage:
+    python server.py --bind 0.0.0.0:5000 --workers 4 --threads 8
+"""
+
+import argparse
+import logging
+import math
+import os
+import select
+import signal
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import FileWrapper
+
+from config import config
+from file_watcher import stop_watchers
+from jobs import stop_job_workers
+from main import create_app
+from routes import error_response
+
+logger = logging.getLogger(__name__)
+
+# Set across a HUP re-exec: workers of the previous generation still to drain
+DRAINING_ENV = 'SERVER_DRAINING_WORKERS'
+READY_TIMEOUT = 30
+
+
+def cpu_count():
+    """CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class TokenBucket:
+    """Request rate limit with bursts, local to one worker process."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token; return 0 if allowed, else seconds until one frees up."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+def install_rate_limit(app, rate, burst):
+    """Answer 429 RATE_LIMITED once a worker exceeds rate requests/second."""
+    bucket = TokenBucket(rate, burst)
+
+    @app.before_request
+    def limit_rate():
+        if request.path in ('/health', '/metrics'):
+            return None
+        wait = bucket.take()
+        if wait:
+            response = error_response('RATE_LIMITED', 'Too many requests')
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response, 429
+        return None
+
+    return bucket
+
+
+class SendfileWrapper(FileWrapper):
+    """wsgi.file_wrapper that sends the rest of the file with sendfile(2).
+
+    Subclassed per connection with the handler to write to. The file is
+    sent from its current position, so a seek before wrapping selects the
+    start of a range.
+    """
+
+    handler = None
+
+    def __iter__(self):
+        try:
+            offset = self.file.tell()
+            self.file.fileno()
+        except (AttributeError, OSError):
+            offset = None
+        if offset is not None:
+            # Flushes the status line and headers
+            yield b''
+            if not self.handler.chunked:
+                self.handler.connection.sendfile(self.file, offset)
+                return
+        yield from iter(lambda: self.file.read(self.buffer_size), b'')
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    """Werkzeug's handler with an idle timeout, optional access log and sendfile."""
+
+    def setup(self):
+        self.timeout = self.server.keepalive
+        self.file_wrapper = type('ConnectionSendfileWrapper', (SendfileWrapper,), {'handler': self})
+        super().setup()
+
+    def make_environ(self):
+        self.chunked = False
+        environ = super().make_environ()
+        environ['wsgi.file_wrapper'] = self.file_wrapper
+        return environ
+
+    def send_header(self, keyword, value):
+        # A chunked body needs framing that sendfile can't add
+        if keyword.lower() == 'transfer-encoding':
+            self.chunked = True
+        super().send_header(keyword, value)
+
+    def log_request(self, code='-', size='-'):
+        if self.server.access_log:
+            super().log_request(code, size)
+
+
+class WorkerServer(BaseWSGIServer):
+    """HTTP/1.1 server handing connections to a fixed thread pool."""
+
+    multithread = True
+    multiprocess = True
+    allow_reuse_port = True
+
+    def __init__(self, host, port, app, threads, keepalive=5, access_log=False):
+        self.keepalive = keepalive
+        self.access_log = access_log
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self._master_pid = os.getppid()
+        self._stopping = False
+        super().__init__(host, port, app, handler=WorkerRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def stop(self):
+        """Stop accepting; safe to call from a signal handler."""
+        if not self._stopping:
+            self._stopping = True
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def service_actions(self):
+        # The master died without telling us
+        if os.getppid() != self._master_pid:
+            self.stop()
+
+    def _accept_backlog(self):
+        """Serve connections already queued on the socket; closing it would reset them."""
+        self.socket.setblocking(False)
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except OSError:
+                return
+            request.setblocking(True)
+            self.process_request(request, client_address)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            socketserver.BaseServer.serve_forever(self, poll_interval)
+            self._accept_backlog()
+        finally:
+            self.server_close()
+            self.pool.shutdown(wait=True)
+
+
+class Master:
+    """Forks, supervises and reloads the worker processes."""
+
+    def __init__(self, app, config_class, host, port, workers, threads, keepalive=5,
+                 graceful_timeout=30, access_log=False):
+        self.app = app
+        self.config_class = config_class
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.threads = threads
+        self.keepalive = keepalive
+        self.graceful_timeout = graceful_timeout
+        self.access_log = access_log
+        self.workers = {}
+        self.draining = {}
+        self._stopping = False
+        self._reloading = False
+
+    def spawn(self):
+        """Fork one worker and return (pid, readiness pipe)."""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 1
+            try:
+                self._run_worker(ready_w)
+                code = 0
+            except BaseException:
+                logger.exception('Worker %s crashed', os.getpid())
+            finally:
+                os._exit(code)
+        os.close(ready_w)
+        self.workers[pid] = time.monotonic()
+        return pid, ready_r
+
+    def _run_worker(self, ready_w):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # Watcher and job threads don't survive fork(); each worker runs its own
+        self.config_class.watch_files(self.app)
+        self.config_class.run_jobs(self.app)
+        server = WorkerServer(self.host, self.port, self.app, self.threads, self.keepalive, self.access_log)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        os.write(ready_w, b'1')
+        os.close(ready_w)
+        server.serve_forever()
+
+    def _wait_ready(self, pipes):
+        """Wait until every new worker is listening."""
+        deadline = time.monotonic() + READY_TIMEOUT
+        pending = list(pipes)
+        while pending and time.monotonic() < deadline:
+            readable, _, _ = select.select(pending, [], [], 0.5)
+            for fd in readable:
+                os.read(fd, 1)
+                os.close(fd)
+                pending.remove(fd)
+        for fd in pending:
+            os.close(fd)
+        return not pending
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.draining.pop(pid, None) is None and self.workers.pop(pid, None) is not None and not self._stopping:
+                logger.warning('Worker %s exited with status %s, replacing it', pid, status)
+
+    def _drain(self, pids):
+        """Ask workers to finish in-flight requests and exit."""
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.draining[pid] = deadline
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.draining.pop(pid)
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.draining.items()):
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def _reexec(self):
+        """Replace this process with a fresh master; current workers are drained by it."""
+        logger.info('Reloading')
+        env = dict(os.environ)
+        env[DRAINING_ENV] = ','.join(str(pid) for pid in list(self.workers) + list(self.draining))
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reloading = True
+        else:
+            self._stopping = True
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._on_signal)
+
+        pipes = [self.spawn()[1] for _ in range(self.size)]
+        if not self._wait_ready(pipes):
+            logger.warning('Some workers did not start within %ss', READY_TIMEOUT)
+        logger.info('Serving on %s:%s with %d workers x %d threads', self.host, self.port, self.size, self.threads)
+
+        # After a reload the previous generation is still serving; retire it now
+        previous = [int(pid) for pid in os.environ.pop(DRAINING_ENV, '').split(',') if pid]
+        self._drain(previous)
+
+        while not self._stopping:
+            if self._reloading:
+                self._reexec()
+            self._reap()
+            self._kill_overdue()
+            missing = self.size - len(self.workers)
+            if missing > 0:
+                self._wait_ready([self.spawn()[1] for _ in range(missing)])
+            time.sleep(0.2)
+
+        self._drain(list(self.workers))
+        while self.draining:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+
+
+def serve(config_name='production', host='0.0.0.0', port=5000, workers=None, threads=None, access_log=False):
+    """Preload the app, then run pre-forked workers until told to stop."""
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(process)d %(levelname)s %(message)s')
+    config_class = config[config_name]
+    app = create_app(config_name)
+    # No threads may be running across fork(); the workers start their own watchers and job workers
+    stop_watchers()
+    stop_job_workers()
+
+    rate = app.config['SERVER_RATE_LIMIT']
+    if rate > 0:
+        install_rate_limit(app, rate, app.config['SERVER_RATE_BURST'])
+
+    master = Master(app, config_class, host, port,
+                    workers or app.config['SERVER_WORKERS'] or cpu_count(),
+                    threads or app.config['SERVER_THREADS'],
+                    keepalive=app.config['SERVER_KEEPALIVE'],
+                    graceful_timeout=app.config['SERVER_GRACEFUL_TIMEOUT'],
+                    access_log=access_log)
+    master.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.environ.get('FLASK_ENV', 'production'))
+    parser.add_argument('--bind', default=f"0.0.0.0:{os.environ.get('PORT', 5000)}", help='host:port')
+    parser.add_argument('--workers', type=int, help='default: SERVER_WORKERS, else one per CPU')
+    parser.add_argument('--threads', type=int, help='default: SERVER_THREADS')
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+    host, _, port = args.bind.rpartition(':')
+    serve(args.config, host or '0.0.0.0', int(port), args.workers, args.threads, args.access_log)
+
+
+if __name__ == '__main__':
+    main()
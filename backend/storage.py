@@ -0,0 +1,191 @@
+"""
+Where files live inside the files directory: flat, or sharded by a hash prefix.
+
+With the flat layout every file sits directly in FILES_DIRECTORY. The
+sharded layout spreads files over up to 4096 fanout directories,
+.shards/<abc>/<name>, where abc is the start of a hash of the name, so no
+directory grows past a few hundred entries per million files.
+
+Lookups always try both places, canonical first, and listings cover
+both. A store can therefore switch layout while serving, and
+migrate_layout.py moves the existing files across in the background.
+
+A storage is also the backend the files live on. LocalStorage hands out
+pathlib.Path objects. S3Storage (s3_storage.py) hands out ObjectPaths,
+which have the same read, stat and unlink methods, so the routes work
+on either backend. Code that needs a real local file checks is_local().
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from s3_storage import S3Storage
+
+LAYOUTS = ('flat', 'sharded')
+BACKENDS = ('local', 's3')
+
+SHARDS_DIRNAME = '.shards'
+SHARD_CHARS = 3
+
+
+def shard_of(name):
+    """Fanout directory name for a filename."""
+    return hashlib.blake2b(os.fsencode(name), digest_size=8).hexdigest()[:SHARD_CHARS]
+
+
+def is_local(path):
+    """Whether a file handle is a local path rather than a remote object."""
+    return isinstance(path, (str, bytes, os.PathLike))
+
+
+def s3_options(config):
+    """S3Storage keyword arguments from the app config."""
+    return {
+        'endpoint_url': config['S3_ENDPOINT_URL'],
+        'bucket': config['S3_BUCKET'],
+        'prefix': config['S3_PREFIX'],
+        'region': config['S3_REGION'],
+        'access_key': config['S3_ACCESS_KEY_ID'],
+        'secret_key': config['S3_SECRET_ACCESS_KEY'],
+        'max_connections': config['S3_MAX_CONNECTIONS'],
+        'multipart_threshold': config['S3_MULTIPART_THRESHOLD'],
+        'multipart_chunk_size': config['S3_MULTIPART_CHUNK_SIZE'],
+        'multipart_concurrency': config['S3_MULTIPART_CONCURRENCY'],
+    }
+
+
+def _visible_files(directory):
+    """Yield DirEntry objects for the regular, non-hidden files in one directory."""
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+
+class LocalStorage:
+    """Name-to-path mapping for one files directory, in the flat or sharded layout."""
+
+    local = True
+
+    def __init__(self, directory, layout='flat'):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout '{layout}'")
+        self.directory = Path(directory)
+        self.layout = layout
+        self.shards_root = self.directory / SHARDS_DIRNAME
+
+    def flat_path(self, name):
+        return self.directory / name
+
+    def sharded_path(self, name):
+        return self.shards_root / shard_of(name) / name
+
+    def path_for(self, name):
+        """Where a new file of this name goes in the current layout."""
+        return self.sharded_path(name) if self.layout == 'sharded' else self.flat_path(name)
+
+    def _other_path(self, name):
+        return self.flat_path(name) if self.layout == 'sharded' else self.sharded_path(name)
+
+    def locate(self, name):
+        """Path of the existing file with this name in either layout, or None."""
+        canonical = self.path_for(name)
+        # Canonical again last: a migration moves files towards it, and
+        # may do so between the first two checks
+        for path in (canonical, self._other_path(name), canonical):
+            if path.is_file():
+                return path
+        return None
+
+    def resolve(self, name):
+        """Path of the file with this name: where it is, or where it would go."""
+        return self.locate(name) or self.path_for(name)
+
+    def prepare(self, name):
+        """Path for a new file of this name, with its directory created."""
+        path = self.path_for(name)
+        if path.parent != self.directory:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def has_shards(self):
+        return self.shards_root.is_dir()
+
+    def shard_dirs(self):
+        """Paths of the existing fanout directories."""
+        try:
+            with os.scandir(self.shards_root) as it:
+                return [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def scan(self):
+        """Yield a DirEntry for every visible file in either layout, one per name.
+
+        A file caught mid-migration in both places is reported once, at its
+        canonical path.
+        """
+        flat = _visible_files(self.directory)
+        sharded = (entry for shard in self.shard_dirs() for entry in _visible_files(shard))
+        first, second = (sharded, flat) if self.layout == 'sharded' else (flat, sharded)
+        seen = set()
+        for entry in first:
+            seen.add(entry.name)
+            yield entry
+        for entry in second:
+            if entry.name not in seen:
+                yield entry
+
+    def mtime(self):
+        """Change marker of the directory, or None if it doesn't exist."""
+        try:
+            return self.directory.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def touch(self):
+        """Bump the directory's mtime so other processes notice a change made inside a shard."""
+        if not self.has_shards():
+            return
+        try:
+            os.utime(self.directory)
+        except OSError:
+            pass
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(directory, layout=None, backend=None, options=None):
+    """Return the process-wide storage for a files directory.
+
+    Pass layout, or backend with its options, to set them; without them
+    the last ones set are kept (a flat local directory by default). With
+    the s3 backend the directory only holds per-server state.
+    """
+    key = os.path.realpath(directory)
+    with _storages_lock:
+        storage = _storages.get(key)
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError(f"Unknown storage backend '{backend}'")
+        if backend == 's3' and not isinstance(storage, S3Storage):
+            storage = _storages[key] = S3Storage(key, **(options or {}))
+        elif storage is None or (backend == 'local' and not storage.local):
+            storage = _storages[key] = LocalStorage(key, layout or 'flat')
+        elif layout is not None and layout != storage.layout and storage.local:
+            if layout not in LAYOUTS:
+                raise ValueError(f"Unknown storage layout '{layout}'")
+            # Changed in place, so holders of this storage follow along
+            storage.layout = layout
+        return storage
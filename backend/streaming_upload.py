@@ -0,0 +1,234 @@
+"""
+Streaming multipart upload handling.
+
+Parses the request body incrementally and writes file parts straight to a
+temp file in the target directory, so uploads are never spooled in full.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import NEED_DATA, Data, Epilogue, Field, File, MultipartDecoder
+
+from compression import compress_file, is_compressible
+from storage import get_storage, is_local
+from utils import format_file_size, is_safe_filename, sanitize_filename
+
+CHUNK_SIZE = 64 * 1024
+
+# Room for boundaries and part headers on top of the file bytes themselves
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+class UploadError(Exception):
+    """Upload failure that maps onto an error_response."""
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class Part:
+    """One part of a multipart body; its data must be read in order."""
+
+    def __init__(self, reader, name, filename):
+        self._reader = reader
+        self.name = name
+        self.filename = filename
+        self.done = False
+
+    def chunks(self):
+        """Yield the part's data as it arrives."""
+        while not self.done:
+            data, more = self._reader._next_data()
+            self.done = not more
+            if data:
+                yield data
+
+    def drain(self):
+        """Skip whatever is left of this part."""
+        for _ in self.chunks():
+            pass
+
+
+def multipart_decoder(content_type):
+    """Return a decoder for a multipart/form-data body with this Content-Type."""
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadError('NO_FILE_PART', 'No file part in the request')
+    return MultipartDecoder(boundary.encode())
+
+
+class MultipartReader:
+    """Pull-based reader over a multipart/form-data stream."""
+
+    def __init__(self, stream, content_type, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = multipart_decoder(content_type)
+        self._finished = False
+
+    def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if event is not NEED_DATA:
+                return event
+            if self._finished:
+                return None
+            chunk = self._stream.read(self._chunk_size)
+            if not chunk:
+                self._finished = True
+                self._decoder.receive_data(None)
+            else:
+                self._decoder.receive_data(chunk)
+
+    def _next_data(self):
+        event = self._next_event()
+        if not isinstance(event, Data):
+            raise UploadError('UPLOAD_ERROR', 'Malformed multipart body')
+        return event.data, event.more_data
+
+    def parts(self):
+        """Yield each Part; unread data is skipped when moving on."""
+        while True:
+            try:
+                event = self._next_event()
+            except ValueError:
+                raise UploadError('UPLOAD_ERROR', 'Malformed multipart body')
+            if event is None or isinstance(event, Epilogue):
+                return
+            if isinstance(event, (File, Field)):
+                part = Part(self, event.name, event.filename if isinstance(event, File) else None)
+                yield part
+                part.drain()
+
+
+def check_content_length(content_length, max_size):
+    """Reject a body that can't possibly fit before reading any of it."""
+    if content_length is not None and content_length > max_size + MULTIPART_OVERHEAD:
+        raise UploadError('FILE_TOO_LARGE', f'File size exceeds maximum allowed size of {format_file_size(max_size)}')
+
+
+def validate_upload_name(filename, files_dir):
+    """Check an upload's filename and return its target path in the storage layout."""
+    if filename == '':
+        raise UploadError('NO_SELECTED_FILE', 'No selected file')
+    if not is_safe_filename(filename):
+        raise UploadError('INVALID_FILENAME', 'Invalid filename')
+    storage = get_storage(files_dir)
+    name = sanitize_filename(filename)
+    if storage.locate(name) is not None:
+        raise UploadError('FILE_EXISTS', 'File already exists', 409)
+    return storage.prepare(name)
+
+
+class TempUpload:
+    """A hidden temp file in the target directory, filled chunk by chunk.
+
+    Aborts past max_size. If a hashlib object is given it is fed every
+    chunk on the way through.
+    """
+
+    def __init__(self, files_dir, max_size, digest=None):
+        fd, self.path = tempfile.mkstemp(dir=files_dir, prefix='.upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+        self._max_size = max_size
+        self._digest = digest
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self._max_size:
+            raise UploadError('FILE_TOO_LARGE', f'File size exceeds maximum allowed size of {format_file_size(self._max_size)}')
+        if self._digest is not None:
+            self._digest.update(chunk)
+        self._file.write(chunk)
+
+    def close(self):
+        """Finish writing and return (temp_path, size)."""
+        self._file.close()
+        return self.path, self.size
+
+    def abort(self):
+        """Discard the temp file."""
+        self._file.close()
+        os.unlink(self.path)
+
+
+def write_temp(chunks, files_dir, max_size, digest=None):
+    """Write chunks to a hidden temp file, aborting past max_size.
+
+    Returns (temp_path, size). The temp file is removed on failure.
+    """
+    upload = TempUpload(files_dir, max_size, digest)
+    try:
+        for chunk in chunks:
+            upload.write(chunk)
+    except BaseException:
+        upload.abort()
+        raise
+    return upload.close()
+
+
+def place_file(temp_path, file_path, store=None, digest=None, compression=None):
+    """Move a finished temp file into place without clobbering an existing one.
+
+    With a content store the file is deduplicated under its SHA-256 digest
+    (of the uploaded bytes). With a compression codec, compressible types
+    are stored compressed. A remote target is uploaded and the temp file
+    removed.
+    """
+    if not is_local(file_path):
+        try:
+            file_path.upload(temp_path)
+        except FileExistsError:
+            raise UploadError('FILE_EXISTS', 'File already exists', 409)
+        finally:
+            os.unlink(temp_path)
+        return file_path
+    if compression and is_compressible(file_path.name):
+        temp_path = compress_file(temp_path, compression)
+    if store is not None:
+        try:
+            return store.add(temp_path, digest, file_path)
+        except FileExistsError:
+            raise UploadError('FILE_EXISTS', 'File already exists', 409)
+
+    try:
+        os.link(temp_path, file_path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            os.unlink(temp_path)
+            raise UploadError('FILE_EXISTS', 'File already exists', 409)
+        # No hard links on this filesystem: fall back to a plain rename
+        if file_path.exists():
+            os.unlink(temp_path)
+            raise UploadError('FILE_EXISTS', 'File already exists', 409)
+        os.replace(temp_path, file_path)
+        return file_path
+    os.unlink(temp_path)
+    return file_path
+
+
+def save_upload(part, files_dir, max_size, store=None, compression=None):
+    """Stream one file part to disk and return (final path, SHA-256 hex)."""
+    file_path = validate_upload_name(part.filename, files_dir)
+    digest = hashlib.sha256()
+    temp_path, _ = write_temp(part.chunks(), files_dir, max_size, digest)
+    return place_file(temp_path, file_path, store, digest.hexdigest(), compression), digest.hexdigest()
+
+
+def stream_single_upload(stream, content_type, content_length, files_dir, max_size, store=None, compression=None):
+    """Handle a single-file upload from the raw request body."""
+    check_content_length(content_length, max_size)
+    reader = MultipartReader(stream, content_type)
+    for part in reader.parts():
+        if part.name == 'file' and part.filename is not None:
+            return save_upload(part, files_dir, max_size, store, compression)
+    raise UploadError('NO_FILE_PART', 'No file part in the request')
@@ -0,0 +1,33 @@
+"""
+Background job handlers, by job kind.
+
+Each handler takes the job's JSON payload and runs in a job worker
+thread inside the app context. Raising retries the job with backoff;
+PermanentJobError fails it for good.
+"""
+
+from flask import current_app
+
+from jobs import PermanentJobError
+from previews import DEFAULT_SIZE, PreviewError
+from routes import get_file_previewer, validate_file_path
+
+
+def render_thumbnail(payload):
+    """Render an uploaded file's thumbnail into the cache."""
+    file_path = validate_file_path(payload['name'])
+    if file_path is None or not file_path.is_file():
+        # Deleted since it was uploaded
+        return
+    try:
+        get_file_previewer().thumbnail(file_path, payload.get('size', DEFAULT_SIZE), payload.get('content_hash'),
+                                       current_app.config['PREVIEW_TIMEOUT'])
+    except PreviewError as e:
+        if e.status == 503:
+            raise
+        raise PermanentJobError(e.message)
+
+
+JOB_HANDLERS = {
+    'thumbnail': render_thumbnail,
+}
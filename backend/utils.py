@@ -7,6 +7,8 @@ import os
 from datetime import datetime
 from pathlib import Path
 
+from compression import logical_size
+
 
 def format_file_size(size_bytes):
     """Convert file size to human-readable format."""
@@ -45,15 +47,23 @@ def sanitize_filename(filename):
     return os.path.basename(filename).replace('/', '').replace('\\', '')
 
 
+def file_info_from_stat(name, stat, size=None):
+    """Build file metadata from an existing stat result.
+
+    size overrides stat.st_size for files compressed at rest.
+    """
+    return {
+        'name': name,
+        'size': stat.st_size if size is None else size,
+        'last_modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+        'type': Path(name).suffix.lower() or 'no-extension'
+    }
+
+
 def get_file_info(file_path):
     """Get file metadata."""
     try:
-        stat = file_path.stat()
-        return {
-            'name': file_path.name,
-            'size': stat.st_size,
-            'last_modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-            'type': file_path.suffix.lower() or 'no-extension'
-        }
+        st = file_path.stat()
+        return file_info_from_stat(file_path.name, st, logical_size(file_path, st))
     except:
         return None
\ No newline at end of file
@@ -0,0 +1,28 @@
+import type { FileType } from '../types/File'
+
+export type FileChangeType = 'created' | 'modified' | 'deleted'
+
+export interface FileChange {
+  seq: number
+  type: FileChangeType
+  name: string
+  file: FileType | null  // null for deletions
+  time: string
+}
+
+export interface ChangeFeedHandlers {
+  onChange: (change: FileChange) => void
+  // Events since the last one seen were lost: refetch, then carry on from seq
+  onReset: (seq: number) => void
+}
+
+// An EventSource resumes from the last event id by itself after a reconnect
+export const subscribeToChanges = (handlers: ChangeFeedHandlers): (() => void) => {
+  const source = new EventSource(`${import.meta.env.VITE_API_URL}/api/changes`)
+  const onChange = (event: MessageEvent) => handlers.onChange(JSON.parse(event.data))
+  for (const type of ['created', 'modified', 'deleted']) {
+    source.addEventListener(type, onChange)
+  }
+  source.addEventListener('reset', (event: MessageEvent) => handlers.onReset(JSON.parse(event.data).seq))
+  return () => source.close()
+}
@@ -2,4 +2,15 @@ import { apiRequest } from './client'
 
 export const deleteFile = async (filename: string): Promise<void> => {
   return apiRequest.delete(`/api/files/${encodeURIComponent(filename)}`)
-}
\ No newline at end of file
+}
+
+export interface BulkDeleteResult {
+  dry_run: boolean
+  summary: { total: number; deleted: number; failed: number; bytes_freed: number }
+  failures: { filename: string; error: { code: string; message: string } }[]
+  files?: string[]
+}
+
+export const deleteFiles = async (names: string[], dryRun = false): Promise<BulkDeleteResult> => {
+  return apiRequest.post<BulkDeleteResult>('/api/files/bulk-delete', { names, dry_run: dryRun })
+}
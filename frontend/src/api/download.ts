@@ -4,4 +4,24 @@ export const downloadFile = async (filename: string): Promise<Blob> => {
   return apiRequest.get<Blob>(`/download/${filename}`, {
     responseType: 'blob',
   })
-}
\ No newline at end of file
+}
+
+// Many files as one archive, built by the server while it streams
+export const downloadArchive = async (names: string[], format: 'zip' | 'tar' = 'zip'): Promise<Blob> => {
+  return apiRequest.post<Blob>('/api/files/archive', { names, format }, {
+    responseType: 'blob',
+  })
+}
+
+const PREVIEWABLE_TYPES = ['.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp', '.pdf']
+
+export const hasThumbnail = (filename: string): boolean => {
+  const dot = filename.lastIndexOf('.')
+  return dot > 0 && PREVIEWABLE_TYPES.includes(filename.slice(dot).toLowerCase())
+}
+
+// Versioned by modification time, so the browser may cache it indefinitely
+export const thumbnailUrl = (filename: string, lastModified: Date | string, size = 256): string => {
+  const version = new Date(lastModified).getTime()
+  return `${import.meta.env.VITE_API_URL}/api/files/${encodeURIComponent(filename)}/thumbnail?size=${size}&v=${version}`
+}
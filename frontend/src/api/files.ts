@@ -1,8 +1,8 @@
 import { apiRequest } from './client'
 import type { FileType } from '../types/File'
-import type { PaginatedResponse, PaginationParams } from '../types/Pagination'
+import type { FileFacets, PaginatedResponse, PaginationParams } from '../types/Pagination'
 
-export const getFiles = async (params?: PaginationParams): Promise<PaginatedResponse<FileType>> => {
+const toQueryString = (params?: object): string => {
   const queryParams = new URLSearchParams()
   
   Object.entries(params || {}).forEach(([key, value]) => {
@@ -11,6 +11,14 @@ export const getFiles = async (params?: PaginationParams): Promise<PaginatedResp
     }
   })
   
-  const url = `/api/files${queryParams.toString() ? `?${queryParams.toString()}` : ''}`
-  return apiRequest.get<PaginatedResponse<FileType>>(url)
+  return queryParams.toString() ? `?${queryParams.toString()}` : ''
+}
+
+export const getFiles = async (params?: PaginationParams): Promise<PaginatedResponse<FileType>> => {
+  return apiRequest.get<PaginatedResponse<FileType>>(`/api/files${toQueryString(params)}`)
+}
+
+// Counts per type and month for the same filters, without fetching rows
+export const getFileFacets = async (params?: Omit<PaginationParams, 'page' | 'per_page' | 'cursor'>): Promise<FileFacets> => {
+  return apiRequest.get<FileFacets>(`/api/files/facets${toQueryString(params)}`)
 }
\ No newline at end of file
@@ -2,4 +2,5 @@ export * from './client'
 export * from './files'
 export * from './upload'
 export * from './download'
-export * from './delete'
\ No newline at end of file
+export * from './delete'
+export * from './changes'
\ No newline at end of file
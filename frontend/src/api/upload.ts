@@ -1,12 +1,181 @@
 import { apiRequest } from './client'
 import type { FileType } from '../types/File'
 
+// Ids of the background jobs queued for the file (see getJob)
+export type UploadedFile = FileType & { jobs?: string[] }
+
 export interface UploadResponse {
   message: string
-  file: FileType
+  file: UploadedFile
+}
+
+export interface UploadSession {
+  upload_id: string
+  chunk_size: number
+  total_chunks: number
+  expires_at: number
+}
+
+export interface UploadStatus extends UploadSession {
+  filename: string
+  size: number
+  received: [number, number][]
+  received_bytes: number
+  complete: boolean
+}
+
+export interface ChunkedUploadOptions {
+  concurrency?: number
+  onProgress?: (uploadedBytes: number, totalBytes: number) => void
+}
+
+// Files above this size go through the resumable chunked API
+export const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+const DEFAULT_CONCURRENCY = 4
+const SESSION_STORAGE_PREFIX = 'upload-session:'
+
+const sessionKey = (file: File) =>
+  `${SESSION_STORAGE_PREFIX}${file.name}:${file.size}:${file.lastModified}`
+
+const sha256Hex = async (data: ArrayBuffer): Promise<string | undefined> => {
+  // crypto.subtle only exists in secure contexts; the server treats checksums as optional
+  if (!globalThis.crypto?.subtle) return undefined
+  const digest = await crypto.subtle.digest('SHA-256', data)
+  return Array.from(new Uint8Array(digest))
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('')
+}
+
+const receivedChunks = (status: UploadStatus): Set<number> => {
+  const received = new Set<number>()
+  status.received.forEach(([first, last]) => {
+    for (let i = first; i <= last; i++) received.add(i)
+  })
+  return received
+}
+
+const resumeOrStartSession = async (file: File): Promise<{ session: UploadSession; received: Set<number> }> => {
+  const storedId = localStorage.getItem(sessionKey(file))
+  if (storedId) {
+    try {
+      const status = await apiRequest.get<UploadStatus>(`/api/uploads/${storedId}`)
+      return { session: status, received: receivedChunks(status) }
+    } catch {
+      localStorage.removeItem(sessionKey(file))
+    }
+  }
+
+  const session = await apiRequest.post<UploadSession>('/api/uploads', {
+    filename: file.name,
+    size: file.size,
+  })
+  localStorage.setItem(sessionKey(file), session.upload_id)
+  return { session, received: new Set() }
+}
+
+export const uploadFileChunked = async (
+  file: File,
+  { concurrency = DEFAULT_CONCURRENCY, onProgress }: ChunkedUploadOptions = {}
+): Promise<UploadResponse> => {
+  const { session, received } = await resumeOrStartSession(file)
+  const { upload_id, chunk_size, total_chunks } = session
+
+  const chunkLength = (index: number) => Math.min(chunk_size, file.size - index * chunk_size)
+  let uploadedBytes = Array.from(received).reduce((sum, index) => sum + chunkLength(index), 0)
+  onProgress?.(uploadedBytes, file.size)
+
+  const pending = Array.from({ length: total_chunks }, (_, i) => i).filter((i) => !received.has(i))
+
+  const worker = async () => {
+    for (let index = pending.shift(); index !== undefined; index = pending.shift()) {
+      const data = await file.slice(index * chunk_size, (index + 1) * chunk_size).arrayBuffer()
+      const checksum = await sha256Hex(data)
+      await apiRequest.put(`/api/uploads/${upload_id}/chunks/${index}`, data, {
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          ...(checksum ? { 'X-Chunk-Checksum': checksum } : {}),
+        },
+      })
+      uploadedBytes += data.byteLength
+      onProgress?.(uploadedBytes, file.size)
+    }
+  }
+
+  await Promise.all(Array.from({ length: Math.min(concurrency, pending.length) }, worker))
+
+  const response = await apiRequest.post<UploadResponse>(`/api/uploads/${upload_id}/complete`)
+  localStorage.removeItem(sessionKey(file))
+  return response
+}
+
+export interface BatchUploadResult {
+  filename: string
+  status: 'uploaded' | 'error'
+  file?: UploadedFile
+  error?: { code: string; message: string }
+}
+
+export interface BatchUploadResponse {
+  results: BatchUploadResult[]
+  summary: { total: number; uploaded: number; failed: number }
+}
+
+// Small files are sent together, at most this many or this many bytes per request
+const BATCH_MAX_FILES = 100
+const BATCH_MAX_BYTES = 32 * 1024 * 1024
+
+export const uploadFilesBatch = async (files: File[]): Promise<BatchUploadResponse> => {
+  const formData = new FormData()
+  files.forEach((file) => formData.append('files', file))
+
+  // Partial success comes back as 207, which axios treats as success
+  return apiRequest.post<BatchUploadResponse>('/api/files/batch', formData, {
+    headers: {
+      'Content-Type': 'multipart/form-data',
+    },
+  })
+}
+
+// Upload many files: large ones resumably, the rest in as few batch requests as possible
+export const uploadFiles = async (files: File[]): Promise<BatchUploadResult[]> => {
+  const results: BatchUploadResult[] = []
+  let batch: File[] = []
+  let batchBytes = 0
+
+  const flush = async () => {
+    if (batch.length === 0) return
+    const response = await uploadFilesBatch(batch)
+    results.push(...response.results)
+    batch = []
+    batchBytes = 0
+  }
+
+  for (const file of files) {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+      try {
+        const response = await uploadFileChunked(file)
+        results.push({ filename: file.name, status: 'uploaded', file: response.file })
+      } catch (err: unknown) {
+        const message = err instanceof Error ? err.message : 'Upload failed'
+        results.push({ filename: file.name, status: 'error', error: { code: 'UPLOAD_ERROR', message } })
+      }
+      continue
+    }
+    if (batch.length >= BATCH_MAX_FILES || batchBytes + file.size > BATCH_MAX_BYTES) {
+      await flush()
+    }
+    batch.push(file)
+    batchBytes += file.size
+  }
+  await flush()
+  return results
 }
 
 export const uploadFile = async (file: File): Promise<UploadResponse> => {
+  if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+    return uploadFileChunked(file)
+  }
+
   const formData = new FormData()
   formData.append('file', file)
 
@@ -15,4 +184,21 @@ export const uploadFile = async (file: File): Promise<UploadResponse> => {
       'Content-Type': 'multipart/form-data',
     },
   })
-}
\ No newline at end of file
+}
+
+export interface Job {
+  id: string
+  kind: string
+  payload: Record<string, unknown>
+  status: 'queued' | 'running' | 'succeeded' | 'failed'
+  attempts: number
+  max_attempts: number
+  run_after: string | null
+  error: string | null
+  created_at: string
+  updated_at: string
+}
+
+export const getJob = async (jobId: string): Promise<Job> => {
+  return apiRequest.get<Job>(`/api/jobs/${jobId}`)
+}
@@ -9,7 +9,7 @@ import { useState } from 'react'
 import { formatFileSize } from '../utils/formatFileSize'
 import { format } from 'date-fns'
 import fileImage from '../assets/file.png'
-import { deleteFile } from '../api'
+import { deleteFile, hasThumbnail, thumbnailUrl } from '../api'
 import { useNavigate } from 'react-router'
 import { useFilesStore } from '../store/filesStore'
 import { useNotificationStore } from '../store/notificationStore'
@@ -24,6 +24,7 @@ function FileCard({ file }: FileCardProps) {
   const [isDeleting, setIsDeleting] = useState(false)
   const [deleteDialogOpen, setDeleteDialogOpen] = useState(false)
   const [error, setError] = useState<string | null>(null)
+  const [thumbnailFailed, setThumbnailFailed] = useState(false)
   
   const navigate = useNavigate()
   const { deleteFile: deleteFileFromStore } = useFilesStore()
@@ -98,9 +99,10 @@ function FileCard({ file }: FileCardProps) {
         <CardMedia
           component="img"
           height="200"
-          image={fileImage}
+          image={hasThumbnail(file.name) && !thumbnailFailed ? thumbnailUrl(file.name, file.last_modified) : fileImage}
           alt={file.name}
           loading="lazy"
+          onError={() => setThumbnailFailed(true)}
           sx={{
             objectFit: 'contain',
           }}
@@ -1,7 +1,7 @@
 import { useState, useRef } from 'react'
 import { Box, Typography, CircularProgress, Paper } from '@mui/material'
 import CloudUploadIcon from '@mui/icons-material/CloudUpload'
-import { uploadFile } from '../api/upload'
+import { uploadFile, uploadFiles } from '../api/upload'
 import type { FileType } from '../types/File'
 import { useNotificationStore } from '../store/notificationStore'
 
@@ -19,8 +19,43 @@ function UploadComponent({ onUploadSuccess, onUploadError }: UploadComponentProp
   const handleFileSelect = async (files: FileList | null) => {
     if (!files || files.length === 0) return
 
-    const file = files[0]
-    await uploadSingleFile(file)
+    if (files.length === 1) {
+      await uploadSingleFile(files[0])
+    } else {
+      await uploadManyFiles(Array.from(files))
+    }
+  }
+
+  const uploadManyFiles = async (selected: File[]) => {
+    setIsUploading(true)
+
+    try {
+      const results = await uploadFiles(selected)
+      const failed = results.filter((result) => result.status === 'error')
+      results.forEach((result) => {
+        if (result.file) onUploadSuccess?.(result.file)
+      })
+      addNotification({
+        message: failed.length === 0
+          ? `Successfully uploaded ${results.length} files`
+          : `Uploaded ${results.length - failed.length} of ${results.length} files; failed: ${failed
+              .slice(0, 3)
+              .map((result) => `${result.filename} (${result.error?.message})`)
+              .join(', ')}${failed.length > 3 ? '…' : ''}`,
+        severity: failed.length === 0 ? 'success' : 'warning',
+        autoHideDuration: failed.length === 0 ? 3000 : 8000
+      })
+    } catch (err: unknown) {
+      const error = err instanceof Error ? err : new Error('Upload failed')
+      addNotification({
+        message: `Upload failed: ${error.message}`,
+        severity: 'error',
+        autoHideDuration: 5000
+      })
+      onUploadError?.(error)
+    } finally {
+      setIsUploading(false)
+    }
   }
 
   const uploadSingleFile = async (file: File) => {
@@ -101,6 +136,7 @@ function UploadComponent({ onUploadSuccess, onUploadError }: UploadComponentProp
         <input
           ref={fileInputRef}
           type="file"
+          multiple
           hidden
           onChange={(e) => handleFileSelect(e.target.files)}
           disabled={isUploading}
@@ -0,0 +1,43 @@
+import { useEffect } from "react"
+import { useQueryClient } from "@tanstack/react-query"
+import { subscribeToChanges } from "../api"
+import type { FileChange } from "../api"
+import type { FileType, PaginatedResponse } from "../types"
+
+const patchPage = (page: PaginatedResponse<FileType> | undefined, change: FileChange) => {
+  if (!page || !page.files.some((file) => file.name === change.name)) {
+    return page
+  }
+  if (change.type === 'deleted') {
+    return {
+      files: page.files.filter((file) => file.name !== change.name),
+      pagination: { ...page.pagination, total_files: page.pagination.total_files - 1 },
+    }
+  }
+  return {
+    ...page,
+    files: page.files.map((file) => (file.name === change.name && change.file ? change.file : file)),
+  }
+}
+
+// Keeps cached listings current: edits and deletions are patched in place,
+// new files (whose page depends on sorting and filters) trigger a refetch
+export const useFileChanges = () => {
+  const queryClient = useQueryClient()
+
+  useEffect(() => {
+    return subscribeToChanges({
+      onChange: (change) => {
+        if (change.type === 'created') {
+          queryClient.invalidateQueries({ queryKey: ['files'] })
+        } else {
+          queryClient.setQueriesData<PaginatedResponse<FileType>>(
+            { queryKey: ['files'] },
+            (page) => patchPage(page, change),
+          )
+        }
+      },
+      onReset: () => queryClient.invalidateQueries({ queryKey: ['files'] }),
+    })
+  }, [queryClient])
+}
@@ -5,6 +5,7 @@ import FileFilter from '../components/FileFilter'
 import UploadComponent from '../components/UploadComponent'
 import { PaginationComponent } from '../components/PaginationComponent'
 import { useGetFiles } from '../hooks/useGetFiles'
+import { useFileChanges } from '../hooks/useFileChanges'
 import { useFilesStore } from '../store/filesStore'
 import { useEffect } from 'react'
 import type { PaginationParams } from '../types'
@@ -40,6 +41,7 @@ function ListFiles() {
     per_page: itemsPerPage,
     ...backendParams as PaginationParams
   })
+  useFileChanges()
 
   useEffect(() => {
     if (data) {
@@ -29,7 +29,7 @@ type FileStore = {
   goToPrevPage: () => void;
   goToPage: (page: number) => void;
   resetSearchAndSort: () => void;
-  getBackendSearchParams: () => { search?: string; sort_by?: string; sort_order?: string; date_from?: string; date_to?: string };
+  getBackendSearchParams: () => { search?: string; sort_by?: string; sort_order?: string; modified_after?: string; modified_before?: string };
 }
 export const useFilesStore = create((set, get) : FileStore => ({
   files: [],
@@ -160,7 +160,7 @@ export const useFilesStore = create((set, get) : FileStore => ({
   
   getBackendSearchParams: () => {
     const { searchTerm, sortBy, sortOrder, startDate, endDate } = get();
-    const params: { search?: string; sort_by?: 'name' | 'size' | 'modified' | 'type'; sort_order?: 'asc' | 'desc'; date_from?: string; date_to?: string } = {};
+    const params: { search?: string; sort_by?: 'name' | 'size' | 'modified' | 'type'; sort_order?: 'asc' | 'desc'; modified_after?: string; modified_before?: string } = {};
     
     if (searchTerm.trim()) {
       params.search = searchTerm.trim();
@@ -173,13 +173,13 @@ export const useFilesStore = create((set, get) : FileStore => ({
     
     // Add date range parameters using date-fns format
     if (startDate) {
-      params.date_from = format(startDate, 'yyyy-MM-dd');
+      params.modified_after = format(startDate, 'yyyy-MM-dd');
     }
     
     if (endDate) {
-      params.date_to = format(endDate, 'yyyy-MM-dd');
+      params.modified_before = format(endDate, 'yyyy-MM-dd');
     }
     
-    return params as { search?: string; sort_by?: 'name' | 'size' | 'modified' | 'type'; sort_order?: 'asc' | 'desc'; date_from?: string; date_to?: string };
+    return params as { search?: string; sort_by?: 'name' | 'size' | 'modified' | 'type'; sort_order?: 'asc' | 'desc'; modified_after?: string; modified_before?: string };
   },
 }))
@@ -5,6 +5,7 @@ export interface PaginationMetadata {
   total_pages: number
   has_next: boolean
   has_prev: boolean
+  next_cursor?: string | null
 }
 
 export interface PaginatedResponse<T> {
@@ -18,6 +19,17 @@ export interface PaginationParams {
   search?: string
   sort_by?: 'name' | 'size' | 'modified' | 'type'
   sort_order?: 'asc' | 'desc'
-  date_from?: string
-  date_to?: string
-}
\ No newline at end of file
+  modified_after?: string
+  modified_before?: string
+  older_than?: string  // duration such as '30d'
+  types?: string
+  min_size?: number
+  max_size?: number
+  cursor?: string
+}
+
+export interface FileFacets {
+  total_files: number
+  types: Record<string, number>
+  months: Record<string, number>
+}